@@ -1,47 +1,52 @@
 import numpy as np
-from pathlib import Path
-import os
-folder = 'folder/to/npy/files'
-img_ind0 = 'image_indices_subset_test_set_CV0_0_0.95.npy'
-img_ind1 = 'image_indices_subset_test_set_CV0_1_0.95.npy'
-img_ind2 = 'image_indices_subset_test_set_CV0_2_0.95.npy'
-img_ind3 = 'image_indices_subset_test_set_CV0_3_0.95.npy'
-img_ind4 = 'image_indices_subset_test_set_CV0_4_0.95.npy'
+from cnn.preprocessor.image_path_index import build_image_path_index
+from cnn.prediction_store import prediction_store_exists, load_from_prediction_store, save_to_prediction_store
+folder = 'folder/to/npy/files/'
+img_ind0 = 'subset_test_set_CV0_0_0.95'
+img_ind1 = 'subset_test_set_CV0_1_0.95'
+img_ind2 = 'subset_test_set_CV0_2_0.95'
+img_ind3 = 'subset_test_set_CV0_3_0.95'
+img_ind4 = 'subset_test_set_CV0_4_0.95'
+new_img_ind = 'Cardiomegalytest_set_CV4_1.00'
 
 IMG_PATH = 'this/is/new/image/path'
-npy_file0 = np.load(folder+img_ind0, allow_pickle=True)
-npy_file = np.load(folder+img_ind2, allow_pickle=True)
-npy_file1 = np.load(folder+img_ind1, allow_pickle=True)
-npy_file3 = np.load(folder+img_ind4, allow_pickle=True)
-npy_file2 = np.load(folder+img_ind3, allow_pickle=True)
+
+
+def load_image_indices(file_unique_name):
+    if prediction_store_exists(folder, file_unique_name):
+        return load_from_prediction_store(folder, file_unique_name, ('image_indices',))[0]
+    # separate .npy files of runs before the prediction store
+    return np.load(folder + 'image_indices_' + file_unique_name + '.npy', allow_pickle=True)
+
+
+def save_image_indices(file_unique_name, image_indices):
+    if prediction_store_exists(folder, file_unique_name):
+        save_to_prediction_store(folder, file_unique_name, image_indices=image_indices)
+    else:
+        np.save(folder + 'image_indices_' + file_unique_name + '.npy', image_indices)
+
+
+npy_file0 = load_image_indices(img_ind0)
+npy_file = load_image_indices(img_ind2)
+npy_file1 = load_image_indices(img_ind1)
+npy_file3 = load_image_indices(img_ind4)
+npy_file2 = load_image_indices(img_ind3)
 assert (npy_file.all()==npy_file0.all()), "files are not the same"
 assert (npy_file==npy_file1).all(), "files are not the same"
 assert (npy_file2==npy_file1).all(), "filer are not the same"
 assert (npy_file2==npy_file3).all(), "fitler are not the same"
 
 
-def replace_all_image_paths(old_img_path_all_images, new_path):
-    new_paths = []
-    for img_path in old_img_path_all_images:
-        img_ind = get_img_ind(img_path)
-        img_new_path = find_new_img_path_from_image_index(img_ind, new_path)
-        new_paths.append(str(img_new_path))
-    return new_paths
+def replace_all_image_paths(old_img_path_all_images, new_path, path_index_file=None):
+    path_index = build_image_path_index(new_path, index_file=path_index_file)
+    # images missing from the new location get the path 'None'
+    return [str(path_index.get(get_img_ind(img_path))) for img_path in old_img_path_all_images]
 
 
 def get_img_ind(old_img_path):
     return old_img_path.split('/')[-1]
 
 
-def find_new_img_path_from_image_index(img_ind, new_path):
-    for src_path in Path(new_path).glob('**/*.png'):
-        image_ind_in_new_path = os.path.basename(src_path)
-        if image_ind_in_new_path == img_ind:
-            return src_path
-
-    return None
-
-
 new_img_path = replace_all_image_paths(npy_file0, IMG_PATH)
 
-np.save(folder + 'image_indices_Cardiomegalytest_set_CV4_1.00.npy', new_img_path)
+save_image_indices(new_img_ind, new_img_path)
@@ -12,8 +12,7 @@ from cnn.nn_architecture import keras_model
 from cnn import keras_utils
 import cnn.preprocessor.load_data as ld
 from cnn.nn_architecture.custom_performance_metrics import keras_accuracy, accuracy_asloss
-from cnn.nn_architecture.custom_loss import keras_loss_v3_nor, keras_loss_v3_lse, keras_loss_v3_lse01, \
-    keras_loss_v3_mean, keras_loss_v3_max
+from cnn.nn_architecture.custom_loss import get_keras_loss
 from cnn.keras_preds import predict_patch_and_save_results
 from cnn.preprocessor.load_data_datasets import load_process_xray14
 from cnn.preprocessor.load_data_mura import load_mura, split_data_cv, filter_rows_on_class, filter_rows_and_columns
@@ -58,6 +57,9 @@ def cross_validation(config, number_splits=5):
     lr = config['lr']
     reg_weight = config['reg_weight']
     pooling_operator = config['pooling_operator']
+    mixed_precision, jit_compile = keras_model.get_fast_training_options(config)
+    # one model is trained for 'class_name' in each split, all findings at once only with train_model.py
+    assert not config.get('multi_label', False), "'multi_label' is supported only by train_model.py"
 
     use_xray, use_pascal = set_dataset_flag(dataset_name)
 
@@ -86,6 +88,7 @@ def cross_validation(config, number_splits=5):
                                                       mura_train_labels_path, mura_test_labels_path, mura_test_img_path)
 
     for split in range(0, number_splits):
+        split_metadata = {'pooling_operator': pooling_operator, 'cv_split': split}
 
         if use_xray:
             df_train, df_val, df_test, _, _,_ = ld.split_xray_cv(xray_df, number_splits,
@@ -115,7 +118,8 @@ def cross_validation(config, number_splits=5):
                 box_size=BOX_SIZE,
                 processed_y=skip_processing,
                 interpolation=mura_interpolation,
-                shuffle=True)
+                shuffle=True,
+                **gen.get_decoding_options(config))
 
             valid_generator = gen.BatchGenerator(
                 instances=df_val.values,
@@ -127,10 +131,13 @@ def cross_validation(config, number_splits=5):
                 norm=keras_utils.normalize,
                 processed_y=skip_processing,
                 interpolation=mura_interpolation,
-                shuffle=True)
+                shuffle=True,
+                **gen.get_decoding_options(config))
+            keras_model.set_jit_compile(jit_compile)
             model = keras_model.build_model(reg_weight)
 
-            model = keras_model.compile_model_accuracy(model, lr, pool_op=pooling_operator)
+            model = keras_model.compile_model_accuracy(model, lr, pool_op=pooling_operator,
+                                                       mixed_precision=mixed_precision)
 
             #   checkpoint on every epoch is not really needed here, not used, CALLBACK REMOVED from the generator
             filepath = trained_models_path + "CV_"+str(split)+"_epoch-{epoch:02d}-{val_loss:.2f}.hdf5"
@@ -142,8 +149,11 @@ def cross_validation(config, number_splits=5):
             print(len(df_train)//BATCH_SIZE)
             print(train_generator.__len__())
 
+            # the generator reshuffles its instances in on_epoch_end, the batches are requested in order so the next
+            # batches can be prefetched
             history = model.fit_generator(
                 generator=train_generator,
+                shuffle=False,
                 steps_per_epoch=train_generator.__len__(),
                 epochs=nr_epochs,
                 validation_data=valid_generator,
@@ -165,15 +175,18 @@ def cross_validation(config, number_splits=5):
             ############################################    PREDICTIONS      #############################################
             predict_patch_and_save_results(model, 'test_set_CV'+str(split), df_test, skip_processing,
                                            BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                           mura_interpolation, resized_images_before_training)
+                                           mura_interpolation, resized_images_before_training,
+                                           metadata=split_metadata)
             predict_patch_and_save_results(model, 'train_set_CV' + str(split), df_train,
                                            skip_processing,
                                            BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                           mura_interpolation, resized_images_before_training)
+                                           mura_interpolation, resized_images_before_training,
+                                           metadata=split_metadata)
             predict_patch_and_save_results(model, 'val_set_CV' + str(split), df_val,
                                            skip_processing,
                                            BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                           mura_interpolation, resized_images_before_training)
+                                           mura_interpolation, resized_images_before_training,
+                                           metadata=split_metadata)
             ##### EVALUATE function
 
             print("evaluate validation")
@@ -196,7 +209,8 @@ def cross_validation(config, number_splits=5):
                 norm=keras_utils.normalize,
                 box_size=BOX_SIZE,
                 processed_y=skip_processing,
-                interpolation=mura_interpolation)
+                interpolation=mura_interpolation,
+                **gen.get_decoding_options(config))
 
             evaluate_test = model.evaluate_generator(
                 generator=test_generator,
@@ -208,6 +222,9 @@ def cross_validation(config, number_splits=5):
             print(evaluate)
             print("Evaluate test")
             print(evaluate_test)
+            # stops the workers decoding the images
+            for generator in [train_generator, valid_generator, test_generator]:
+                generator.close()
         else:
             files_found = 0
             print(trained_models_path)
@@ -220,27 +237,24 @@ def cross_validation(config, number_splits=5):
 
             assert files_found == 1, "No model found/ Multiple models found, not clear which to use "
             print(str(files_found))
-            loss_function_dict = {'nor': keras_loss_v3_nor,
-                                  "lse": keras_loss_v3_lse,
-                                  "lse01": keras_loss_v3_lse01,
-                                  "max": keras_loss_v3_max,
-                                  "mean": keras_loss_v3_mean
-                                  }
             model = load_model(str(file_path),
                                custom_objects={
-                                   loss_function_dict[pooling_operator].__name__: loss_function_dict[pooling_operator],
+                                   get_keras_loss(pooling_operator).__name__: get_keras_loss(pooling_operator),
                                    'keras_accuracy': keras_accuracy,
                                    'accuracy_asloss': accuracy_asloss})
             model = keras_model.compile_model_accuracy(model, lr, pooling_operator)
 
             predict_patch_and_save_results(model, "train_set_CV" + (str(split)), df_train, skip_processing,
                                            BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                           mura_interpolation, resized_images_before_training)
+                                           mura_interpolation, resized_images_before_training,
+                                           metadata=split_metadata)
             predict_patch_and_save_results(model, "val_set_CV" + (str(split)), df_val, skip_processing,
                                            BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                           mura_interpolation, resized_images_before_training)
+                                           mura_interpolation, resized_images_before_training,
+                                           metadata=split_metadata)
             predict_patch_and_save_results(model, "test_set_CV" + (str(split)), df_test, skip_processing,
                                            BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                           mura_interpolation, resized_images_before_training)
+                                           mura_interpolation, resized_images_before_training,
+                                           metadata=split_metadata)
 
 
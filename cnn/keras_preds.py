@@ -4,18 +4,29 @@ import numpy as np
 from sklearn.metrics import confusion_matrix, roc_auc_score
 from cnn.nn_architecture.custom_performance_metrics import combine_predictions_each_batch
 import cnn.nn_architecture.keras_generators as gen
+from cnn.nn_architecture.pooling import compute_pooling, compute_segmentation_pooling, get_pooling_operator
 from cnn.keras_utils import normalize, save_evaluation_results, plot_roc_curve, plot_confusion_matrix, \
-    image_larger_input, calculate_scale_ratio, set_dataset_flag, build_path_results
+    set_dataset_flag, build_path_results
+from cnn.prediction_store import save_to_prediction_store, prediction_store_exists, load_from_prediction_store, \
+    load_numeric_npy
 from pathlib import Path
-from keras_preprocessing.image import load_img, img_to_array
 from sklearn.metrics import roc_auc_score, roc_curve, auc
 
-from cnn.preprocessor.load_data_mura import padding_needed, pad_image
+from cnn.preprocessor.image_transform import transform_image
 
 
 def predict_patch_and_save_results(saved_model, file_unique_name, data_set, processed_y,
                                    test_batch_size, box_size, image_size, res_path, mura_interpolation,
-                                   resized_images_before_training):
+                                   resized_images_before_training, metadata=None, class_names=None):
+    """
+    Predicts the patches of a set and saves the predictions, image indices and patch labels in the prediction store
+    of the model run (see prediction_store.py).
+    :param metadata: optional dictionary with settings of the run (e.g. pooling operator, CV split, subset seed,
+                    overlap ratio) saved with the predictions
+    :param class_names: optional - names of the classes of a model predicting several classes, in the order of the
+                    output channels. The predictions of each class are also saved in a store of their own,
+                    <file_unique_name>_<class name>, which is evaluated like the store of a single class model
+    """
     test_generator = gen.BatchGenerator(
         instances=data_set.values,
         resized_image=resized_images_before_training,
@@ -30,7 +41,6 @@ def predict_patch_and_save_results(saved_model, file_unique_name, data_set, proc
     )
 
     predictions = saved_model.predict_generator(test_generator, steps=test_generator.__len__(), workers=1)
-    np.save(res_path + 'predictions_' + file_unique_name, predictions)
 
     all_img_ind = []
     all_patch_labels = []
@@ -40,8 +50,16 @@ def predict_patch_and_save_results(saved_model, file_unique_name, data_set, proc
         res_img_ind = test_generator.get_batch_image_indices(batch_ind)
         all_img_ind = combine_predictions_each_batch(res_img_ind, all_img_ind, batch_ind)
         all_patch_labels = combine_predictions_each_batch(y_cast, all_patch_labels, batch_ind)
-    np.save(res_path + 'image_indices_' + file_unique_name, all_img_ind)
-    np.save(res_path + 'patch_labels_' + file_unique_name, all_patch_labels)
+    save_to_prediction_store(res_path, file_unique_name, metadata=metadata, overwrite=True, predictions=predictions,
+                             image_indices=all_img_ind, patch_labels=all_patch_labels)
+    if class_names is not None and len(class_names) > 1:
+        assert len(class_names) == predictions.shape[-1], "A class name is needed for each predicted class"
+        for class_ind, class_name in enumerate(class_names):
+            class_metadata = dict(metadata or {}, class_name=class_name)
+            save_to_prediction_store(res_path, file_unique_name + '_' + class_name, metadata=class_metadata,
+                                     overwrite=True, predictions=predictions[..., class_ind:class_ind + 1],
+                                     image_indices=all_img_ind,
+                                     patch_labels=all_patch_labels[..., class_ind:class_ind + 1])
 
 
 def get_patch_labels_from_batches(generator, path, file_name):
@@ -59,18 +77,19 @@ def get_patch_labels_from_batches(generator, path, file_name):
 
 
 #################################################################
-def load_npy(file_name, res_path):
-    return np.load(res_path + file_name, allow_pickle=True)
-
-
 def get_index_label_prediction(file_set_name, res_path):
+    if prediction_store_exists(res_path, file_set_name):
+        preds, img_indices, patch_labs = load_from_prediction_store(res_path, file_set_name,
+                                                                    ('predictions', 'image_indices', 'patch_labels'))
+        return preds, img_indices, patch_labs
+    # separate .npy files of runs before the prediction store
     prediction_file = 'predictions_' + file_set_name + '.npy'
     img_ind_file = 'image_indices_' + file_set_name + '.npy'
     patch_labels_file = 'patch_labels_' + file_set_name + '.npy'
 
-    preds = load_npy(prediction_file, res_path)
-    img_indices = load_npy(img_ind_file, res_path)
-    patch_labs = load_npy(patch_labels_file, res_path)
+    preds = load_numeric_npy(res_path + prediction_file)
+    img_indices = np.load(res_path + img_ind_file, allow_pickle=True)
+    patch_labs = load_numeric_npy(res_path + patch_labels_file)
     return preds, img_indices, patch_labs
 
 
@@ -99,40 +118,12 @@ def compute_accuracy_on_segmentation(predictions, patch_labels, th_binarization,
     return np.greater_equal(iou_score, th_iou, dtype=float)
 
 
-def compute_bag_prediction_nor_on_segmentation(patch_pred, patch_labels):
-    '''
-    Computes the bag prediction using NOR pooling on images with annotated segmentation
-    NB: THIS function is used only during training, or for sanity check, but never in testing condition
-    :param patch_pred: patch predictions
-    :param patch_labels: patch labels
-    :return: probability of positive bag
-    '''
-    pos_patch_labels_mask = np.equal(patch_labels, 0.0)
-    neg_patch_labels_mask = np.equal(patch_labels, 1.0)
-
-    normalized_pos_patches = ((1 - 0.98) * patch_pred) + 0.98
-    normalized_neg_patches = ((1 - 0.98) * (1 - patch_pred)) + 0.98
-
-    # element wise multiplication is used as a boolean mask to separate active from inactive patches
-    norm_pos_patches = np.ma.masked_array(normalized_pos_patches, mask=pos_patch_labels_mask)
-    norm_neg_patches = np.ma.masked_array(normalized_neg_patches, mask=neg_patch_labels_mask)
-
-    product_positive_patches = np.prod(norm_pos_patches, axis=(1, 2))
-    product_negative_patches = np.prod(norm_neg_patches, axis=(1, 2))
-
-    return product_positive_patches * product_negative_patches
-
-
-def compute_bag_prediction_nor(patch_pred):
-    subtracted_prob = 1 - patch_pred
-
-    normalized_mat = ((1 - 0.98) * subtracted_prob) + 0.98
-    element_product = np.prod(normalized_mat, axis=(1, 2))
-    return (1.0 - element_product)
-
-
 def save_generated_files(res_path, file_unique_name, image_labels, image_predictions, has_bbox,
                          accurate_localizations, dice):
+    if prediction_store_exists(res_path, file_unique_name):
+        save_to_prediction_store(res_path, file_unique_name, image_labels=image_labels,
+                                 image_predictions=image_predictions, bbox_present=has_bbox, dice=dice)
+        return
     np.save(res_path + '/image_labels_' + file_unique_name, image_labels)
     np.save(res_path + '/image_predictions_' + file_unique_name, image_predictions)
     np.save(res_path + '/bbox_present_' + file_unique_name, has_bbox)
@@ -274,81 +265,26 @@ def compute_save_auc(eval_df, data_set_name, image_pred_method, res_path, image_
     plot_confusion_matrix(conf_matrix, [0, 1], res_path, data_set_name + 'norm', normalize=True, title=None)
 
 
-def compute_bag_prediction_mean_on_segmentation(nn_output, patch_labels):
-    '''
-    this function shows the pooling mechanism for annotated images ONLY during TRAINING
-    It is implemented for extra insight, but not used to evaluate performance of the algorithm
-    It is numpy equivalent of the tensorflow function used during training
-    :param nn_output:
-    :param patch_labels:
-    :return:
-    '''
-    pos_patch_labels_mask = np.equal(patch_labels, 0.0)
-    neg_patch_labels_mask = np.equal(patch_labels, 1.0)
-
-    pos_patches_masked = np.ma.masked_array(nn_output, mask=pos_patch_labels_mask, fill_value=0)
-    neg_patches_masked = np.ma.masked_array(1 - nn_output, mask=neg_patch_labels_mask, fill_value=0)
-
-    mean = np.mean(pos_patches_masked.filled() + neg_patches_masked.filled(), axis=(1, 2))
-    return mean
-
-
-def compute_bag_prediction_mean(patch_pred):
-    sum_patches = np.sum(patch_pred, axis=(1, 2))
-    assert np.mean(patch_pred, axis=(1, 2)).all() == np.sum((1 / 256) * sum_patches, axis=1).all(), "asserion bag error"
-    return np.mean(patch_pred, axis=(1, 2))
-
-
-def compute_bag_prediction_lse(patch_pred, r):
-    mean_exp_patches = np.mean(np.exp(r * patch_pred), axis=(1, 2))
-    assert ((1 / r) * (np.log(mean_exp_patches))).all() == np.sum((1 / 256) * np.exp(r * patch_pred), axis=1).all(), \
-        "asserion bag error"
-    return (1 / r) * (np.log(mean_exp_patches))
-
-
-def compute_bag_prediction_lse_on_segmentation(nn_output, patch_labels, r):
-    pos_patch_labels_mask = np.equal(patch_labels, 0.0)
-    neg_patch_labels_mask = np.equal(patch_labels, 1.0)
-    pos_patches_masked = np.ma.masked_array(nn_output, mask=pos_patch_labels_mask, fill_value=0)
-    neg_patches_masked = np.ma.masked_array(1 - nn_output, mask=neg_patch_labels_mask, fill_value=0)
-
-    pos_patches = r * pos_patches_masked
-    neg_patches = r * neg_patches_masked
-
-    mean = np.mean((np.exp(pos_patches)).filled() + (np.exp(neg_patches)).filled(), axis=(1, 2))
-    result = (1 / r) * np.log(mean)
+def flatten_patches(patch_pred):
+    patch_pred = np.asarray(patch_pred)
+    return patch_pred.reshape(patch_pred.shape[0], patch_pred.shape[1] * patch_pred.shape[2], -1)
 
-    sum_pos_patches = np.sum(np.exp(pos_patches).filled(), axis=(1, 2), keepdims=True)
-    sum_neg_patches = np.sum(np.exp(neg_patches).filled(), axis=(1, 2), keepdims=True)
-    sum_total = sum_neg_patches + sum_pos_patches
-    mean2 = np.sum((1 / (256)) * sum_total, axis=(1, 2))
-    result2 = (1 / r) * np.log(mean2)
-    assert (result == result2).all(), "error in lse computation"
 
-    return result
-
-
-def compute_bag_prediction_max(patch_pred):
-    return np.max(patch_pred, axis=(1, 2))
+def restore_image_prediction_shape(image_predictions, patch_pred):
+    # predictions without a class axis give one prediction per image
+    return image_predictions[:, 0] if np.ndim(patch_pred) == 3 else image_predictions
 
 
 def compute_bag_prediction_as_production(patch_pred, pool_method, lse_r):
     '''
-
-    :param patch_pred:
-    :param pool_method:
-    :param lse_r: R hyperparameter - only applicable if the pooling method is 'LSE'
-    :return:
+    Calculates the image prediction with the numpy version of a pooling operator from pooling.py
+    :param patch_pred: patch predictions
+    :param pool_method: name of the pooling operator
+    :param lse_r: R hyperparameter of the pooling operator. None: the default of the operator is used
+    :return: image predictions
     '''
-    assert pool_method in ['mean', 'nor', 'lse', 'max'], "ensure you have the right pooling method "
-    if pool_method.lower() == 'nor':
-        return compute_bag_prediction_nor(patch_pred)
-    elif pool_method.lower() == 'mean':
-        return compute_bag_prediction_mean(patch_pred)
-    elif pool_method.lower() == 'lse':
-        return compute_bag_prediction_lse(patch_pred, r=lse_r)
-    elif pool_method.lower() == 'max':
-        return compute_bag_prediction_max(patch_pred)
+    image_predictions = compute_pooling(pool_method, flatten_patches(patch_pred), backend='numpy', r=lse_r)
+    return restore_image_prediction_shape(image_predictions, patch_pred)
 
 
 def compute_bag_prediction_as_training(has_bbox, predictions, patch_labels, pool_method, r):
@@ -361,19 +297,12 @@ def compute_bag_prediction_as_training(has_bbox, predictions, patch_labels, pool
     :param pool_method: pooling method
     :return:
     '''
-    if pool_method.lower() == 'nor':
-        return np.where(has_bbox,
-                        compute_bag_prediction_nor_on_segmentation(nn_output=predictions, patch_labels=patch_labels),
-                        compute_bag_prediction_nor(predictions))
-    elif pool_method.lower() == 'mean':
-        return np.where(has_bbox,
-                        compute_bag_prediction_mean_on_segmentation(nn_output=predictions, patch_labels=patch_labels),
-                        compute_bag_prediction_mean(predictions))
-    elif pool_method.lower() == 'lse':
-        return np.where(has_bbox,
-                        compute_bag_prediction_lse_on_segmentation(nn_output=predictions, patch_labels=patch_labels,
-                                                                   r=r),
-                        compute_bag_prediction_lse(predictions, r))
+    image_predictions = np.where(
+        np.reshape(has_bbox, (len(has_bbox), -1)),
+        compute_segmentation_pooling(pool_method, flatten_patches(predictions), flatten_patches(patch_labels),
+                                     backend='numpy', r=r),
+        compute_pooling(pool_method, flatten_patches(predictions), backend='numpy', r=r))
+    return restore_image_prediction_shape(image_predictions, predictions)
 
 
 def compute_bag_prediction(predictions, has_bbox, patch_labels, pool_method, r,
@@ -389,7 +318,7 @@ def compute_bag_prediction(predictions, has_bbox, patch_labels, pool_method, r,
     :return:
     '''
     assert image_prediction_method.lower() in ['as_production', 'as_training'], "Invalid image prediction method"
-    assert pool_method in ['mean', 'nor', 'lse', 'max'], "ensure you have the right pooling method "
+    get_pooling_operator(pool_method)
 
     if image_prediction_method.lower() == 'as_production':
         return compute_bag_prediction_as_production(predictions, pool_method, r)
@@ -404,27 +333,7 @@ def do_transformation_masks_pascal(image_dir):
     :param image_dir: image path
     :return: returns resized image mask
     """
-    img_width, img_height = load_img(image_dir, target_size=None, color_mode='rgb').size
-    decrease_needed = image_larger_input(img_width, img_height, 512, 512)
-
-    # IF one or both sides have bigger size than the input, then decrease is needed
-    if decrease_needed:
-        ratio = calculate_scale_ratio(img_width, img_height, 512, 512)
-        assert ratio >= 1.00, "wrong ratio - it will increase image size"
-        assert int(img_height / ratio) == 512 or int(img_width / ratio) == 512, \
-            "error in computation"
-        image = img_to_array(load_img(image_dir, target_size=(int(img_height / ratio), int(img_width / ratio)),
-                                      color_mode='rgb'))
-    else:
-        # ELSE just open image in its original form
-        image = img_to_array(load_img(image_dir, target_size=None, color_mode='rgb'))
-    ### PADDING
-    pad_needed = padding_needed(image)
-
-    if pad_needed:
-        image = pad_image(image, final_size_x=512, final_size_y=512)
-
-    return image
+    return transform_image(image_dir, 512, 512, interpolation=False)
 
 
 def get_mask_img_ind(mask_path1, mask_path2, image_indices):
@@ -515,7 +424,10 @@ def process_mask_images_pascal(pascal_image_path, classifiers, res_path, predict
     masks_path1 = pascal_dir + "/GTMasks/ETHZ_sideviews_cars"
 
     masks_path_2 = pascal_dir + "/GTMasks/TUGraz_cars"
-    img_ind = np.load(res_path + 'image_indices_' + classifiers + '.npy', allow_pickle=True)
+    if prediction_store_exists(res_path, classifiers):
+        img_ind = load_from_prediction_store(res_path, classifiers, ('image_indices',))[0]
+    else:
+        img_ind = np.load(res_path + 'image_indices_' + classifiers + '.npy', allow_pickle=True)
     gt_masks, image_name_to_keep, indices_to_keep, parents_folder = get_mask_img_ind(masks_path1,
                                                                                      masks_path_2, img_ind)
 
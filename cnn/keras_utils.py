@@ -11,6 +11,9 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from cnn.nn_architecture.custom_loss import compute_ground_truth
 
+# instance labels of images without a bounding box, as they are saved in the processed csv files
+NEGATIVE_INSTANCE_LABELS = str(np.zeros((16, 16))).replace('\n', '')
+POSITIVE_INSTANCE_LABELS = str(np.ones((16, 16))).replace('\n', '')
 
 def image_larger_input(img_width, img_height, input_width, input_height):
     if img_width > input_width or img_height > input_height:
@@ -75,10 +78,39 @@ def set_dataset_flag(dataset_name, allowed_names=['xray', 'pascal', 'mura']):
 
 
 def process_loaded_labels(label_col):
+    if isinstance(label_col, bytes):
+        return unpack_loaded_labels([label_col])[0].astype(float)
     newstr = (label_col.replace("[", "")).replace("]", "")
     return np.fromstring(newstr, dtype=np.ones((16, 16)).dtype, sep=' ').reshape(16, 16)
 
 
+def unpack_loaded_labels(label_col):
+    """
+    :param label_col: instance labels of the images as bit packed bytes, as they are loaded from a label store
+    :return: uint8 array with the instance labels, with shape (images, 16, 16)
+    """
+    packed_labels = np.frombuffer(b''.join(label_col), dtype=np.uint8).reshape(len(label_col), -1)
+    return np.unpackbits(packed_labels, axis=1).reshape(-1, 16, 16)
+
+
+def parse_loaded_labels(label_col):
+    """
+    Parses the instance labels of all images at once. Most images share the same labels (all patches negative or all
+    positive), so each distinct label string is parsed only once. Bit packed labels from a label store are only
+    unpacked.
+    :param label_col: instance labels of the images as strings of 16x16 matrices, or as bit packed bytes
+    :return: uint8 array with the instance labels, with shape (images, 16, 16)
+    """
+    label_col = np.asarray(label_col, dtype=object)
+    if len(label_col) > 0 and isinstance(label_col[0], bytes):
+        return unpack_loaded_labels(label_col)
+    unique_labels, label_rows = np.unique(label_col.astype(str), return_inverse=True)
+    if len(unique_labels) == 0:
+        return np.zeros((0, 16, 16), dtype=np.uint8)
+    parsed_labels = np.stack([process_loaded_labels(labels) for labels in unique_labels]).astype(np.uint8)
+    return parsed_labels[label_rows.reshape(-1)]
+
+
 def plot_train_validation(train_curve, val_curve, train_label, val_label,
                           title, y_axis, out_dir):
     plt.ioff()
@@ -255,14 +287,9 @@ def get_image_index_from_pathstring(string_path):
 # The function is redundant and can be more efficient
 # it is uses same code as in the generator - so it is a test that everything works adequately
 def prepare_labels_all_classes(instance, processed_y):
-    instances_classes =[]
-    for i in range(1, instance.shape[0]):  # (15)
-        if processed_y:
-            g = process_loaded_labels(instance[i])
-            instances_classes.append(g)
-        else:
-            instances_classes.append(instance[i])
-    return np.transpose(np.asarray(instances_classes), [1, 2, 0])
+    if processed_y:
+        return np.transpose(parse_loaded_labels(instance[1:]), [1, 2, 0])
+    return np.transpose(np.asarray(list(instance[1:])), [1, 2, 0])
 
 
 def visualize_single_image_all_classes(batch_df, img_ind, results_path, batch_predictions, batch_img_prob,
@@ -1,5 +1,7 @@
 import tensorflow as tf
-from tensorflow.keras.losses import binary_crossentropy
+from tensorflow.keras.backend import binary_crossentropy
+
+from cnn.nn_architecture.pooling import compute_pooling, compute_segmentation_pooling, compute_pooling_as_training
 
 
 def compute_image_label_from_localization_NORM(nn_output, y_true, P, clas_nr):
@@ -14,23 +16,10 @@ def compute_image_label_from_localization_NORM(nn_output, y_true, P, clas_nr):
     :return:  A list of image predictions for each image based on the raw predictions. Aggregation from instance level
     predictions to bag level predictions for images with available segmentation. This is a supervised method only used
     in training, not in testing.
+    The product is computed as a sum of logarithms, see nor_pooling_segmentation() in pooling.py.
     """
-    pos_patches = tf.reshape((nn_output * y_true), (-1, P * P, clas_nr))
-    neg_patches = tf.reshape((1 - nn_output) * (1 - y_true), (-1, P * P, clas_nr))
-
-    normalized_pos = ((1 - 0.98) * pos_patches) + 0.98
-    normalized_neg = ((1 - 0.98) * neg_patches) + 0.98
-
-    # element wise multiplication is used as a boolean mask to separate active from inactive patches
-    # due to the normalization the inactive patches are also converted t0 0.98
-    # so with multiplication - we revert them to 0
-    norm_pos_patches = normalized_pos*tf.reshape(y_true, (-1, P * P, clas_nr))
-    norm_neg_patches = normalized_neg*tf.reshape((1 - y_true), (-1, P * P, clas_nr))
-
-    Pi_pos_patches = tf.reduce_prod(tf.where(norm_pos_patches>0.0, norm_pos_patches, tf.fill(tf.shape(norm_pos_patches),1.0)), axis=1)
-    Pi_neg_patches = tf.reduce_prod(tf.where(norm_neg_patches>0.0, norm_neg_patches, tf.fill(tf.shape(norm_neg_patches),1.0)), axis=1)
-
-    return tf.multiply(Pi_pos_patches, Pi_neg_patches)
+    return compute_segmentation_pooling('nor', tf.reshape(nn_output, (-1, P * P, clas_nr)),
+                                        tf.reshape(y_true, (-1, P * P, clas_nr)), backend='tensorflow')
 
 
 def compute_image_label_in_classification_NORM(nn_output, P, clas_nr):
@@ -43,13 +32,9 @@ def compute_image_label_in_classification_NORM(nn_output, P, clas_nr):
     :param clas_nr: number of prediciton classes
     :return: A list of image predictions for each image based on the raw predictions. Aggregation from instanse level
     predictions to bag level predictions
+    The product is computed as a sum of logarithms, see nor_pooling() in pooling.py.
     """
-    subtracted_prob = 1 - nn_output
-    flat_mat = tf.reshape(subtracted_prob, (-1, P * P, clas_nr))
-
-    normalized_mat = ((1 - 0.98) * flat_mat) + 0.98
-    element_product = tf.reduce_prod(normalized_mat, axis=1)
-    return tf.cast(1, tf.float32) - element_product
+    return compute_pooling('nor', tf.reshape(nn_output, (-1, P * P, clas_nr)), backend='tensorflow')
 
 
 def compute_image_label_prediction(has_bbox, nn_output_class, y_true_class, P, class_nr):
@@ -85,80 +70,13 @@ def compute_ground_truth(instance_labels_gt, m, class_nr):
     return sum_active_patches, class_label_ground_truth, has_bbox
 
 
-def mean_pooling_segmentation_images(nn_output, y_true, P, clas_nr):
-    pos_patches = tf.reshape((nn_output * y_true), (-1, P * P, clas_nr))
-    neg_patches = tf.reshape((1 - nn_output) * (1 - y_true), (-1, P * P, clas_nr))
-    mean = tf.reduce_mean(pos_patches +neg_patches, axis=1)
-
-    sum_pos_patches = tf.reduce_sum(tf.where(pos_patches>0.0, pos_patches, tf.fill(tf.shape(pos_patches),0.0)), axis=1,
-                                    keepdims=True)
-    sum_neg_patches = tf.reduce_sum(tf.where(neg_patches > 0.0, neg_patches, tf.fill(tf.shape(neg_patches), 0.0)),
-                                    axis=1, keepdims=True)
-    sum_total = tf.add(sum_neg_patches, sum_pos_patches)
-    mean2 = tf.reduce_sum(tf.multiply((1/(P*P)), sum_total), axis=1)
-    return mean
-
-
-def mean_pooling_bag_level(nn_output):
-    return tf.reduce_mean(nn_output, axis=[1, 2])
-
-
-def lse_pooling_bag_level(nn_output, r =1):
-    mean = tf.reduce_mean(tf.exp(r*nn_output), axis=[1,2])
-    return (1/r)*(tf.math.log(mean))
-
-
-def max_pooling_bag_level(nn_output):
-    return tf.reduce_max(nn_output, axis=[1, 2])
-
-
-def lse_pooling_segmentation_images(nn_output, y_true, P, clas_nr, r =1):
-
-    pos_patch_labels_filter = tf.equal(y_true, 1.0)
-    neg_patch_labels_filter = tf.equal(y_true, 0.0)
-
-    pos_patches = r *(nn_output)
-    neg_patches = r * (1 - nn_output)
-
-    pos_patches_exp = tf.where(pos_patch_labels_filter, tf.exp(pos_patches),
-                               tf.fill(tf.shape(pos_patch_labels_filter),0.0))
-    neg_patches_exp = tf.where(neg_patch_labels_filter, tf.exp(neg_patches),
-                               tf.fill(tf.shape(pos_patch_labels_filter),0.0))
-    pos_neg_combined = pos_patches_exp+neg_patches_exp
-
-    mean3 = tf.reduce_mean(pos_neg_combined, axis=[1,2])
-    mean2 = tf.reduce_sum((1 / (P*P))* pos_neg_combined, axis=[1,2])
-    result2 = (1 / r) * tf.math.log(mean2)
-    result3 = tf.math.log(mean3)/r
-    return result2
-
-
-def max_pooling_segmentation_images(nn_output, y_true, P, clas_nr):
-    pos_patches = tf.reshape((nn_output * y_true), (-1, P * P, clas_nr))
-    max = tf.reduce_max(pos_patches, axis=1)
-    return max
-
-
 def compute_image_label_prediction_v2(has_bbox, nn_output_class, y_true_class, P, class_nr, pooling_operator, r):
-    assert pooling_operator in ['mean', 'nor', 'lse', 'max'], "ensure you have the right pooling method "
-
-    if pooling_operator.lower()=='nor':
-        prob = tf.where(has_bbox, compute_image_label_from_localization_NORM(nn_output_class, y_true_class, P, class_nr),
-                        compute_image_label_in_classification_NORM(nn_output_class, P, class_nr))
-    elif pooling_operator.lower()=='mean':
-        prob = tf.where(has_bbox,
-                        mean_pooling_segmentation_images(nn_output_class, y_true_class, P, class_nr),
-                        mean_pooling_bag_level(nn_output_class))
-    elif pooling_operator.lower()=='lse':
-        prob = tf.where(has_bbox,
-                        lse_pooling_segmentation_images(nn_output_class, y_true_class, P, class_nr),
-                        lse_pooling_bag_level(nn_output_class, r=r))
-    elif pooling_operator.lower()=='max':
-        prob = tf.where(has_bbox,
-                        max_pooling_segmentation_images(nn_output_class, y_true_class, P, class_nr),
-                        max_pooling_bag_level(nn_output_class))
-
-    return prob
+    """
+    Computes the image predictions as during training with any pooling operator registered in pooling.py
+    :param r: hyperparameter of the pooling operator, None: the default of the operator is used
+    """
+    return compute_pooling_as_training(pooling_operator, has_bbox, tf.reshape(nn_output_class, (-1, P * P, class_nr)),
+                                       tf.reshape(y_true_class, (-1, P * P, class_nr)), backend='tensorflow', r=r)
 
 
 def compute_loss_v3(nn_output, instance_label_ground_truth, P, class_nr, pool_method, r, bbox_weight):
@@ -170,7 +88,8 @@ def compute_loss_v3(nn_output, instance_label_ground_truth, P, class_nr, pool_me
     :param class_nr: number of classes
     :param pool_method: pooling method to derive image prediction
     :param bbox_weight: weight in loss for samples with localization annotation
-    :return: loss value
+    :return: loss value of each image, the mean of the losses of its classes. The loss of a class is weighted with
+    bbox_weight when the image has a segmentation of this class
     '''
     m = P * P
     sum_active_patches, class_label_ground_truth, has_bbox = compute_ground_truth(instance_label_ground_truth, m,
@@ -178,30 +97,43 @@ def compute_loss_v3(nn_output, instance_label_ground_truth, P, class_nr, pool_me
     img_label_pred = compute_image_label_prediction_v2(has_bbox, nn_output, instance_label_ground_truth, P, class_nr,
                                                        pool_method, r)
 
-    loss = tf.where(tf.reshape(has_bbox, (-1,)),
-                    bbox_weight * binary_crossentropy(class_label_ground_truth, img_label_pred),
-                    binary_crossentropy(class_label_ground_truth, img_label_pred))
-    return loss
+    class_loss = binary_crossentropy(class_label_ground_truth, img_label_pred)
+    loss = tf.where(has_bbox, bbox_weight * class_loss, class_loss)
+    return tf.reduce_mean(loss, axis=-1)
 
-# def keras_loss_v3(y_true, y_pred):
-#     return compute_loss_v3(y_pred, y_true, 16, 1, 'nor', r=1, bbox_weight=5)
-
-
-def keras_loss_v3_nor(y_true, y_pred):
-    return compute_loss_v3(y_pred, y_true, 16, 1, 'nor', r=1, bbox_weight=5)
-
-
-def keras_loss_v3_lse(y_true, y_pred):
-    return compute_loss_v3(y_pred, y_true, 16, 1, 'lse', r=1, bbox_weight=5)
 
+def make_keras_loss(pooling_operator, r=None, P=16, class_nr=1, bbox_weight=5):
+    """
+    Creates the keras loss function of a pooling operator. The function is named keras_loss_v3_<pooling operator>,
+    which is also the name under which keras saves it in the model files.
+    :param pooling_operator: name of a pooling operator registered in pooling.py
+    :param r: hyperparameter of the pooling operator, None: the default of the operator is used
+    :param class_nr: number of classes predicted by the model, one channel of the patch predictions per class
+    :return: loss function with arguments (y_true, y_pred)
+    """
+    def keras_loss(y_true, y_pred):
+        return compute_loss_v3(y_pred, y_true, P, class_nr, pooling_operator, r=r, bbox_weight=bbox_weight)
 
-def keras_loss_v3_lse01(y_true, y_pred):
-    return compute_loss_v3(y_pred, y_true, 16, 1, 'lse', r=0.1, bbox_weight=5)
+    keras_loss.__name__ = 'keras_loss_v3_' + pooling_operator.lower()
+    return keras_loss
 
 
-def keras_loss_v3_mean(y_true, y_pred):
-    return compute_loss_v3(y_pred, y_true, 16, 1, 'mean', r=1, bbox_weight=5)
+keras_loss_v3_nor = make_keras_loss('nor')
+keras_loss_v3_lse = make_keras_loss('lse')
+keras_loss_v3_lse01 = make_keras_loss('lse01')
+keras_loss_v3_mean = make_keras_loss('mean')
+keras_loss_v3_max = make_keras_loss('max')
+KERAS_LOSSES = {('nor', 1): keras_loss_v3_nor, ('lse', 1): keras_loss_v3_lse, ('lse01', 1): keras_loss_v3_lse01,
+                ('mean', 1): keras_loss_v3_mean, ('max', 1): keras_loss_v3_max}
 
 
-def keras_loss_v3_max(y_true, y_pred):
-    return compute_loss_v3(y_pred, y_true, 16, 1, 'max', r=1, bbox_weight=5)
+def get_keras_loss(pooling_operator, class_nr=1):
+    """
+    :param pooling_operator: name of a pooling operator registered in pooling.py
+    :param class_nr: number of classes predicted by the model
+    :return: the keras loss function of the pooling operator
+    """
+    loss_key = (pooling_operator.lower(), class_nr)
+    if loss_key not in KERAS_LOSSES:
+        KERAS_LOSSES[loss_key] = make_keras_loss(pooling_operator, class_nr=class_nr)
+    return KERAS_LOSSES[loss_key]
@@ -71,6 +71,23 @@ def keras_accuracy(y_true, y_pred):
     return compute_accuracy_keras(y_pred, y_true, P=16, iou_threshold=0.1, class_nr=1)
 
 
+def make_keras_accuracy(class_nr):
+    """
+    Creates keras_accuracy() for a model predicting class_nr classes. The metric has the same name, so the training
+    history and the saved models use the same keys for any number of classes.
+    :param class_nr: number of classes predicted by the model
+    :return: metric function with arguments (y_true, y_pred)
+    """
+    if class_nr == 1:
+        return keras_accuracy
+
+    def multi_class_keras_accuracy(y_true, y_pred):
+        return compute_accuracy_keras(y_pred, y_true, P=16, iou_threshold=0.1, class_nr=class_nr)
+
+    multi_class_keras_accuracy.__name__ = 'keras_accuracy'
+    return multi_class_keras_accuracy
+
+
 def compute_image_probability_asloss(nn_output, instance_label_ground_truth, P, class_nr):
     '''
     Computes image probability the same way it is computed in the loss
@@ -124,3 +141,19 @@ def accuracy_asloss(y_true, y_pred):
     class_label_ground_truth, img_label_pred = compute_image_probability_asloss(y_pred, y_true, 16, class_nr=1)
     return K.metrics.binary_accuracy(class_label_ground_truth, img_label_pred)
 
+
+def make_accuracy_asloss(class_nr):
+    """
+    Creates accuracy_asloss() for a model predicting class_nr classes, under the same metric name.
+    :param class_nr: number of classes predicted by the model
+    :return: metric function with arguments (y_true, y_pred)
+    """
+    if class_nr == 1:
+        return accuracy_asloss
+
+    def multi_class_accuracy_asloss(y_true, y_pred):
+        class_label_ground_truth, img_label_pred = compute_image_probability_asloss(y_pred, y_true, 16, class_nr)
+        return K.metrics.binary_accuracy(class_label_ground_truth, img_label_pred)
+
+    multi_class_accuracy_asloss.__name__ = 'accuracy_asloss'
+    return multi_class_accuracy_asloss
@@ -2,16 +2,76 @@
 inspired by https://github.com/neuralmed/learning_with_bbox
 """
 
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
 from tensorflow.keras.utils import Sequence
 from tensorflow.keras.preprocessing.image import load_img, img_to_array
-from cnn.preprocessor.load_data_mura import padding_needed, pad_image
-from cnn.keras_utils import process_loaded_labels, image_larger_input, calculate_scale_ratio
+from cnn.keras_utils import parse_loaded_labels
+from cnn.preprocessor.image_transform import transform_image
+from cnn.preprocessor.process_input import update_image_cache
+
+
+def decode_image(image_dir, resized_image, interpolation, net_h, net_w):
+    """
+    Reads an image and brings it to the input size of the network. The file is decoded only once.
+    The function is on module level, so it can be run in a process pool.
+    :param image_dir: path to the image
+    :param resized_image: True: the image is already resized and it is used as it is
+    :param interpolation: True: the image is resized to the input size. False: the image is decreased preserving its
+                        aspect ratio (if it is larger than the input) and padded to the input size
+    :param net_h: input height of the network
+    :param net_w: input width of the network
+    :return: the image as an array
+    """
+    if resized_image:
+        return img_to_array(load_img(image_dir, target_size=None, color_mode='rgb'))
+    return transform_image(image_dir, net_h, net_w, interpolation)
+
+
+def parse_instance_labels(instances):
+    """
+    Parses the patch labels of all label columns (after 'Dir Path') of the instances.
+    :param instances: array with the image path in the first column and a column of patch labels for each class
+    :return: uint8 array with shape (images, 16, 16, label columns)
+    """
+    return np.stack([parse_loaded_labels(instances[:, class_index]) for class_index in range(1, instances.shape[1])],
+                    axis=-1)
+
+
+def get_decoding_options(config):
+    """
+    Reads the optional settings for decoding images in BatchGenerator from the config file.
+    :param config: yaml config file
+    :return: keyword arguments for BatchGenerator
+    """
+    return {'decode_workers': config.get('decode_workers', 0),
+            'decode_processes': config.get('decode_processes', False),
+            'prefetch_batches': config.get('prefetch_batches', 0),
+            'image_cache_dir': config.get('image_cache_dir', None),
+            'batch_buffers': config.get('batch_buffers', 0)}
 
 
 class BatchGenerator(Sequence):
     def __init__(self, instances, resized_image, batch_size=16, shuffle=True,
-                 norm=None, net_h=512, net_w=512, box_size=16, processed_y = None, interpolation=True):
+                 norm=None, net_h=512, net_w=512, box_size=16, processed_y = None, interpolation=True,
+                 decode_workers=0, decode_processes=False, prefetch_batches=0, image_cache_dir=None,
+                 batch_buffers=0):
+        """
+        :param decode_workers: number of workers decoding the images of a batch in parallel. 0: the images are decoded
+                                one after another when the batch is requested
+        :param decode_processes: True: the workers are processes, False: the workers are threads
+        :param prefetch_batches: number of next batches decoded in the background while the current batch is used.
+                                Used only with decode_workers > 0. The batches have to be requested in order, e.g.
+                                fit_generator(..., shuffle=False), the instances are reshuffled in on_epoch_end
+        :param image_cache_dir: optional - directory of a memory mapped uint8 cache with the preprocessed images. Images
+                                missing from the cache are preprocessed once when the generator is created, batches are
+                                then sliced from the cache instead of decoding the image files
+        :param batch_buffers: number of preallocated float32 batch arrays that are reused in turn. It has to be larger
+                                than the number of batches keras keeps queued (max_queue_size + workers of fit), as a
+                                buffer is overwritten when its turn comes again. 0: new arrays are allocated for each batch
+        """
 
         self.instances = instances
         self.batch_size = batch_size
@@ -23,15 +83,45 @@ class BatchGenerator(Sequence):
         self.processed_y = processed_y
         self.interpolation = interpolation
         self.resized_image = resized_image
-
-        if shuffle: np.random.shuffle(self.instances)
+        self.decode_workers = decode_workers
+        self.decode_processes = decode_processes
+        self.prefetch_batches = prefetch_batches
+        self._executor = None
+        self._prefetched_batches = {}
+        self._prefetch_lock = threading.Lock()
+        self._cached_images = None
+        self._image_rows = None
+        self.batch_buffers = batch_buffers
+        self._batch_arrays = [None] * batch_buffers
+        self._next_batch_array = 0
+        self._batch_arrays_lock = threading.Lock()
+        if image_cache_dir is not None:
+            self._cached_images, self._image_rows = update_image_cache(
+                [instance[0] for instance in self.instances], image_cache_dir, net_h, net_w, interpolation,
+                resized_image)
+
+        # one channel of patch labels for each label column after 'Dir Path', e.g. the 14 findings of xray
+        self.class_nr = max(1, self.instances.shape[1] - 1)
+        # the instance labels are parsed once, and are kept in the order of the instances
+        self._instance_labels = None
+        if processed_y:
+            self._instance_labels = parse_instance_labels(self.instances)
+
+        if shuffle: self._shuffle_instances()
+
+    def _shuffle_instances(self):
+        # same permutation as np.random.shuffle(self.instances), applied also to the parsed labels
+        order = np.arange(len(self.instances))
+        np.random.shuffle(order)
+        self.instances[:] = self.instances[order]
+        if self._instance_labels is not None:
+            self._instance_labels = self._instance_labels[order]
 
     def __len__(self):
         # return int(np.ceil(float(len(self.instances)) / self.batch_size))
         return int(np.floor(float(len(self.instances)) / self.batch_size))
 
-    def __getitem__(self, idx):
-
+    def _get_batch_bounds(self, idx):
         # determine the first and the last indices of the batch
         l_bound = idx * self.batch_size
         r_bound = (idx + 1) * self.batch_size
@@ -39,67 +129,108 @@ class BatchGenerator(Sequence):
         if r_bound > len(self.instances):
             r_bound = len(self.instances)
             l_bound = r_bound - self.batch_size
+        return l_bound, r_bound
+
+    def _decode_image(self, image_dir):
+        return decode_image(image_dir, self.resized_image, self.interpolation, self.net_h, self.net_w)
+
+    def _submit_batch(self, idx):
+        l_bound, r_bound = self._get_batch_bounds(idx)
+        return [self._executor.submit(decode_image, train_instance[0], self.resized_image, self.interpolation,
+                                      self.net_h, self.net_w)
+                for train_instance in self.instances[l_bound:r_bound]]
+
+    def _decode_batch(self, idx):
+        """
+        Decodes the images of a batch. With workers, the images are decoded in parallel and the next batches are
+        submitted for decoding, so they are ready when requested.
+        """
+        if self._cached_images is not None:
+            l_bound, r_bound = self._get_batch_bounds(idx)
+            cache_rows = [self._image_rows[train_instance[0]] for train_instance in self.instances[l_bound:r_bound]]
+            return self._cached_images[cache_rows].astype(np.float32)
+
+        if self.decode_workers <= 0:
+            l_bound, r_bound = self._get_batch_bounds(idx)
+            return [self._decode_image(train_instance[0]) for train_instance in self.instances[l_bound:r_bound]]
+
+        with self._prefetch_lock:
+            if self._executor is None:
+                pool_executor = ProcessPoolExecutor if self.decode_processes else ThreadPoolExecutor
+                self._executor = pool_executor(max_workers=self.decode_workers)
+            image_futures = self._prefetched_batches.pop(idx, None)
+            if image_futures is None:
+                image_futures = self._submit_batch(idx)
+
+            batches_nr = self.__len__()
+            batches_to_prefetch = [next_idx % batches_nr
+                                   for next_idx in range(idx + 1, idx + 1 + self.prefetch_batches)] \
+                if batches_nr > 0 else []
+            # batches requested in a different order are not needed anymore
+            stale_batches = [stale_idx for stale_idx in self._prefetched_batches
+                             if stale_idx not in batches_to_prefetch]
+            for stale_idx in stale_batches:
+                for image_future in self._prefetched_batches.pop(stale_idx):
+                    image_future.cancel()
+            for next_idx in batches_to_prefetch:
+                if next_idx != idx and next_idx not in self._prefetched_batches:
+                    self._prefetched_batches[next_idx] = self._submit_batch(next_idx)
+        return [image_future.result() for image_future in image_futures]
+
+    def _get_batch_arrays(self, batch_rows):
+        x_shape = (batch_rows, self.net_w, self.net_h, 3)
+        y_shape = (batch_rows, self.box_size, self.box_size, self.class_nr)
+        if self.batch_buffers <= 0:
+            return np.zeros(x_shape, dtype=np.float32), np.zeros(y_shape, dtype=np.float32)
+
+        with self._batch_arrays_lock:
+            buffer_ind = self._next_batch_array
+            self._next_batch_array = (buffer_ind + 1) % self.batch_buffers
+            if self._batch_arrays[buffer_ind] is None or self._batch_arrays[buffer_ind][0].shape != x_shape:
+                # every row of the arrays is overwritten when the batch is filled
+                self._batch_arrays[buffer_ind] = (np.empty(x_shape, dtype=np.float32),
+                                                  np.empty(y_shape, dtype=np.float32))
+            return self._batch_arrays[buffer_ind]
 
-        x_batch = np.zeros((r_bound - l_bound, self.net_w, self.net_h, 3))  # input images
-        y_batch = np.zeros((r_bound - l_bound, self.box_size, self.box_size, 14))
-        y_batch = np.zeros((r_bound - l_bound, self.box_size, self.box_size, 1))
+    def __getitem__(self, idx):
 
-        instance_count = 0
-        # do the logic to fill in the inputs and the output
-        for train_instance in self.instances[l_bound:r_bound]:
-            image_dir = train_instance[0]
-            image = load_img(image_dir, target_size=None, color_mode='rgb')
-            img_width, img_height = image.size
-            decrease_needed = image_larger_input(img_width, img_height, self.net_w, self.net_h)
-            image = img_to_array(image)
-
-            if not self.resized_image:
-                if self.interpolation:
-                    #### NEAREST INTERPOLATION
-                    image = img_to_array(
-                        load_img(image_dir, target_size=(self.net_h, self.net_w), color_mode='rgb'))
-                else:
-                    # IF one or both sides have bigger size than the input, then decrease is needed
-                    if decrease_needed:
-                        ratio = calculate_scale_ratio(img_width, img_height, self.net_w, self.net_h)
-                        assert ratio >= 1.00, "wrong ratio - it will increase image size"
-                        assert int(img_height/ratio) == self.net_h or int(img_width/ratio) == self.net_w, \
-                            "error in computation"
-                        image = img_to_array(load_img(image_dir, target_size=(int(img_height/ratio), int(img_width/ratio)),
-                                                      color_mode='rgb'))
-                    else:
-                        #ELSE just open image in its original form
-                        image = img_to_array(load_img(image_dir, target_size=None, color_mode='rgb'))
-                    ### PADDING
-                    pad_needed = padding_needed(image)
-
-                    if pad_needed:
-                        image = pad_image(image, final_size_x=self.net_w, final_size_y=self.net_h)
+        l_bound, r_bound = self._get_batch_bounds(idx)
 
+        x_batch, y_batch = self._get_batch_arrays(r_bound - l_bound)  # input images and patch labels
+
+        batch_images = self._decode_batch(idx)
+        # do the logic to fill in the inputs and the output
+        for instance_count, image in enumerate(batch_images):
             if self.norm != None:
                 x_batch[instance_count] = self.norm(image)
             else:
                 x_batch[instance_count] = image
 
-            train_instances_classes = []
-
-            if self.processed_y is not None:
-
-                for class_index in range(1, train_instance.shape[0]):  # (15)
-                    assert self.processed_y==True, "Error, I do not know how to handle the processing of labels"
-                    if self.processed_y:
-                        class_labels = process_loaded_labels(train_instance[class_index])
-                        train_instances_classes.append(class_labels)
-
-                y_batch[instance_count] = np.transpose(np.asarray(train_instances_classes), [1, 2, 0])
-            else:
-                y_batch[instance_count]= None
-
-            instance_count += 1
+        if self.processed_y is not None:
+            assert self.processed_y==True, "Error, I do not know how to handle the processing of labels"
+            y_batch[:] = self._instance_labels[l_bound:r_bound]
+        else:
+            y_batch[:] = None
         return x_batch, y_batch
 
     def on_epoch_end(self):
-        if self.shuffle: np.random.shuffle(self.instances)
+        if self.shuffle:
+            with self._prefetch_lock:
+                # the prefetched batches are from the previous order of the instances
+                for image_futures in self._prefetched_batches.values():
+                    for image_future in image_futures:
+                        image_future.cancel()
+                self._prefetched_batches = {}
+                self._shuffle_instances()
+
+    def close(self):
+        """
+        Stops the workers decoding the images.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self._prefetched_batches = {}
 
     def num_classes(self):
         return len(self.labels)
@@ -114,12 +245,5 @@ class BatchGenerator(Sequence):
         return image
 
     def get_batch_image_indices(self, idx):
-        # determine the first and the last indices of the batch
-        l_bound = idx * self.batch_size
-        r_bound = (idx + 1) * self.batch_size
-
-        if r_bound > len(self.instances):
-            r_bound = len(self.instances)
-            l_bound = r_bound - self.batch_size
-
+        l_bound, r_bound = self._get_batch_bounds(idx)
         return self.instances[l_bound:r_bound][:, 0]
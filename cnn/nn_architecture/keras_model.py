@@ -1,15 +1,21 @@
+import tensorflow as tf
 from tensorflow.keras import regularizers
 from tensorflow.keras.applications import ResNet50
 from tensorflow.keras.layers import MaxPooling2D, Conv2D, BatchNormalization
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 
-from cnn.nn_architecture.custom_loss import keras_loss_v3_nor, keras_loss_v3_mean, \
-    keras_loss_v3_lse, keras_loss_v3_lse01, keras_loss_v3_max
-from cnn.nn_architecture.custom_performance_metrics import keras_accuracy, accuracy_asloss
+from cnn.nn_architecture.custom_loss import get_keras_loss
+from cnn.nn_architecture.custom_performance_metrics import make_keras_accuracy, make_accuracy_asloss
 
 
-def build_model(reg_weight):
+def build_model(reg_weight, class_nr=1):
+    '''
+    :param reg_weight: weight of the l2 regularization of the recognition layer
+    :param class_nr: number of predicted classes. The backbone is shared, and the last layer predicts a channel for each
+                    class on every patch
+    :return: the model
+    '''
     base_model = ResNet50(weights='imagenet', include_top=False, input_shape=(512, 512, 3))
     ## freezing layers
     #for layer in base_model.layers:
@@ -30,7 +36,7 @@ def build_model(reg_weight):
 
     recg_net = Conv2D(512, kernel_size=(3,3), padding='same', activation='relu', activity_regularizer=regularizers.l2(reg_weight))(downsamp)
     recg_net = BatchNormalization()(recg_net)
-    recg_net = Conv2D(1, (1,1), padding='same', activation='sigmoid')(recg_net)
+    recg_net = Conv2D(class_nr, (1,1), padding='same', activation='sigmoid')(recg_net)
     model = Model(base_model.input, recg_net)
     
     return model
@@ -55,16 +61,34 @@ def dynamic_lr(epoch):
     return 1e-6 * 10 **(epoch/20)
 
 
-def compile_model_accuracy(model, lr, pool_op):
-    loss_f ={'nor': keras_loss_v3_nor,
-            'mean': keras_loss_v3_mean,
-             'lse': keras_loss_v3_lse,
-             'lse01': keras_loss_v3_lse01,
-             'max': keras_loss_v3_max
-     }
+def set_jit_compile(jit_compile):
+    """
+    Turns the XLA compilation of the graphs built afterwards (training, evaluation and prediction) on or off. XLA
+    clusters the many small operations of the backbone, the pooling and the loss into a few fused kernels.
+    :param jit_compile: True: XLA compilation, False: the graphs run op by op
+    """
+    tf.config.optimizer.set_jit(jit_compile)
+
+
+def compile_model_accuracy(model, lr, pool_op, class_nr=1, mixed_precision=False):
+    """
+    :param mixed_precision: True: the training graph computes in float16 where it is safe, and the loss is scaled to
+                            avoid float16 underflow of the gradients. The weights stay float32
+    """
     optimizer = Adam(lr=lr)
+    if mixed_precision:
+        # the graph rewrite changes only GPU kernels, on CPU the model runs in float32
+        optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
     model.compile(optimizer=optimizer,
-                  loss=loss_f[pool_op],
-                  metrics=[keras_accuracy, accuracy_asloss])
+                  loss=get_keras_loss(pool_op, class_nr),
+                  metrics=[make_keras_accuracy(class_nr), make_accuracy_asloss(class_nr)])
     return model
 
+
+def get_fast_training_options(config):
+    """
+    Reads the optional settings of the fast training mode from the config file.
+    :param config: yaml config file
+    :return: True/False for mixed precision and for XLA compilation
+    """
+    return config.get('mixed_precision', False), config.get('jit_compile', False)
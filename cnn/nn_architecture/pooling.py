@@ -0,0 +1,170 @@
+"""
+Pooling operators converting patch (instance) predictions to image (bag) predictions.
+Each operator is defined once on top of a small set of array operations, and it is run either with tensorflow (loss and
+metrics during training) or with numpy (offline evaluation of saved predictions).
+All operators work on patches flattened to shape (images, patches, classes) and reduce the patch axis, so the result
+has shape (images, classes).
+"""
+import numpy as np
+
+# NOR pooling normalizes the probabilities of the patches to [0.98, 1], the factor of a patch is 1 - 0.02*p
+NOR_NORMALIZATION_RANGE = 1 - 0.98
+
+POOLING_OPERATORS = {}
+
+
+def _numpy_mean_top_k(patches, k):
+    return np.mean(-np.partition(-patches, k - 1, axis=1)[:, :k], axis=1)
+
+
+def _get_numpy_ops():
+    return {'sum': np.sum, 'mean': np.mean, 'max': np.max, 'exp': np.exp, 'log': np.log, 'log1p': np.log1p,
+            'expm1': np.expm1, 'where': np.where, 'minimum': np.minimum, 'maximum': np.maximum,
+            'mean_top_k': _numpy_mean_top_k}
+
+
+def _get_tensorflow_ops():
+    import tensorflow as tf
+
+    def mean_top_k(patches, k):
+        return tf.reduce_mean(tf.math.top_k(tf.transpose(patches, [0, 2, 1]), k=k).values, axis=2)
+
+    return {'sum': tf.reduce_sum, 'mean': tf.reduce_mean, 'max': tf.reduce_max, 'exp': tf.exp, 'log': tf.math.log,
+            'log1p': tf.math.log1p, 'expm1': tf.math.expm1, 'where': tf.where, 'minimum': tf.minimum,
+            'maximum': tf.maximum, 'mean_top_k': mean_top_k}
+
+
+def get_pooling_ops(backend):
+    assert backend in ('numpy', 'tensorflow'), "Pooling operators run only with numpy or tensorflow"
+    return _get_numpy_ops() if backend == 'numpy' else _get_tensorflow_ops()
+
+
+def _patch_errors(patch_predictions, patch_labels):
+    # 1-p on positive patches and p on negative patches
+    return patch_labels * (1 - patch_predictions) + (1 - patch_labels) * patch_predictions
+
+
+def nor_pooling(ops, patch_predictions, r):
+    """
+    Eq. (2) in https://arxiv.org/pdf/1711.06373.pdf with (1-p) normalized to [0.98, 1]. The product is computed as a sum
+    of logarithms, and 1 - product with expm1, which stays accurate when the product is close to 1.
+    """
+    return -ops['expm1'](ops['sum'](ops['log1p'](-NOR_NORMALIZATION_RANGE * patch_predictions), axis=1))
+
+
+def nor_pooling_segmentation(ops, patch_predictions, patch_labels, r):
+    """
+    Eq. (1) in https://arxiv.org/pdf/1711.06373.pdf with the factors normalized to [0.98, 1]. A positive patch
+    contributes 0.98 + 0.02*p = 1 - 0.02*(1-p), a negative patch 0.98 + 0.02*(1-p) = 1 - 0.02*p.
+    """
+    patch_errors = _patch_errors(patch_predictions, patch_labels)
+    return ops['exp'](ops['sum'](ops['log1p'](-NOR_NORMALIZATION_RANGE * patch_errors), axis=1))
+
+
+def mean_pooling(ops, patch_predictions, r):
+    return ops['mean'](patch_predictions, axis=1)
+
+
+def mean_pooling_segmentation(ops, patch_predictions, patch_labels, r):
+    return ops['mean'](1 - _patch_errors(patch_predictions, patch_labels), axis=1)
+
+
+def lse_pooling(ops, patch_predictions, r):
+    return ops['log'](ops['mean'](ops['exp'](r * patch_predictions), axis=1)) / r
+
+
+def lse_pooling_segmentation(ops, patch_predictions, patch_labels, r):
+    return ops['log'](ops['mean'](ops['exp'](r * (1 - _patch_errors(patch_predictions, patch_labels))), axis=1)) / r
+
+
+def max_pooling(ops, patch_predictions, r):
+    return ops['max'](patch_predictions, axis=1)
+
+
+def max_pooling_segmentation(ops, patch_predictions, patch_labels, r):
+    return ops['max'](patch_predictions * patch_labels, axis=1)
+
+
+def _top_k_patches(patch_predictions, ratio):
+    return max(1, int(np.ceil(ratio * int(patch_predictions.shape[1]))))
+
+
+def top_k_pooling(ops, patch_predictions, r):
+    """
+    Mean of the highest predictions, r is the ratio of patches used. It goes from max pooling (one patch) to mean
+    pooling (all patches).
+    """
+    return ops['mean_top_k'](patch_predictions, _top_k_patches(patch_predictions, r))
+
+
+def top_k_pooling_segmentation(ops, patch_predictions, patch_labels, r):
+    """
+    Mean of the highest predictions of the positive patches. Images with less than k positive patches average all
+    their positive patches, so the masked negative patches do not decrease the prediction.
+    """
+    k = _top_k_patches(patch_predictions, r)
+    # the masked negative patches are 0, so the top k contains the positive patches first
+    top_k_sum = ops['mean_top_k'](patch_predictions * patch_labels, k) * k
+    positive_patches = ops['minimum'](ops['sum'](patch_labels, axis=1), k)
+    return top_k_sum / ops['maximum'](positive_patches, 1)
+
+
+def register_pooling_operator(name, pooling, segmentation_pooling, r=None):
+    """
+    Adds a pooling operator, which can then be used by its name in the config file ('pooling_operator').
+    :param name: name of the operator
+    :param pooling: function(ops, patch_predictions, r) computing the image prediction from the patch predictions only
+    :param segmentation_pooling: function(ops, patch_predictions, patch_labels, r) computing the image prediction of
+                                images with segmentation during training
+    :param r: default hyperparameter of the operator
+    """
+    POOLING_OPERATORS[name.lower()] = {'pooling': pooling, 'segmentation_pooling': segmentation_pooling, 'r': r}
+
+
+def get_pooling_operator(name):
+    assert name.lower() in POOLING_OPERATORS, "ensure you have the right pooling method "
+    return POOLING_OPERATORS[name.lower()]
+
+
+def get_pooling_r(name, r=None):
+    return get_pooling_operator(name)['r'] if r is None else r
+
+
+def compute_pooling(name, patch_predictions, backend='numpy', r=None):
+    """
+    Computes the image predictions from the patch predictions, as in testing/production.
+    :param name: name of the pooling operator
+    :param patch_predictions: patch predictions with shape (images, patches, classes)
+    :param backend: 'numpy' or 'tensorflow'
+    :param r: hyperparameter of the operator. None: the default of the operator is used
+    :return: image predictions with shape (images, classes)
+    """
+    return get_pooling_operator(name)['pooling'](get_pooling_ops(backend), patch_predictions, get_pooling_r(name, r))
+
+
+def compute_segmentation_pooling(name, patch_predictions, patch_labels, backend='numpy', r=None):
+    """
+    Computes the image predictions of images with segmentation, supervised by the patch labels as during training.
+    """
+    return get_pooling_operator(name)['segmentation_pooling'](get_pooling_ops(backend), patch_predictions,
+                                                              patch_labels, get_pooling_r(name, r))
+
+
+def compute_pooling_as_training(name, has_bbox, patch_predictions, patch_labels, backend='numpy', r=None):
+    """
+    Computes the image predictions as during training: images with segmentation are pooled supervised by their patch
+    labels, the other images only from their patch predictions.
+    :param has_bbox: flag of images with segmentation, with shape (images, classes)
+    """
+    return get_pooling_ops(backend)['where'](has_bbox,
+                                             compute_segmentation_pooling(name, patch_predictions, patch_labels,
+                                                                          backend, r),
+                                             compute_pooling(name, patch_predictions, backend, r))
+
+
+register_pooling_operator('nor', nor_pooling, nor_pooling_segmentation)
+register_pooling_operator('mean', mean_pooling, mean_pooling_segmentation)
+register_pooling_operator('lse', lse_pooling, lse_pooling_segmentation, r=1.0)
+register_pooling_operator('lse01', lse_pooling, lse_pooling_segmentation, r=0.1)
+register_pooling_operator('max', max_pooling, max_pooling_segmentation)
+register_pooling_operator('topk', top_k_pooling, top_k_pooling_segmentation, r=0.1)
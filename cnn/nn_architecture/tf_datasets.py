@@ -0,0 +1,151 @@
+"""
+tf.data input pipeline, an alternative to BatchGenerator in keras_generators.py. It reads the same instances
+('Dir Path' and the label columns) and gives the same batches, and it can be passed directly to model.fit().
+The images are decoded with tensorflow operations by parallel map calls, and the next batches are prepared while the
+model trains on the current batch.
+"""
+import numpy as np
+import tensorflow as tf
+
+from cnn.nn_architecture.keras_generators import parse_instance_labels
+from cnn.preprocessor.process_input import update_image_cache
+
+
+def get_dataset_options(config):
+    """
+    Reads the optional settings of the tf.data pipeline from the config file.
+    :param config: yaml config file
+    :return: keyword arguments for build_dataset()
+    """
+    return {'image_cache_dir': config.get('image_cache_dir', None),
+            'shuffle_seed': config.get('tf_data_shuffle_seed', 1)}
+
+
+def get_instance_labels(instances, box_size, processed_y):
+    """
+    :return: the patch labels of the instances as in BatchGenerator, with shape (images, box_size, box_size, label
+            columns). Without processed labels the labels are nan
+    """
+    if not processed_y:
+        return np.full((len(instances), box_size, box_size, max(1, instances.shape[1] - 1)), np.nan, dtype=np.float32)
+    return parse_instance_labels(instances)
+
+
+def get_dataset_steps(instances, batch_size):
+    # only full batches are used, as in BatchGenerator
+    return len(instances) // batch_size
+
+
+def get_resized_size_tensors(image_height, image_width, net_h, net_w, interpolation):
+    """
+    Same size as get_resized_size() in image_transform.py, computed on the image shape tensors.
+    :return: height and width of the resized image
+    """
+    if interpolation:
+        return tf.constant(net_h), tf.constant(net_w)
+    height, width = tf.cast(image_height, tf.float64), tf.cast(image_width, tf.float64)
+    ratio = tf.where(width >= height, width / net_w, height / net_h)
+    # only images larger than the input are decreased
+    larger_input = tf.logical_or(image_width > net_w, image_height > net_h)
+    return tf.where(larger_input, tf.cast(height / ratio, tf.int32), image_height), \
+        tf.where(larger_input, tf.cast(width / ratio, tf.int32), image_width)
+
+
+def get_nearest_indices(size, target_size):
+    """
+    Source rows (or columns) of nearest neighbour resizing with the sampling of PIL used by load_img(): the centers of
+    the target pixels are accumulated in float64. tf.image.resize picks a neighbouring row for some scales.
+    """
+    scale = tf.cast(size, tf.float64) / tf.cast(target_size, tf.float64)
+    centers = tf.math.cumsum(tf.concat([[scale / 2], tf.fill([target_size - 1], scale)], axis=0))
+    return tf.minimum(tf.cast(tf.floor(centers), tf.int32), size - 1)
+
+
+def decode_image_tensor(image_path, resized_image, interpolation, net_h, net_w):
+    """
+    Reads an image and brings it to the input size of the network as decode_image() in keras_generators.py, with
+    tensorflow operations: nearest neighbour resizing, and padding in the middle of the input (letterboxing).
+    :return: uint8 tensor with shape (net_h, net_w, 3)
+    """
+    image = tf.image.decode_image(tf.io.read_file(image_path), channels=3, expand_animations=False)
+    if not resized_image:
+        image_shape = tf.shape(image)
+        target_height, target_width = get_resized_size_tensors(image_shape[0], image_shape[1], net_h, net_w,
+                                                               interpolation)
+        image = tf.gather(image, get_nearest_indices(image_shape[0], target_height), axis=0)
+        image = tf.gather(image, get_nearest_indices(image_shape[1], target_width), axis=1)
+        # when the padding is odd, the extra pixel goes on the top and on the left
+        image = tf.image.pad_to_bounding_box(image, (net_h - target_height + 1) // 2, (net_w - target_width + 1) // 2,
+                                             net_h, net_w)
+    image.set_shape((net_h, net_w, 3))
+    return image
+
+
+def build_dataset(instances, resized_image, batch_size=16, shuffle=True, norm=None, net_h=512, net_w=512,
+                  box_size=16, processed_y=None, interpolation=True, image_cache_dir=None, shuffle_seed=1,
+                  num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    """
+    Builds a tf.data dataset giving the batches of input images and patch labels. The dataset repeats, so
+    model.fit() needs steps_per_epoch (and validation_steps), see get_dataset_steps().
+    :param instances: array with the image path in the first column and a column of patch labels for each class
+    :param resized_image: True: the images are already resized and they are used as they are
+    :param shuffle: True: the order of the images changes every epoch. The orders are the same in each run with the
+                    same shuffle_seed
+    :param norm: optional - function normalizing the images, applied on batch tensors
+    :param processed_y: True: the labels are processed patch labels, None: there are no labels
+    :param interpolation: True: the image is resized to the input size. False: the image is decreased preserving its
+                        aspect ratio (if it is larger than the input) and padded to the input size
+    :param image_cache_dir: optional - directory of the memory mapped uint8 image cache of BatchGenerator. The batches
+                    are then sliced from the cache instead of decoding the image files
+    :param shuffle_seed: seed of the shuffling
+    :param num_parallel_calls: number of images decoded in parallel, by default tuned to the available cores
+    :return: the dataset. The batches have the same order as the instances when they are not shuffled
+    """
+    image_paths = np.asarray(instances[:, 0], dtype=str)
+    instance_labels = tf.constant(get_instance_labels(instances, box_size, processed_y))
+
+    # the row numbers of the instances are shuffled, so the whole set is shuffled without keeping images in a buffer
+    dataset = tf.data.Dataset.range(len(image_paths))
+    if shuffle:
+        dataset = dataset.shuffle(len(image_paths), seed=shuffle_seed, reshuffle_each_iteration=True)
+
+    if image_cache_dir is None:
+        path_tensor = tf.constant(image_paths)
+
+        def map_instance(row):
+            return decode_image_tensor(tf.gather(path_tensor, row), resized_image, interpolation, net_h, net_w), \
+                tf.gather(instance_labels, row)
+
+        dataset = dataset.map(map_instance, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+    else:
+        cached_images, image_rows = update_image_cache(list(image_paths), image_cache_dir, net_h, net_w,
+                                                       interpolation, resized_image)
+        cache_rows = np.array([image_rows[image_path] for image_path in image_paths])
+
+        def load_cached_batch(batch_rows):
+            # a batch is a single copy from the memory map, so the python call holds the GIL only briefly
+            return cached_images[cache_rows[batch_rows]]
+
+        def map_batch(batch_rows):
+            images = tf.numpy_function(load_cached_batch, [batch_rows], tf.uint8)
+            images.set_shape((batch_size, net_h, net_w, 3))
+            return images, tf.gather(instance_labels, batch_rows)
+
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+        dataset = dataset.map(map_batch, num_parallel_calls=num_parallel_calls)
+
+    def prepare_batch(images, labels):
+        images = tf.cast(images, tf.float32)
+        if norm is not None:
+            images = norm(images)
+        return images, tf.cast(labels, tf.float32)
+
+    dataset = dataset.map(prepare_batch, num_parallel_calls=num_parallel_calls)
+
+    options = tf.data.Options()
+    # the parallel decoding keeps the order of the images, so runs with the same seed are reproducible
+    options.experimental_deterministic = True
+    dataset = dataset.with_options(options)
+    # each repetition is a new epoch with its own order of the images
+    return dataset.repeat().prefetch(tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,148 @@
+import os
+import time
+
+import h5py
+import numpy as np
+
+# Names of the datasets in a prediction store. They are equal to the prefixes of the separate .npy files that were
+# saved per model before.
+PREDICTION_STORE_DATASETS = ('patch_labels', 'image_indices', 'predictions', 'image_labels', 'image_predictions',
+                             'bbox_present', 'dice')
+# number of images kept together in a compressed chunk
+STORE_CHUNK_ROWS = 64
+
+
+def get_prediction_store_path(res_path, file_unique_name):
+    return os.path.join(res_path, 'prediction_store_' + file_unique_name + '.h5')
+
+
+def prediction_store_exists(res_path, file_unique_name):
+    return os.path.isfile(get_prediction_store_path(res_path, file_unique_name))
+
+
+def _prepare_values(values):
+    values = np.asarray(values)
+    assert values.ndim > 0, "Only arrays with one row per image can be stored"
+    if values.dtype.kind in ('U', 'S', 'O'):
+        # image indices are kept as variable length strings
+        return values.astype(str).astype(object), h5py.special_dtype(vlen=str)
+    return values, values.dtype
+
+
+def _create_dataset(store, name, values):
+    values, dtype = _prepare_values(values)
+    chunk_rows = max(1, min(STORE_CHUNK_ROWS, values.shape[0]))
+    dataset = store.create_dataset(name, data=values, dtype=dtype, chunks=(chunk_rows,) + values.shape[1:],
+                                   maxshape=(None,) + values.shape[1:], compression='gzip', shuffle=True)
+    dataset.attrs['saved_at'] = time.time()
+
+
+def _save_metadata(store, metadata):
+    if metadata is not None:
+        for key, value in metadata.items():
+            if value is not None:
+                store.attrs[key] = value
+
+
+def save_to_prediction_store(res_path, file_unique_name, metadata=None, overwrite=False, **datasets):
+    """
+    Saves arrays of a model run in its prediction store - a single compressed HDF5 file with a dataset for each array.
+    Datasets that are already in the store are replaced.
+    :param res_path: directory of the prediction store
+    :param file_unique_name: unique name of the model run and the set, e.g. test_set_CV1_0
+    :param metadata: optional dictionary with settings of the run (e.g. pooling operator, CV split, subset seed and
+                    overlap ratio), saved as attributes of the store
+    :param overwrite: True: a new store is created and the previous one is removed
+    :param datasets: the arrays to save, e.g. predictions=..., image_indices=...
+    """
+    with h5py.File(get_prediction_store_path(res_path, file_unique_name), 'w' if overwrite else 'a') as store:
+        _save_metadata(store, metadata)
+        for name, values in datasets.items():
+            if name in store:
+                del store[name]
+            _create_dataset(store, name, values)
+
+
+def append_to_prediction_store(res_path, file_unique_name, metadata=None, **datasets):
+    """
+    Appends rows (images) to datasets of a prediction store. Datasets that are not in the store yet are created.
+    :param res_path: directory of the prediction store
+    :param file_unique_name: unique name of the model run and the set
+    :param metadata: optional dictionary with settings of the run saved as attributes of the store
+    :param datasets: the rows to append, e.g. predictions=..., image_indices=...
+    """
+    with h5py.File(get_prediction_store_path(res_path, file_unique_name), 'a') as store:
+        _save_metadata(store, metadata)
+        for name, values in datasets.items():
+            if name not in store:
+                _create_dataset(store, name, values)
+            else:
+                values, _ = _prepare_values(values)
+                dataset = store[name]
+                assert dataset.shape[1:] == values.shape[1:], "Rows with a different shape can not be appended"
+                old_rows = dataset.shape[0]
+                dataset.resize(old_rows + values.shape[0], axis=0)
+                dataset[old_rows:] = values
+                dataset.attrs['saved_at'] = time.time()
+
+
+def _read_dataset(dataset, rows):
+    values = dataset[()] if rows is None else dataset[np.asarray(rows)]
+    if h5py.check_dtype(vlen=dataset.dtype) is not None:
+        return np.array([value.decode() if isinstance(value, bytes) else value for value in values], dtype=object)
+    return values
+
+
+def load_from_prediction_store(res_path, file_unique_name, dataset_names=PREDICTION_STORE_DATASETS, rows=None):
+    """
+    Loads datasets from the prediction store of a model run with a single file open.
+    :param res_path: directory of the prediction store
+    :param file_unique_name: unique name of the model run and the set
+    :param dataset_names: names of the datasets to load
+    :param rows: optional - indices of the images to load in increasing order. None: all images are loaded.
+    :return: a list with the arrays in the order of dataset_names
+    """
+    with h5py.File(get_prediction_store_path(res_path, file_unique_name), 'r') as store:
+        return [_read_dataset(store[name], rows) for name in dataset_names]
+
+
+def load_dataset_save_times(res_path, file_unique_name, dataset_names):
+    """
+    Finds when each dataset of a prediction store was last written, e.g. to check if data derived from other datasets
+    is out of date.
+    :param res_path: directory of the prediction store
+    :param file_unique_name: unique name of the model run and the set
+    :param dataset_names: names of the datasets
+    :return: a list with the time each dataset was saved, or None for datasets that are not in the store
+    """
+    with h5py.File(get_prediction_store_path(res_path, file_unique_name), 'r') as store:
+        return [store[name].attrs.get('saved_at', 0.0) if name in store else None for name in dataset_names]
+
+
+def load_prediction_store_metadata(res_path, file_unique_name):
+    with h5py.File(get_prediction_store_path(res_path, file_unique_name), 'r') as store:
+        return dict(store.attrs)
+
+
+def open_prediction_store(res_path, file_unique_name):
+    """
+    Opens the prediction store for reading. The datasets support random row access without loading the whole array,
+    e.g. store['predictions'][rows] with rows in increasing order. The caller should close the store.
+    :param res_path: directory of the prediction store
+    :param file_unique_name: unique name of the model run and the set
+    :return: the opened h5py.File
+    """
+    return h5py.File(get_prediction_store_path(res_path, file_unique_name), 'r')
+
+
+def load_numeric_npy(file_path):
+    """
+    Opens a numeric .npy file as a read-only memory map, so only the rows that are accessed (e.g. the images kept after
+    filtering) are read from disk. Arrays of python objects can not be memory mapped and are read in memory.
+    :param file_path: path of the .npy file
+    :return: the memory mapped array
+    """
+    try:
+        return np.load(file_path, mmap_mode='r')
+    except ValueError:
+        return np.load(file_path, allow_pickle=True)
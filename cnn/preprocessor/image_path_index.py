@@ -0,0 +1,31 @@
+import os
+
+import pandas as pd
+
+
+def build_image_path_index(path_to_images, index_file=None, extension='.png'):
+    """
+    Finds all images under a directory in a single walk, and maps each file name (image index) to its path.
+    If an image name is found more than once, the first path found is kept.
+    :param path_to_images: common parent directory of all images
+    :param index_file: optional - csv file where the index is saved. If the file exists, the index is loaded from it
+                        instead of walking the directory again
+    :param extension: extension of the image files
+    :return: dictionary from image index to image path
+    """
+    if index_file is not None and os.path.isfile(index_file):
+        index_df = pd.read_csv(index_file)
+        return dict(zip(index_df['Image Index'], index_df['Dir Path']))
+
+    path_index = {}
+    for dir_path, dir_names, file_names in os.walk(path_to_images):
+        # walk in a fixed order, so the same path is kept for repeated names
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if file_name.endswith(extension):
+                path_index.setdefault(file_name, os.path.join(dir_path, file_name))
+
+    if index_file is not None:
+        pd.DataFrame({'Image Index': list(path_index.keys()),
+                      'Dir Path': list(path_index.values())}).to_csv(index_file, index=False)
+    return path_index
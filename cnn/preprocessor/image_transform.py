@@ -0,0 +1,62 @@
+import math
+
+import numpy as np
+from PIL import Image
+from tensorflow.keras.preprocessing.image import load_img, img_to_array
+
+from cnn.keras_utils import image_larger_input, calculate_scale_ratio
+
+
+def get_resized_size(img_width, img_height, net_h, net_w, interpolation):
+    """
+    Computes the size of an image after it is brought to the input size of the network.
+    :param img_width: width of the original image
+    :param img_height: height of the original image
+    :param net_h: input height of the network
+    :param net_w: input width of the network
+    :param interpolation: True: the image is resized to the input size. False: the image is decreased preserving its
+                        aspect ratio (if it is larger than the input) and later padded to the input size
+    :return: width and height of the resized image
+    """
+    if interpolation:
+        return net_w, net_h
+    # IF one or both sides have bigger size than the input, then decrease is needed
+    if image_larger_input(img_width, img_height, net_w, net_h):
+        ratio = calculate_scale_ratio(img_width, img_height, net_w, net_h)
+        assert ratio >= 1.00, "wrong ratio - it will increase image size"
+        assert int(img_height / ratio) == net_h or int(img_width / ratio) == net_w, "error in computation"
+        return int(img_width / ratio), int(img_height / ratio)
+    return img_width, img_height
+
+
+def resize_loaded_image(image, target_height, target_width):
+    # same nearest neighbour resizing as load_img() with a target size, without decoding the file again
+    if image.size != (target_width, target_height):
+        return image.resize((target_width, target_height), Image.NEAREST)
+    return image
+
+
+def transform_image(image_dir, net_h, net_w, interpolation):
+    """
+    Reads an image and brings it to the input size of the network. The file is decoded only once, the image is
+    resized and then placed in the middle of a zero array of the input size (letterboxing). When the padding is odd,
+    the extra pixel goes on the top and on the left.
+    :param image_dir: path to the image
+    :param net_h: input height of the network
+    :param net_w: input width of the network
+    :param interpolation: True: the image is resized to the input size. False: the image is decreased preserving its
+                        aspect ratio (if it is larger than the input) and padded to the input size
+    :return: float32 array with shape (net_h, net_w, 3)
+    """
+    image = load_img(image_dir, target_size=None, color_mode='rgb')
+    target_width, target_height = get_resized_size(image.size[0], image.size[1], net_h, net_w, interpolation)
+    image = img_to_array(resize_loaded_image(image, target_height, target_width), dtype='float32')
+    if image.shape[:2] == (net_h, net_w):
+        return image
+
+    ### PADDING
+    transformed_image = np.zeros((net_h, net_w, 3), dtype=np.float32)
+    top = math.ceil((net_h - target_height) / 2)
+    left = math.ceil((net_w - target_width) / 2)
+    transformed_image[top:top + target_height, left:left + target_width] = image
+    return transformed_image
@@ -0,0 +1,175 @@
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from cnn.keras_utils import parse_loaded_labels
+
+# side of the label grid of an image - the number of patches on each axis
+LABEL_GRID_SIZE = 16
+# stores saved with another format version are created again from the csv
+LABEL_STORE_VERSION = 2
+
+
+def get_label_store_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.h5'
+
+
+def get_segmented_column_name(grid_column):
+    """
+    Name of the typed column flagging the images with a segmentation (bounding box) in a label grid column. An image
+    is segmented when its label grid has both positive and negative patches.
+    """
+    return grid_column + '_segmented'
+
+
+def pack_label_grids(label_col):
+    """
+    Parses label grids saved as strings of matrices and packs them to bits.
+    :param label_col: label grids of the images as strings, or already bit packed as bytes
+    :return: uint8 array with shape (images, LABEL_GRID_SIZE*LABEL_GRID_SIZE/8), and the number of positive patches of
+            each image
+    """
+    label_grids = parse_loaded_labels(label_col).reshape(len(label_col), -1)
+    return np.packbits(label_grids.astype(bool), axis=1), label_grids.sum(axis=1)
+
+
+def get_label_grid_cells(packed_grids):
+    """
+    Converts bit packed label grids to the cells of a dataframe column. The generators and parse_loaded_labels() unpack
+    the bytes directly. Each distinct grid is converted only once, and the images with the same grid share its bytes.
+    :param packed_grids: uint8 array with the bit packed grids of the images
+    :return: object array with the bit packed grid of each image as bytes
+    """
+    unique_grids, grid_rows = np.unique(packed_grids, axis=0, return_inverse=True)
+    grid_cells = np.empty(len(unique_grids), dtype=object)
+    grid_cells[:] = [grid.tobytes() for grid in unique_grids]
+    return grid_cells[grid_rows.reshape(-1)]
+
+
+def unpack_label_grids(packed_grids):
+    """
+    Converts bit packed label grids back to the strings of matrices used in the processed csv files. Each distinct
+    grid is converted only once.
+    :param packed_grids: uint8 array with the bit packed grids of the images
+    :return: array with the label grids of the images as strings
+    """
+    unique_grids, grid_rows = np.unique(packed_grids, axis=0, return_inverse=True)
+    grid_strings = np.array([str(grid.reshape(LABEL_GRID_SIZE, LABEL_GRID_SIZE).astype(float)).replace('\n', '')
+                             for grid in np.unpackbits(unique_grids, axis=1)], dtype=object)
+    return grid_strings[grid_rows.reshape(-1)]
+
+
+def is_label_grid_column(values):
+    return values.dtype.kind == 'O' and len(values) > 0 and isinstance(values[0], bytes)
+
+
+def format_label_grids(df):
+    """
+    Converts the bit packed label grids of a dataframe loaded from a label store back to strings of matrices, for
+    saving the dataframe in a csv file.
+    :param df: processed dataframe
+    :return: a copy of the dataframe with the label grids as strings
+    """
+    df = df.copy()
+    for column in df.columns:
+        values = df[column].values
+        if is_label_grid_column(values):
+            df[column] = unpack_label_grids(pack_label_grids(values)[0])
+    return df
+
+
+def save_label_store(df, store_path, grid_columns):
+    """
+    Saves a processed label dataframe in a columnar HDF5 file with a typed dataset per column. The label grid columns
+    are bit packed, and a flag for the segmented images is saved for each of them. The missing values of text columns
+    are flagged in a mask dataset of the 'missing' group.
+    :param df: processed dataframe, with the label grids as strings of matrices or as bit packed bytes
+    :param store_path: path of the label store
+    :param grid_columns: names of the columns with label grids
+    """
+    # the segmentation flags of a dataframe loaded from a label store are computed again from the grids
+    df = df.drop(columns=[get_segmented_column_name(column) for column in grid_columns], errors='ignore')
+    with h5py.File(store_path, 'w') as store:
+        store.attrs['version'] = LABEL_STORE_VERSION
+        # lists of str attributes need an explicit string type with h5py 2
+        store.attrs.create('columns', data=[str(column) for column in df.columns], dtype=h5py.special_dtype(vlen=str))
+        store.attrs.create('grid_columns', data=list(grid_columns), dtype=h5py.special_dtype(vlen=str))
+        if df.index.dtype.kind in 'iu':
+            store.create_dataset('index', data=df.index.values)
+        columns = store.create_group('columns')
+        for column in df.columns:
+            assert '/' not in str(column), "Column names with '/' can not be saved"
+            values = df[column].values
+            if column in grid_columns:
+                values, positive_patches = pack_label_grids(values)
+                segmented = (positive_patches > 0) & (positive_patches < LABEL_GRID_SIZE * LABEL_GRID_SIZE)
+                columns.create_dataset(get_segmented_column_name(column), data=segmented.astype(np.uint8))
+                columns.create_dataset(column, data=values, compression='gzip')
+            elif values.dtype.kind == 'O':
+                missing = pd.isnull(values)
+                if missing.any():
+                    store.require_group('missing').create_dataset(column, data=missing.astype(np.uint8),
+                                                                  compression='gzip')
+                columns.create_dataset(column, data=np.where(missing, '', values.astype(str)).astype(object),
+                                       dtype=h5py.special_dtype(vlen=str), compression='gzip')
+            else:
+                columns.create_dataset(column, data=values, compression='gzip')
+
+
+def get_label_store_version(store_path):
+    with h5py.File(store_path, 'r') as store:
+        # the first stores had no version
+        return store.attrs.get('version', 1)
+
+
+def load_label_store(store_path, column_names=None):
+    """
+    Loads a processed label dataframe from a label store. The label grids stay bit packed (as bytes, see
+    get_label_grid_cells()), and a typed column flags the segmented images of each grid column.
+    :param store_path: path of the label store
+    :param column_names: optional - columns to load. None: all columns are loaded
+    :return: the dataframe
+    """
+    with h5py.File(store_path, 'r') as store:
+        grid_columns = list(store.attrs['grid_columns'])
+        column_names = list(store.attrs['columns']) if column_names is None else column_names
+        columns = store['columns']
+        data = {}
+        for column in column_names:
+            values = columns[column][()]
+            if column in grid_columns:
+                data[column] = get_label_grid_cells(values)
+            elif h5py.check_dtype(vlen=columns[column].dtype) is not None:
+                data[column] = np.array([value.decode() if isinstance(value, bytes) else value for value in values],
+                                        dtype=object)
+                if 'missing' in store and column in store['missing']:
+                    data[column][store['missing'][column][()].astype(bool)] = np.nan
+            else:
+                data[column] = values
+        for column in grid_columns:
+            if column in column_names:
+                data[get_segmented_column_name(column)] = columns[get_segmented_column_name(column)][()]
+        index = store['index'][()] if 'index' in store else None
+    return pd.DataFrame(data, index=index)
+
+
+def load_processed_labels(csv_path, grid_columns, read_csv=pd.read_csv):
+    """
+    Loads a processed label csv through its label store. The store is created next to the csv the first time, and
+    recreated when the csv is newer than the store.
+    :param csv_path: path of the processed csv file, or of its label store (.h5)
+    :param grid_columns: names of the columns with label grids
+    :param read_csv: function reading the csv file into a dataframe
+    :return: the processed dataframe with a typed segmentation flag for each grid column
+    """
+    store_path = get_label_store_path(csv_path)
+    if os.path.isfile(store_path) and (not os.path.isfile(csv_path) or
+                                       (os.path.getmtime(store_path) >= os.path.getmtime(csv_path) and
+                                        get_label_store_version(store_path) == LABEL_STORE_VERSION)):
+        return load_label_store(store_path)
+
+    print("Saving the processed labels in " + store_path)
+    save_label_store(read_csv(csv_path), store_path, grid_columns)
+    return load_label_store(store_path)
@@ -8,7 +8,9 @@ from sklearn.cross_validation import StratifiedShuffleSplit
 from sklearn.model_selection import GroupShuffleSplit
 import imagesize
 
-from cnn.keras_utils import visualize_population
+from cnn.keras_utils import visualize_population, NEGATIVE_INSTANCE_LABELS, POSITIVE_INSTANCE_LABELS
+from cnn.preprocessor.label_store import load_processed_labels, get_segmented_column_name, format_label_grids
+from cnn.preprocessor.image_path_index import build_image_path_index
 FINDINGS = ['Atelectasis', 'Cardiomegaly', 'Consolidation', 'Edema', 'Effusion', 'Emphysema',
             'Fibrosis', 'Hernia', 'Infiltration', 'Mass', 'Nodule', 'Pleural_Thickening',
             'Pneumonia', 'Pneumothorax']
@@ -90,15 +92,11 @@ def reorder_rows(df):
     return df.sort_values(by=["Reorder Index"])
 
 
-def preprocess_labels(Yclass, path_to_png):
+def preprocess_labels(Yclass, path_to_png, path_index_file=None):
     xy_df = Yclass.copy(deep=True)
     xy_df['Image Found'] = None
     xy_df['Reorder Index'] = None
-    xy_df['Dir Path'] = None
-
-    for src_path in Path(path_to_png).glob('**/*.png'):
-        image_ind = os.path.basename(src_path)
-        xy_df.loc[xy_df['Image Index'] == image_ind, ['Dir Path']] = str(src_path)
+    xy_df['Dir Path'] = xy_df['Image Index'].map(build_image_path_index(path_to_png, index_file=path_index_file))
     print("xy before dropping")
     print(xy_df.shape)
     xy_df = xy_df.dropna(subset=['Dir Path'])
@@ -116,12 +114,25 @@ def translate_on_patches(x_min, y_min, x_max, y_max):
 
 def couple_location_labels(Y_loc_dir, Y_class, P, out_dir):
     Y_loc = rename_columns(load_csv(Y_loc_dir), False)
+    # images without any bounding box keep the labels from the classification
+    Y_class['Bbox'] = Y_class['Image Index'].isin(Y_loc['Image Index']).astype(int)
+    image_scales = get_image_scaling_factors(Y_class.loc[Y_class['Bbox'] == 1])
 
+    positive_labels = str(np.ones((P, P))).replace('\n', '')
+    negative_labels = str(np.zeros((P, P))).replace('\n', '')
     for diagnosis in FINDINGS:
-        Y_class[[diagnosis + '_loc','Bbox']]= Y_class.apply(lambda x: pd.Series(integrate_annotations(x, Y_loc, diagnosis, P)), axis=1)
+        # same labels as create_label_matrix_classification()
+        Y_class[diagnosis + '_loc'] = pd.Series(np.where(Y_class[diagnosis] == 1, positive_labels, negative_labels),
+                                                index=Y_class.index, dtype=object)
+        bbox_labels = integrate_annotations(Y_loc, image_scales, diagnosis, P)
+        has_diagnosis_bbox = Y_class['Image Index'].isin(bbox_labels.index)
+        Y_class.loc[has_diagnosis_bbox, diagnosis + '_loc'] = \
+            Y_class.loc[has_diagnosis_bbox, 'Image Index'].map(bbox_labels)
 
     Y_class.to_csv(out_dir+'/processed_new_Y.csv')
-    return Y_class
+    # the labels are returned as in the runs skipping the processing, with the grids bit packed in the label store
+    return load_processed_labels(out_dir+'/processed_new_Y.csv', [finding + '_loc' for finding in FINDINGS],
+                                 read_csv=load_processed_csv)
 
 
 def create_label_matrix_classification(row, label, P):
@@ -141,43 +152,40 @@ def make_label_matrix_localization_v2(P, x_min, y_min, x_max, y_max):
     im_q[y_min:(y_max + 1), x_min:(x_max + 1)] = 1.
     return im_q
 
-def get_all_bbox_for_image(row, Y_loc):
-    all_info = Y_loc.loc[Y_loc['Image Index'] == row['Image Index']]
-    return all_info, row
-
-
-def integrate_annotations(row, Y_loc, diagnosis, P):
-    result_image_class = []
-    all_rows, row_classif_df = get_all_bbox_for_image(row, Y_loc)
 
-    # if no bbox is found for this image
-    if all_rows.values.size==0:
-        y_mat = create_label_matrix_classification(row, diagnosis, P)
-
-        result_image_class.append(y_mat)
-        return [y_mat, 0]
-    else:
-
-        if diagnosis in all_rows['Finding Label'].values:
-            # y_mat = all_rows.groupby(['Image Index']).apply(lambda x: image_with_bbox_v2(x, row_classif_df, diagnosis, P))
-            y_mat = all_rows.apply(lambda x: create_label_matrix_localization(x, row_classif_df, diagnosis, P), axis=1)
-
-            result_image_class.append(y_mat.dropna().values[0])
-            # return [np.array2string(y_mat.dropna().values[0], separator=' '), 1]
-            return [str(y_mat.dropna().values[0]).replace('\n', ''), 1]
+def get_image_scaling_factors(Y_class):
+    """
+    Reads the size of each image once.
+    :param Y_class: dataframe with the 'Image Index' and 'Dir Path' of the images
+    :return: dictionary from image index to the scaling factors of the image to the input size
+    """
+    return {image_ind: scaling_factor_v2(img_path)
+            for image_ind, img_path in zip(Y_class['Image Index'], Y_class['Dir Path'])}
 
-        else:
-            y_mat = create_label_matrix_classification(row, diagnosis, P)
-            result_image_class.append(y_mat)
 
-            return [y_mat, 1]
+def integrate_annotations(Y_loc, image_scales, diagnosis, P):
+    """
+    Creates the label matrix of the images with a bounding box of the diagnosis. If an image has several bounding
+    boxes of the diagnosis, the first one is used.
+    :param Y_loc: dataframe with the bounding boxes
+    :param image_scales: dictionary from image index to the scaling factors of the image
+    :param diagnosis: the finding
+    :param P: number of patches on each side of the image
+    :return: series with the label matrix as a string, indexed on the image index
+    """
+    diagnosis_bbox = Y_loc.loc[(Y_loc['Finding Label'] == diagnosis) & Y_loc['Image Index'].isin(image_scales.keys())]
+    diagnosis_bbox = diagnosis_bbox.drop_duplicates(subset=['Image Index'], keep='first')
+    label_matrices = [str(create_label_matrix_localization(bbox_row, image_scales[bbox_row['Image Index']],
+                                                           diagnosis, P)).replace('\n', '')
+                      for _, bbox_row in diagnosis_bbox.iterrows()]
+    return pd.Series(label_matrices, index=diagnosis_bbox['Image Index'].values, dtype=object)
 
 
-def create_label_matrix_localization(row, row_classif_df, diagnosis, P):
+def create_label_matrix_localization(row, image_scale, diagnosis, P):
     if row.values.size > 0:
         if diagnosis == row['Finding Label']:
             # scale_x, scale_y = scaling_factor(row_classif_df['Dir Path'])
-            scale_x, scale_y = scaling_factor_v2(row_classif_df['Dir Path'])
+            scale_x, scale_y = image_scale
             x_min, y_min, x_max, y_max = translate_coords_to_new_image_size(row['x'], row['y'], row['w'], row['h'],
                                                                             scale_x,
                                                                             scale_y)
@@ -277,21 +285,23 @@ def separate_localization_classification_labels(Y, single_class=None):
     if single_class is None:
         return Y.loc[Y['Bbox']==0], Y.loc[Y['Bbox']==1]
     else:
-        class_ind = Y[single_class + '_loc'].isin(
-            [str(np.zeros((16, 16))).replace('\n', ''), str(np.ones((16, 16))).replace('\n', '')])
+        segmented_column = get_segmented_column_name(single_class + '_loc')
+        if segmented_column in Y.columns:
+            class_ind = Y[segmented_column] == 0
+        else:
+            class_ind = Y[single_class + '_loc'].isin([NEGATIVE_INSTANCE_LABELS, POSITIVE_INSTANCE_LABELS])
 
         return Y.loc[class_ind], Y.loc[class_ind==False]
         # return Y.loc[Y[single_class+'_loc']==0], Y.loc[Y[single_class+'_loc']==1]
 
 # THIS METHOD IS USED FOR KERAS TESTING
 def keep_index_and_diagnose_columns(Y):
-    return Y[['Dir Path', 'Atelectasis_loc', 'Cardiomegaly_loc', 'Consolidation_loc', 'Edema_loc',
-        'Effusion_loc', 'Emphysema_loc','Fibrosis_loc', 'Hernia_loc', 'Infiltration_loc', 'Mass_loc',
-        'Nodule_loc', 'Pleural_Thickening_loc', 'Pneumonia_loc', 'Pneumothorax_loc']]
+    # the patch labels of all findings, in the order of FINDINGS - the order of the classes predicted by the model
+    return Y[['Dir Path'] + [finding + '_loc' for finding in FINDINGS]]
 
 
 def check_bounding_box_present(Y, class_name):
-    Y[class_name + '_loc'] == str(np.zeros((16, 16))).replace('\n', '')
+    Y[class_name + '_loc'] == NEGATIVE_INSTANCE_LABELS
 
 
 def keep_index_and_1diagnose_columns(Y, y_column_name):
@@ -307,11 +317,14 @@ def keep_observations_of_positive_patients(Y, res_path, class_name):
             Y.loc[Y['Patient ID'] == name, 'keep_patient'] = keep_patient_flag
 
         Y2 = Y.loc[(Y['keep_patient'])==1]
-        Y2.to_csv(res_path + "processed_"+ class_name + ".csv")
+        format_label_grids(Y2).to_csv(res_path + "processed_"+ class_name + ".csv")
         return Y2
 
 
 def keep_observations_with_label(Y, class_name):
+    # the typed label column, if present, holds the same result as searching the finding labels
+    if class_name in Y.columns:
+        return Y.loc[Y[class_name] == 1]
     return Y.loc[Y['Finding Labels'].str.contains(class_name)]
 
 
@@ -345,17 +358,14 @@ def get_train_test(Y, random_state=None, do_stats=False, res_path =None, label_c
         visualize_population(df_class_test, 'test_class_group', res_path, FINDINGS)
         visualize_population(pd.concat([df_bbox_test, df_class_test]), 'test_group', res_path, FINDINGS)
 
-    label_patches = label_col + '_loc'
+    # without a label column all findings are predicted
+    population_labels = ['No Finding'] + (FINDINGS if label_col is None else [label_col])
     print("Population: ")
-    print("Train dataset ")
-    print("No Finding: "+ str(df_train.loc[df_train['Finding Labels'].str.contains('No Finding')].shape[0]))
-    print(label_col+ ": " + str(df_train.loc[df_train['Finding Labels'].str.contains(label_col)].shape[0]))
-    print("Validation dataset ")
-    print("No Finding: " + str(df_val.loc[df_val['Finding Labels'].str.contains('No Finding')].shape[0]))
-    print(label_col + ": " + str(df_val.loc[df_val['Finding Labels'].str.contains(label_col)].shape[0]))
-    print("Test without bounding boxes dataset ")
-    print("No Finding: " + str(df_class_test.loc[df_class_test['Finding Labels'].str.contains('No Finding')].shape[0]))
-    print(label_col + ": " + str(df_class_test.loc[df_class_test['Finding Labels'].str.contains(label_col)].shape[0]))
+    for set_name, df_set in [("Train dataset ", df_train), ("Validation dataset ", df_val),
+                             ("Test without bounding boxes dataset ", df_class_test)]:
+        print(set_name)
+        for population_label in population_labels:
+            print(population_label + ": " + str(keep_observations_with_label(df_set, population_label).shape[0]))
     # if label_col is not None:
     #     train_set, val_set = keep_index_and_1diagnose_columns(df_train, label_patches),\
     #                          keep_index_and_1diagnose_columns(df_val,  label_patches)
@@ -518,10 +528,18 @@ def filter_observations(df, positive_obs, negative_obs):
     return filtered_patients_df
 
 
+def load_processed_csv(file_path):
+    df = load_csv(file_path)
+    # typed column for the images without findings, as the columns of the findings
+    df['No Finding'] = df['Finding Labels'].str.contains('No Finding').astype(float)
+    return df
+
+
 def load_xray(skip_processing, processed_labels_path, classication_labels_path, image_path, localization_labels_path,
               results_path):
     if skip_processing:
-        xray_df = load_csv(processed_labels_path)
+        xray_df = load_processed_labels(processed_labels_path, [finding + '_loc' for finding in FINDINGS],
+                                        read_csv=load_processed_csv)
         print('Cardiomegaly label division')
 
     else:
@@ -15,6 +15,17 @@ def test_size_bbox(bbox_label):
     return sum_active_patches
 
 
+def get_class_names(config):
+    '''
+    Classes predicted by the model. With the optional 'multi_label' setting all xray findings are predicted at once by
+    one model, otherwise only 'class_name'.
+    '''
+    if config.get('multi_label', False):
+        assert config['dataset_name'].lower() == 'xray', "'multi_label' is supported only for the xray dataset"
+        return list(ld.FINDINGS)
+    return [config['class_name']]
+
+
 def split_filter_data(config, df):
     '''
     Splits a dataframe into test, validation and training subsets and Filters unnecessary columns
@@ -24,6 +35,13 @@ def split_filter_data(config, df):
 
     print("Splitting data ...")
 
+    if config.get('multi_label', False):
+        # images are split on the segmentation of any finding, and the patch labels of all findings are kept
+        df_train, df_val, df_test = ld.get_train_test(df, random_state=1, do_stats=False, res_path=results_path,
+                                                      label_col=None)
+        return ld.keep_index_and_diagnose_columns(df_train), ld.keep_index_and_diagnose_columns(df_val), \
+            ld.keep_index_and_diagnose_columns(df_test)
+
     df_train, df_val, df_test = ld.get_train_test(df, random_state=1, do_stats=False,
                                                   res_path=results_path,
                                                   label_col=class_name)
@@ -51,7 +69,8 @@ def load_process_xray14(config):
 
     xray_df = ld.load_xray(skip_processing, processed_labels_path, classication_labels_path, image_path,
                            localization_labels_path, results_path)
-    xray_df = ld.filter_observations(xray_df, class_name, 'No Finding')
+    if not config.get('multi_label', False):
+        xray_df = ld.filter_observations(xray_df, class_name, 'No Finding')
     return xray_df
 
 
@@ -1,11 +1,11 @@
 import pandas as pd
 import cv2
 from sklearn.model_selection import ShuffleSplit
-from tqdm import tqdm
 import numpy as np
 import math
 
 from cnn.preprocessor.load_data import keep_index_and_1diagnose_columns, calculate_observations_to_keep
+from cnn.preprocessor.label_store import load_processed_labels
 
 CLASS_LIST = ['elbow', 'finger', 'forearm', 'hand', 'humerus', 'shoulder', 'wrist']
 
@@ -45,23 +45,39 @@ def create_instance_labels(bag_label, P):
         return str(im_q).replace('\n', '')
 
 
+def get_study_path(img_paths):
+    """
+    :param img_paths: series with paths of images, or of studies
+    :return: the path of the study of each image, without the trailing '/'
+    """
+    return img_paths.str.rstrip('/').str.rsplit('/', n=1).str[0]
+
+
 def combine_labels_and_path(df_labels, df_img_path, file_path_root, csv_name):
-    for index, row in tqdm(df_labels.iterrows()):
-        file_path_substring = row[0]
-        file_label_bag = row[1]
-
-        if df_img_path.iloc[:, 0].str.contains(file_path_substring).any():
-            # print(file_path)
-            matching_indices = df_img_path.index[df_img_path.iloc[:, 0].str.contains(file_path_substring)]
-            ### UPDATE PATH TO IMAGES
-            file_path_in_csv = df_img_path.loc[matching_indices, 'Dir Path']
-            df_img_path.loc[matching_indices, 'Dir Path'] = file_path_root + file_path_in_csv
-            start_class = file_path_substring.find('XR_') + 3
-            end_class = file_path_substring.find('patient', start_class)
-            class_present = file_path_substring[start_class:end_class - 1]
-            df_img_path.loc[matching_indices, 'class'] =  class_present.lower()
-            df_img_path.loc[matching_indices, 'label'] =file_label_bag
-            df_img_path.loc[matching_indices, 'instance labels'] = create_instance_labels(file_label_bag, 16)
+    """
+    Adds the study labels to the images, joining the images and the studies on the study path.
+    :param df_labels: dataframe with the study path in the first column and the study label in the second
+    :param df_img_path: dataframe with the image paths in 'Dir Path'
+    :param file_path_root: directory containing the MURA-v1.1 folder, prepended to the paths of the labeled images
+    :param csv_name: name of the csv file where the result is saved
+    :return: df_img_path with the updated path, class, label and instance labels of the labeled images
+    """
+    study_labels = pd.Series(df_labels.iloc[:, 1].values, index=df_labels.iloc[:, 0].str.rstrip('/').values)
+    study_labels = study_labels[~study_labels.index.duplicated(keep='last')]
+    study_paths = get_study_path(df_img_path['Dir Path'])
+    matching_indices = study_paths.isin(study_labels.index)
+    image_labels = study_paths[matching_indices].map(study_labels)
+
+    ### UPDATE PATH TO IMAGES
+    df_img_path.loc[matching_indices, 'Dir Path'] = file_path_root + df_img_path.loc[matching_indices, 'Dir Path']
+    df_img_path['class'] = df_img_path['class'].astype(object)
+    df_img_path.loc[matching_indices, 'class'] = \
+        study_paths[matching_indices].str.extract(r'XR_(.*?).patient', expand=False).str.lower()
+    df_img_path.loc[matching_indices, 'label'] = image_labels
+    df_img_path['instance labels'] = df_img_path['instance labels'].astype(object)
+    df_img_path.loc[matching_indices, 'instance labels'] = np.where(image_labels == 1,
+                                                                    create_instance_labels(1, 16),
+                                                                    create_instance_labels(0, 16))
     df_img_path.to_csv(file_path_root+ 'MURA-v1.1/' + csv_name+'.csv')
     return df_img_path
 
@@ -70,8 +86,8 @@ def load_mura(skip_processing, processed_train_labels_path, processed_test_label
               mura_train_img_path, mura_train_labels_path,
               mura_test_labels_path, mura_test_img_path):
     if skip_processing:
-        df_train_val = pd.read_csv(processed_train_labels_path)
-        test_df_all_classes = pd.read_csv(processed_test_labels_path)
+        df_train_val = load_processed_labels(processed_train_labels_path, ['instance labels'])
+        test_df_all_classes = load_processed_labels(processed_test_labels_path, ['instance labels'])
 
     else:
         end_class = mura_train_img_path.find('MURA-v1.1')
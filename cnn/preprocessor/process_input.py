@@ -1,7 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
+
 from tensorflow.keras.preprocessing.image import load_img, img_to_array, save_img
-from cnn.preprocessor.load_data_mura import padding_needed, pad_image
-from cnn.keras_utils import image_larger_input, calculate_scale_ratio
+from cnn.preprocessor.image_transform import transform_image
+from cnn.preprocessor.label_store import format_label_grids, load_processed_labels
+from cnn.preprocessor.load_data import FINDINGS
+import fcntl
 import os
+import tempfile
+import numpy as np
 import pandas as pd
 
 
@@ -20,56 +26,63 @@ def decrease_image_size(new_height, new_width, image_dir):
 
 
 def resize_image(image_dir, image_new_height, image_new_width, resize_method):
-    original_img_width, original_img_height = load_img(image_dir, target_size=None, color_mode='rgb').size
-    decrease_needed = image_larger_input(original_img_width, original_img_height, image_new_height, image_new_width)
-
-    # this just decreases the image size to the new image size WITHOUT checking if ratio is kept
-    # this is used only for xray dataset where images are 1024x1024
-    if resize_method:
-        resized_image = decrease_image_size(image_new_height, image_new_width, image_dir)
-
-    else:
-        # IF one or both sides of the image have bigger size than the requires input, then decrease is needed
-        # rescaling with preserving the image ratio
-        if decrease_needed:
-            ratio = calculate_scale_ratio(original_img_width, original_img_height, image_new_width,
-                                          image_new_height)
-            assert ratio >= 1.00, "wrong ratio - it will increase image size"
-            assert int(original_img_height / ratio) == image_new_height or \
-                   int(original_img_width / ratio) == image_new_width, "error in computation"
-
-            resized_image = load_img(image_dir,
-                                     target_size=(int(original_img_height / ratio),
-                                                  int(original_img_width / ratio)),
-                                     color_mode='rgb')
-        else:
-            # ELSE just open image in its original form
-            resized_image = load_img(image_dir, target_size=None, color_mode='rgb')
-
-        ### PADDING
-        pad_needed = padding_needed(resized_image)
-
-        if pad_needed:
-            resized_image = pad_image(resized_image, final_size_x=image_new_width, final_size_y=image_new_height)
-
-    return resized_image
+    """
+    Brings an image to the new size. resize_method True: the image is resized to the new size - used for the xray
+    dataset where images are 1024x1024. False: the image is decreased preserving its ratio and padded.
+    :return: float32 array of the resized image
+    """
+    return transform_image(image_dir, image_new_height, image_new_width, resize_method)
+
+
+def preprocess_image_file(image_dir, processed_image_path, image_new_height, image_new_width, resize_method):
+    """
+    Resizes an image and saves it. The image is written to a temporary file that replaces processed_image_path when
+    complete, so an interrupted run never leaves a partial image behind.
+    The function is on module level, so it can be run in a process pool.
+    """
+    img_array = img_to_array(resize_image(image_dir, image_new_height, image_new_width, resize_method))
+    path_root, extension = os.path.splitext(processed_image_path)
+    partial_image_path = path_root + '.partial' + extension
+    save_img(partial_image_path, img_array)
+    os.replace(partial_image_path, processed_image_path)
+    return processed_image_path
 
 
 def preprocess_images_from_dataframe(df, image_new_height, image_new_width, resize_method, parent_folder,
-                                     new_folder_name, df2):
-
+                                     new_folder_name, df2, workers=0, resume=False):
+    """
+    Resizes the images of a dataframe and saves them in a new directory. The paths in both dataframes are updated to
+    the new images, and df is saved in a csv file next to the directory.
+    :param workers: number of processes resizing the images in parallel. 0: the images are resized one after another
+    :param resume: True: images already saved in the new directory (e.g. by an interrupted run) are not processed again
+    :return: df and df2 with the new image paths
+    """
     processed_images_dir = create_new_directory(parent_folder, new_folder_name)
 
-    for index, row in df.iterrows():
-        image_dir = row['Dir Path']
-        image_name = os.path.split(image_dir)[-1]
-        resized_image = resize_image(image_dir, image_new_height, image_new_width, resize_method)
-        img_array = img_to_array(resized_image)
-
-        save_img(processed_images_dir+'/'+image_name, img_array)
-        df2.loc[df2['Image Index'] == image_name, 'Dir Path'] =  processed_images_dir+'/'+image_name
-        df.loc[index, 'Dir Path'] = processed_images_dir+'/'+image_name
-    df.to_csv(parent_folder+new_folder_name+'.csv')
+    image_dirs = df['Dir Path'].tolist()
+    image_names = [os.path.split(image_dir)[-1] for image_dir in image_dirs]
+    processed_image_paths = [processed_images_dir + '/' + image_name for image_name in image_names]
+    images_to_process = [(image_dir, processed_image_path)
+                         for image_dir, processed_image_path in zip(image_dirs, processed_image_paths)
+                         if not (resume and os.path.isfile(processed_image_path))]
+    print("Preprocessing " + str(len(images_to_process)) + " images, " +
+          str(len(image_dirs) - len(images_to_process)) + " already processed")
+
+    if workers > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(preprocess_image_file, [image_dir for image_dir, _ in images_to_process],
+                              [processed_image_path for _, processed_image_path in images_to_process],
+                              [image_new_height] * len(images_to_process), [image_new_width] * len(images_to_process),
+                              [resize_method] * len(images_to_process), chunksize=16))
+    else:
+        for image_dir, processed_image_path in images_to_process:
+            preprocess_image_file(image_dir, processed_image_path, image_new_height, image_new_width, resize_method)
+
+    processed_paths_by_name = dict(zip(image_names, processed_image_paths))
+    processed_rows = df2['Image Index'].isin(processed_paths_by_name.keys())
+    df2.loc[processed_rows, 'Dir Path'] = df2.loc[processed_rows, 'Image Index'].map(processed_paths_by_name)
+    df['Dir Path'] = processed_image_paths
+    format_label_grids(df).to_csv(parent_folder+new_folder_name+'.csv')
     return df, df2
 
 
@@ -77,8 +90,89 @@ def fetch_preprocessed_images_csv(parent_folder, new_folder_name):
     new_path = os.path.join(parent_folder, new_folder_name)
     assert os.path.exists(new_path), " Directory not found. Please, run preprocess_images.py first"
     if os.path.exists(new_path):
-        return pd.read_csv(parent_folder+new_folder_name+'.csv', index_col=0)
+        # the resized images are only used for xray, with a label grid column for each finding
+        return load_processed_labels(parent_folder+new_folder_name+'.csv', [finding + '_loc' for finding in FINDINGS],
+                                     read_csv=lambda csv_path: pd.read_csv(csv_path, index_col=0))
 
 
 def combine_preprocessed_csv(df_train, df_test, df_val):
-    return pd.concat([df_train, df_val, df_test])
\ No newline at end of file
+    return pd.concat([df_train, df_val, df_test])
+
+
+def get_image_cache_name(cache_dir, image_new_height, image_new_width, resize_method, resized_images):
+    if resized_images:
+        preprocessing = 'resized'
+    elif resize_method:
+        preprocessing = 'interpolation'
+    else:
+        preprocessing = 'padding'
+    return os.path.join(cache_dir, 'image_cache_' + str(image_new_height) + 'x' + str(image_new_width) + '_' +
+                        preprocessing)
+
+
+def load_image_cache(cache_name, image_new_height, image_new_width):
+    """
+    Opens an image cache created with update_image_cache().
+    :param cache_name: path of the cache files without extension (see get_image_cache_name())
+    :return: read-only memory map of the uint8 images, and a dictionary from image path (Dir Path) to row in the images
+    """
+    cached_paths = load_image_cache_paths(cache_name)
+    if len(cached_paths) == 0:
+        return np.zeros((0, image_new_height, image_new_width, 3), dtype=np.uint8), {}
+    # only the rows of the listed paths are mapped, images added later by another run are not visible
+    cached_images = np.memmap(cache_name + '.uint8', dtype=np.uint8, mode='r',
+                              shape=(len(cached_paths), image_new_height, image_new_width, 3))
+    return cached_images, {image_dir: row for row, image_dir in enumerate(cached_paths)}
+
+
+def load_image_cache_paths(cache_name):
+    if not os.path.isfile(cache_name + '_paths.npy'):
+        return []
+    return list(np.load(cache_name + '_paths.npy'))
+
+
+def update_image_cache(image_dirs, cache_dir, image_new_height, image_new_width, resize_method, resized_images):
+    """
+    Keeps preprocessed images in a memory mapped uint8 array, so each image is decoded, resized and padded only once
+    across epochs and trainings. Images missing from the cache are preprocessed as in resize_image() and appended in
+    place, the images already cached are not rewritten. The images are stored in image_cache_*.uint8 and their paths
+    (Dir Path) in image_cache_*_paths.npy. Runs sharing the cache directory add their images one after another.
+    :param image_dirs: paths of the images needed
+    :param cache_dir: directory of the cache
+    :param image_new_height: height of the preprocessed images
+    :param image_new_width: width of the preprocessed images
+    :param resize_method: True: images are resized to the new size. False: images are decreased preserving their ratio
+                        and padded to the new size
+    :param resized_images: True: the images are already preprocessed and are cached as they are
+    :return: read-only memory map of the uint8 images, and a dictionary from image path to row in the images
+    """
+    cache_name = get_image_cache_name(cache_dir, image_new_height, image_new_width, resize_method, resized_images)
+    with open(cache_name + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        cached_paths = load_image_cache_paths(cache_name)
+        cached_dirs = set(cached_paths)
+        missing_dirs = list(dict.fromkeys(image_dir for image_dir in image_dirs if image_dir not in cached_dirs))
+        if len(missing_dirs) > 0:
+            print("Adding " + str(len(missing_dirs)) + " images to the image cache " + cache_name)
+            image_shape = (image_new_height, image_new_width, 3)
+            with open(cache_name + '.uint8', 'r+b' if os.path.isfile(cache_name + '.uint8') else 'wb') as images_file:
+                # images of an interrupted update are not listed in the paths, they are overwritten
+                images_file.truncate(len(cached_paths) * int(np.prod(image_shape)))
+                images_file.seek(0, os.SEEK_END)
+                for image_dir in missing_dirs:
+                    if resized_images:
+                        image = img_to_array(load_img(image_dir, target_size=None, color_mode='rgb'))
+                    else:
+                        image = img_to_array(resize_image(image_dir, image_new_height, image_new_width,
+                                                          resize_method))
+                    assert image.shape == image_shape, "Preprocessed image has a different size than the cache"
+                    images_file.write(np.clip(np.rint(image), 0, 255).astype(np.uint8).tobytes())
+                images_file.flush()
+                os.fsync(images_file.fileno())
+
+            # the paths are replaced after their images are written, from a temporary file unique to this run
+            paths_file, new_paths_name = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+            with os.fdopen(paths_file, 'wb') as new_paths:
+                np.save(new_paths, np.array(cached_paths + missing_dirs, dtype=str))
+            os.replace(new_paths_name, cache_name + '_paths.npy')
+    return load_image_cache(cache_name, image_new_height, image_new_width)
@@ -34,25 +34,12 @@ performance_path = build_path_results(results_path, dataset_name, pooling_operat
                                              result_suffix='performance')
 make_directory(performance_path)
 
-pool_dict = {'nor': "nor",
-             "lse": "lse",
-             "lse01": "lse",
-             "max": "max",
-             "mean": "mean"
-             }
-r = {'nor': 0,
-    "lse": 1.0,
-    "lse01": 0.1,
-     "max": 0,
-     "mean":0
-     }
-
 image_labels, image_predictions, \
 has_bbox, accurate_localizations, dice_scores = keras_preds.process_prediction(config,
                                                                                predictions_unique_name,
                                                                                predictions_path,
-                                                                               r=r[pooling_operator],
-                                                                               pool_method=pool_dict[pooling_operator],
+                                                                               r=None,
+                                                                               pool_method=pooling_operator,
                                                                                img_pred_method=image_prediction_method,
                                                                                threshold_binarization=0.5,
                                                                                iou_threshold=0.1)
@@ -15,6 +15,10 @@ def load_config(path):
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--config_path', type=str,
                     help='Provide the file path to the configuration')
+parser.add_argument('-w', '--workers', type=int, default=0,
+                    help='Number of processes resizing the images in parallel, 0 resizes them one after another')
+parser.add_argument('-r', '--resume', action='store_true',
+                    help='Skip the images which are already preprocessed, e.g. by an interrupted run')
 
 args = parser.parse_args()
 config = load_config(args.config_path)
@@ -37,6 +41,7 @@ xray_df = pd.read_csv(processed_labels_path).copy()
 ## currently only working for Xray dataset
 if resized_images_before_training:
     df_processed, xray_df = preprocess_images_from_dataframe(df_xray, IMAGE_SIZE, IMAGE_SIZE, mura_interpolation, image_path,
-                                                'processed_imgs', xray_df)
+                                                'processed_imgs', xray_df, workers=args.workers,
+                                                resume=args.resume)
 
     xray_df.to_csv(image_path+'/all_processed_images.csv')
@@ -11,13 +11,14 @@ from tensorflow.python.keras.engine.saving import load_model
 from numpy.random import seed
 
 import cnn.nn_architecture.keras_generators as gen
+import cnn.nn_architecture.tf_datasets as tf_datasets
 import cnn.preprocessor.load_data_datasets as ldd
 from cnn import keras_utils
 from cnn.keras_preds import predict_patch_and_save_results
 from cnn.keras_utils import set_dataset_flag, build_path_results, make_directory
 from cnn.nn_architecture import keras_model
-from cnn.nn_architecture.custom_loss import keras_loss_v3_nor
-from cnn.nn_architecture.custom_performance_metrics import keras_accuracy, accuracy_asloss
+from cnn.nn_architecture.custom_loss import get_keras_loss
+from cnn.nn_architecture.custom_performance_metrics import make_keras_accuracy, make_accuracy_asloss
 from cnn.preprocessor.process_input import fetch_preprocessed_images_csv
 
 np.random.seed(1)
@@ -56,6 +57,12 @@ lr = config['lr']
 reg_weight = config['reg_weight']
 pooling_operator = config['pooling_operator']
 class_name = config['class_name']
+# with 'multi_label' one model predicts all xray findings, each in its own output channel
+class_names = ldd.get_class_names(config)
+class_nr = len(class_names)
+mixed_precision, jit_compile = keras_model.get_fast_training_options(config)
+# with 'tf_data' the model is trained on a tf.data pipeline instead of the generators
+use_tf_data = config.get('tf_data', False)
 
 IMAGE_SIZE = 512
 BATCH_SIZE = 10
@@ -88,34 +95,53 @@ else:
 
 if train_mode:
     tf.keras.backend.clear_session()
-    train_generator = gen.BatchGenerator(
-    instances=df_train.values,
-    resized_image = resized_images_before_training,
-    batch_size=BATCH_SIZE,
-    net_h=IMAGE_SIZE,
-    net_w=IMAGE_SIZE,
-    shuffle=True,
-    norm=keras_utils.normalize,
-    box_size=BOX_SIZE,
-    processed_y=skip_processing,
-    interpolation=mura_interpolation)
-
-    valid_generator = gen.BatchGenerator(
-        instances=df_val.values,
-        resized_image = resized_images_before_training,
-        batch_size=BATCH_SIZE,
-        shuffle=True,
-        net_h=IMAGE_SIZE,
-        net_w=IMAGE_SIZE,
-        box_size=BOX_SIZE,
-        norm=keras_utils.normalize,
-        processed_y=skip_processing,
-        interpolation=mura_interpolation)
-
-    model = keras_model.build_model(reg_weight)
+    if use_tf_data:
+        train_dataset = tf_datasets.build_dataset(df_train.values, resized_images_before_training,
+                                                  batch_size=BATCH_SIZE, shuffle=True, norm=keras_utils.normalize,
+                                                  net_h=IMAGE_SIZE, net_w=IMAGE_SIZE, box_size=BOX_SIZE,
+                                                  processed_y=skip_processing, interpolation=mura_interpolation,
+                                                  **tf_datasets.get_dataset_options(config))
+        valid_dataset = tf_datasets.build_dataset(df_val.values, resized_images_before_training,
+                                                  batch_size=BATCH_SIZE, shuffle=True, norm=keras_utils.normalize,
+                                                  net_h=IMAGE_SIZE, net_w=IMAGE_SIZE, box_size=BOX_SIZE,
+                                                  processed_y=skip_processing, interpolation=mura_interpolation,
+                                                  **tf_datasets.get_dataset_options(config))
+        train_steps = tf_datasets.get_dataset_steps(df_train, BATCH_SIZE)
+        valid_steps = tf_datasets.get_dataset_steps(df_val, BATCH_SIZE)
+    else:
+        train_generator = gen.BatchGenerator(
+            instances=df_train.values,
+            resized_image = resized_images_before_training,
+            batch_size=BATCH_SIZE,
+            net_h=IMAGE_SIZE,
+            net_w=IMAGE_SIZE,
+            shuffle=True,
+            norm=keras_utils.normalize,
+            box_size=BOX_SIZE,
+            processed_y=skip_processing,
+            interpolation=mura_interpolation,
+            **gen.get_decoding_options(config))
+
+        valid_generator = gen.BatchGenerator(
+            instances=df_val.values,
+            resized_image = resized_images_before_training,
+            batch_size=BATCH_SIZE,
+            shuffle=True,
+            net_h=IMAGE_SIZE,
+            net_w=IMAGE_SIZE,
+            box_size=BOX_SIZE,
+            norm=keras_utils.normalize,
+            processed_y=skip_processing,
+            interpolation=mura_interpolation,
+            **gen.get_decoding_options(config))
+        train_steps = train_generator.__len__()
+        valid_steps = valid_generator.__len__()
+
+    keras_model.set_jit_compile(jit_compile)
+    model = keras_model.build_model(reg_weight, class_nr)
     model.summary()
 
-    model = keras_model.compile_model_accuracy(model, lr, pooling_operator)
+    model = keras_model.compile_model_accuracy(model, lr, pooling_operator, class_nr, mixed_precision=mixed_precision)
 
     early_stop = EarlyStopping(monitor='val_loss',
                                min_delta=0.001,
@@ -142,17 +168,31 @@ if train_mode:
     dynamic_lrate = LearningRateScheduler(keras_model.dynamic_lr)
     print("df train STEPS")
     print(len(df_train) // BATCH_SIZE)
-    print(train_generator.__len__())
-
-    history = model.fit_generator(
-        generator=train_generator,
-        steps_per_epoch=train_generator.__len__(),
-        epochs=nr_epochs,
-        validation_data=valid_generator,
-        validation_steps=valid_generator.__len__(),
-        verbose=1,
-        callbacks=[best_model_checkpoint, dynamic_lrate]
-    )
+    print(train_steps)
+
+    if use_tf_data:
+        history = model.fit(
+            train_dataset,
+            steps_per_epoch=train_steps,
+            epochs=nr_epochs,
+            validation_data=valid_dataset,
+            validation_steps=valid_steps,
+            verbose=1,
+            callbacks=[best_model_checkpoint, dynamic_lrate]
+        )
+    else:
+        # the generator reshuffles its instances in on_epoch_end, the batches are requested in order so the next
+        # batches can be prefetched
+        history = model.fit_generator(
+            generator=train_generator,
+            shuffle=False,
+            steps_per_epoch=train_steps,
+            epochs=nr_epochs,
+            validation_data=valid_generator,
+            validation_steps=valid_steps,
+            verbose=1,
+            callbacks=[best_model_checkpoint, dynamic_lrate]
+        )
     print(model.get_weights()[2])
     print("history")
     print(history.history)
@@ -170,15 +210,19 @@ if train_mode:
     ##### EVALUATE function
 
     print("evaluate validation")
-    evaluate = model.evaluate_generator(
-        generator=valid_generator,
-        steps=valid_generator.__len__(),
-        verbose=1)
-
-    evaluate_train = model.evaluate_generator(
-        generator=train_generator,
-        steps=train_generator.__len__(),
-        verbose=1)
+    if use_tf_data:
+        evaluate = model.evaluate(valid_dataset, steps=valid_steps, verbose=1)
+        evaluate_train = model.evaluate(train_dataset, steps=train_steps, verbose=1)
+    else:
+        evaluate = model.evaluate_generator(
+            generator=valid_generator,
+            steps=valid_steps,
+            verbose=1)
+
+        evaluate_train = model.evaluate_generator(
+            generator=train_generator,
+            steps=train_steps,
+            verbose=1)
     test_generator = gen.BatchGenerator(
         instances=df_test.values,
         resized_image = resized_images_before_training,
@@ -189,7 +233,8 @@ if train_mode:
         norm=keras_utils.normalize,
         box_size=BOX_SIZE,
         processed_y=skip_processing,
-        interpolation=mura_interpolation)
+        interpolation=mura_interpolation,
+        **gen.get_decoding_options(config))
 
     evaluate_test = model.evaluate_generator(
         generator=test_generator,
@@ -201,40 +246,49 @@ if train_mode:
     print(evaluate)
     print("Evaluate test")
     print(evaluate_test)
+    # stops the workers decoding the images
+    test_generator.close()
+    if not use_tf_data:
+        train_generator.close()
+        valid_generator.close()
 
     predict_patch_and_save_results(model, 'val_set', df_val, skip_processing,
                                    BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
                                    mura_interpolation=mura_interpolation,
-                                   resized_images_before_training = resized_images_before_training)
+                                   resized_images_before_training = resized_images_before_training,
+                                   class_names=class_names)
     predict_patch_and_save_results(model, 'train_set', df_train, skip_processing,
                                    BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
                                    mura_interpolation=mura_interpolation,
-                                   resized_images_before_training = resized_images_before_training)
+                                   resized_images_before_training = resized_images_before_training,
+                                   class_names=class_names)
     predict_patch_and_save_results(model, 'test_set', df_test, skip_processing,
                                    BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
                                    mura_interpolation=mura_interpolation,
-                                   resized_images_before_training=resized_images_before_training)
+                                   resized_images_before_training=resized_images_before_training,
+                                   class_names=class_names)
 
 else:
     ######################################################################################
     # deserealize a model and do predictions with it
+    keras_loss = get_keras_loss(pooling_operator, class_nr)
     model = load_model(trained_models_path + 'Cardiomegaly-01-14.67.hdf5', compile=True, custom_objects={
-        'keras_loss_v3_nor': keras_loss_v3_nor,  'keras_accuracy': keras_accuracy,
-        'accuracy_asloss': accuracy_asloss})
+        keras_loss.__name__: keras_loss,  'keras_accuracy': make_keras_accuracy(class_nr),
+        'accuracy_asloss': make_accuracy_asloss(class_nr)})
 
     ########################################### TRAINING SET########################################################
 
     predict_patch_and_save_results(model, 'train_set', df_train, skip_processing,
                                    BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path, mura_interpolation,
-                                   resized_images_before_training)
+                                   resized_images_before_training, class_names=class_names)
 
     # ########################################### VALIDATION SET######################################################
 
     predict_patch_and_save_results(model, 'val_set', df_val, skip_processing,
                                    BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path, mura_interpolation,
-                                   resized_images_before_training)
+                                   resized_images_before_training, class_names=class_names)
 
     ########################################### TESTING SET########################################################
     predict_patch_and_save_results(model, 'test_set', df_test, skip_processing,
                                    BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path, mura_interpolation,
-                                   resized_images_before_training)
+                                   resized_images_before_training, class_names=class_names)
@@ -0,0 +1,126 @@
+"""
+Checks that the fast training mode (mixed precision and XLA compilation) gives the same results as float32. The same weights are evaluated in both modes on a small fixture of the test set, and keras_accuracy, the
+loss and the AUC of the image predictions are compared.
+"""
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+import yaml
+from sklearn.metrics import roc_auc_score
+
+import cnn.nn_architecture.keras_generators as gen
+import cnn.preprocessor.load_data_datasets as ldd
+from cnn import keras_utils
+from cnn.keras_preds import compute_bag_prediction_as_production
+from cnn.keras_utils import set_dataset_flag
+from cnn.nn_architecture import keras_model
+from cnn.preprocessor.process_input import fetch_preprocessed_images_csv
+
+os.environ['TF_CUDNN_DETERMINISTIC'] = 'true'
+os.environ['TF_DETERMINISTIC_OPS'] = 'true'
+
+
+def load_config(path):
+    with open(path, 'r') as ymlfile:
+        return yaml.load(ymlfile)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--config_path', type=str,
+                    help='Provide the file path to the configuration')
+parser.add_argument('-m', '--model_path', type=str, default=None,
+                    help='Optional - trained model whose weights are compared. Default: imagenet weights')
+parser.add_argument('-n', '--fixture_size', type=int, default=50,
+                    help='Number of test images used for the comparison')
+parser.add_argument('-t', '--tolerance', type=float, default=0.01,
+                    help='Largest accepted difference of keras_accuracy and AUC')
+
+args = parser.parse_args()
+config = load_config(args.config_path)
+
+resized_images_before_training = config['resized_images_before_training']
+skip_processing = config['skip_processing_labels']
+image_path = config['image_path']
+dataset_name = config['dataset_name']
+mura_interpolation = config['mura_interpolation']
+lr = config['lr']
+reg_weight = config['reg_weight']
+pooling_operator = config['pooling_operator']
+class_nr = len(ldd.get_class_names(config))
+
+IMAGE_SIZE = 512
+BATCH_SIZE = 10
+BOX_SIZE = 16
+
+use_xray, use_pascal = set_dataset_flag(dataset_name)
+if use_xray:
+    if resized_images_before_training:
+        xray_df = fetch_preprocessed_images_csv(image_path, 'processed_imgs')
+    else:
+        xray_df = ldd.load_process_xray14(config)
+    _, _, df_test = ldd.split_filter_data(config, xray_df)
+elif use_pascal:
+    _, _, df_test = ldd.load_preprocess_pascal(config)
+else:
+    _, _, df_test = ldd.load_preprocess_mura(config)
+df_fixture = df_test[:args.fixture_size]
+
+
+def evaluate_training_mode(mixed_precision, jit_compile, weights):
+    """
+    Builds the model in a training mode, and evaluates it on the fixture.
+    :param weights: weights of the model. None: the weights of the built model are kept
+    :return: the weights of the model, keras_accuracy, the loss, and the AUC of the image predictions
+    """
+    tf.keras.backend.clear_session()
+    keras_model.set_jit_compile(jit_compile)
+    model = keras_model.build_model(reg_weight, class_nr)
+    if weights is not None:
+        model.set_weights(weights)
+    elif args.model_path is not None:
+        model.load_weights(args.model_path)
+    model = keras_model.compile_model_accuracy(model, lr, pooling_operator, class_nr,
+                                               mixed_precision=mixed_precision)
+
+    fixture_generator = gen.BatchGenerator(
+        instances=df_fixture.values,
+        resized_image=resized_images_before_training,
+        batch_size=BATCH_SIZE,
+        net_h=IMAGE_SIZE,
+        net_w=IMAGE_SIZE,
+        shuffle=False,
+        norm=keras_utils.normalize,
+        box_size=BOX_SIZE,
+        processed_y=skip_processing,
+        interpolation=mura_interpolation)
+    # newer tensorflow versions set the metric names only when the model is evaluated
+    evaluation = model.evaluate_generator(fixture_generator, steps=fixture_generator.__len__())
+    evaluation = dict(zip(model.metrics_names, evaluation))
+
+    patch_predictions = model.predict_generator(fixture_generator, steps=fixture_generator.__len__())
+    patch_labels = np.concatenate([fixture_generator.__getitem__(batch_ind)[1]
+                                   for batch_ind in range(fixture_generator.__len__())])
+    image_labels = patch_labels.reshape(patch_labels.shape[0], -1, class_nr).max(axis=1)
+    image_predictions = compute_bag_prediction_as_production(patch_predictions, pooling_operator, None)
+    auc_scores = [roc_auc_score(image_labels[:, class_ind], image_predictions[:, class_ind])
+                  if len(np.unique(image_labels[:, class_ind])) == 2 else np.nan for class_ind in range(class_nr)]
+    return model.get_weights(), evaluation['keras_accuracy'], evaluation['loss'], np.array(auc_scores)
+
+
+weights, accuracy_float32, loss_float32, auc_float32 = evaluate_training_mode(False, False, None)
+_, accuracy_fast, loss_fast, auc_fast = evaluate_training_mode(True, True, weights)
+keras_model.set_jit_compile(False)
+tf.train.experimental.disable_mixed_precision_graph_rewrite()
+
+print("float32: keras_accuracy " + str(accuracy_float32) + ", loss " + str(loss_float32) + ", AUC " + str(auc_float32))
+print("fast mode: keras_accuracy " + str(accuracy_fast) + ", loss " + str(loss_fast) + ", AUC " + str(auc_fast))
+
+assert abs(accuracy_float32 - accuracy_fast) <= args.tolerance, "keras_accuracy differs in the fast training mode"
+# a class with only positive or only negative images in the fixture has no AUC
+compared_auc = ~np.isnan(auc_float32)
+assert np.any(compared_auc), "No class has positive and negative images in the fixture, use a larger fixture"
+assert np.all(np.abs(auc_float32[compared_auc] - auc_fast[compared_auc]) <= args.tolerance), \
+    "AUC differs in the fast training mode"
+print("The fast training mode gives the same results within " + str(args.tolerance))
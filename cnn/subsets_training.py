@@ -12,8 +12,7 @@ from cnn.keras_preds import predict_patch_and_save_results
 from cnn.keras_utils import set_dataset_flag, build_path_results, make_directory
 from cnn.nn_architecture import keras_generators as gen
 from cnn.nn_architecture import keras_model
-from cnn.nn_architecture.custom_loss import keras_loss_v3_nor, keras_loss_v3_lse, keras_loss_v3_lse01, \
-    keras_loss_v3_mean, keras_loss_v3_max
+from cnn.nn_architecture.custom_loss import get_keras_loss
 from cnn.nn_architecture.custom_performance_metrics import keras_accuracy, accuracy_asloss
 from cnn.preprocessor import load_data as ld
 from cnn.preprocessor.load_data import load_xray, split_xray_cv
@@ -63,6 +62,9 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
     lr = config['lr']
     reg_weight = config['reg_weight']
     pooling_operator = config['pooling_operator']
+    mixed_precision, jit_compile = keras_model.get_fast_training_options(config)
+    # one model is trained for 'class_name' in each split, all findings at once only with train_model.py
+    assert not config.get('multi_label', False), "'multi_label' is supported only by train_model.py"
 
     IMAGE_SIZE = 512
     BATCH_SIZE = 10
@@ -110,6 +112,8 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
             df_test = filter_rows_and_columns(test_df_all_classes, class_name)
 
         for curr_classifier in range(0, number_classifiers):
+            classifier_metadata = {'pooling_operator': pooling_operator, 'cv_split': split,
+                                   'subset_seed': subset_seeds[curr_classifier], 'overlap_ratio': overlap_ratio}
             if train_mode and split == CV_split_to_use:
                 print("#####################################################")
                 print("SPLIT :" + str(split))
@@ -143,7 +147,8 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
                     box_size=BOX_SIZE,
                     processed_y=skip_processing,
                     interpolation=mura_interpolation,
-                    shuffle=True)
+                    shuffle=True,
+                    **gen.get_decoding_options(config))
 
                 valid_generator = gen.BatchGenerator(
                     instances=df_val.values,
@@ -155,10 +160,12 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
                     norm=keras_utils.normalize,
                     processed_y=skip_processing,
                     interpolation=mura_interpolation,
-                    shuffle=True)
+                    shuffle=True,
+                    **gen.get_decoding_options(config))
 
+                keras_model.set_jit_compile(jit_compile)
                 model = keras_model.build_model(reg_weight)
-                model = keras_model.compile_model_accuracy(model, lr, pooling_operator)
+                model = keras_model.compile_model_accuracy(model, lr, pooling_operator, mixed_precision=mixed_precision)
                 lrate = LearningRateScheduler(keras_model.step_decay, verbose=1)
 
                 filepath = trained_models_path + "CV_" + str(split)  + '_' + str(curr_classifier) + "_-{epoch:02d}-{val_loss:.2f}.hdf5"
@@ -169,14 +176,20 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
                 print(len(df_train) // BATCH_SIZE)
                 print(train_generator.__len__())
 
+                # the generator reshuffles its instances in on_epoch_end, the batches are requested in order so the next
+                # batches can be prefetched
                 history = model.fit_generator(
                     generator=train_generator,
+                    shuffle=False,
                     steps_per_epoch=train_generator.__len__(),
                     epochs=nr_epochs,
                     validation_data=valid_generator,
                     validation_steps=valid_generator.__len__(),
                     verbose=1
                 )
+                # stops the workers decoding the images
+                train_generator.close()
+                valid_generator.close()
                 filepath = trained_models_path + 'subset_' + class_name + "_CV" + str(split) + '_' + str(
                     curr_classifier) + '_' + \
                            str(overlap_ratio) + ".hdf5"
@@ -199,18 +212,21 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
                 predict_patch_and_save_results(model, 'train_set_CV' + str(split)+'_'+ str(curr_classifier),
                                                df_train, skip_processing,
                                                BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                               mura_interpolation, resized_images_before_training)
+                                               mura_interpolation, resized_images_before_training,
+                                               metadata=classifier_metadata)
 
                 ########################################## VALIDATION SET######################################################
                 predict_patch_and_save_results(model, 'val_set_CV' + str(split)+'_'+ str(curr_classifier),
                                                df_val, skip_processing,
                                                BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                               mura_interpolation, resized_images_before_training)
+                                               mura_interpolation, resized_images_before_training,
+                                               metadata=classifier_metadata)
 
                 ########################################### TESTING SET########################################################
                 predict_patch_and_save_results(model, 'test_set_CV' + str(split) + '_' + str(curr_classifier), df_test,
                                                skip_processing, BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE,
-                                               prediction_results_path, mura_interpolation, resized_images_before_training)
+                                               prediction_results_path, mura_interpolation, resized_images_before_training,
+                                               metadata=classifier_metadata)
             elif not train_mode:
                 files_found = 0
                 print(trained_models_path)
@@ -223,26 +239,22 @@ def train_on_subsets(config, number_splits, CV_split_to_use, number_classifiers,
 
                 assert files_found == 1, "No model found/ Multiple models found, not clear which to use "
                 print(str(files_found))
-                loss_function_dict = {'nor': keras_loss_v3_nor,
-                                      "lse": keras_loss_v3_lse,
-                                      "lse01": keras_loss_v3_lse01,
-                                      "max": keras_loss_v3_max,
-                                      "mean": keras_loss_v3_mean
-                                      }
                 model = load_model(str(file_path),
                                    custom_objects={
-                                       loss_function_dict[pooling_operator].__name__: loss_function_dict[
-                                           pooling_operator],
+                                       get_keras_loss(pooling_operator).__name__: get_keras_loss(pooling_operator),
                                        'keras_accuracy': keras_accuracy,
                                        'accuracy_asloss': accuracy_asloss})
                 model = keras_model.compile_model_accuracy(model, lr, pooling_operator)
 
                 predict_patch_and_save_results(model, "train_set_CV" + str(split) + str(curr_classifier), df_train, skip_processing,
                                                BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                               mura_interpolation, resized_images_before_training)
+                                               mura_interpolation, resized_images_before_training,
+                                               metadata=classifier_metadata)
                 predict_patch_and_save_results(model, "val_set_CV" + str(split)+ str(curr_classifier), df_val, skip_processing,
                                                BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                               mura_interpolation, resized_images_before_training)
+                                               mura_interpolation, resized_images_before_training,
+                                               metadata=classifier_metadata)
                 predict_patch_and_save_results(model, "test_set_CV" + str(split)+ str(curr_classifier), df_test, skip_processing,
                                                BATCH_SIZE_TEST, BOX_SIZE, IMAGE_SIZE, prediction_results_path,
-                                               mura_interpolation,resized_images_before_training)
+                                               mura_interpolation,resized_images_before_training,
+                                               metadata=classifier_metadata)
@@ -1,5 +1,16 @@
+import os
+
+import h5py
 import numpy as np
 
+from cnn.prediction_store import prediction_store_exists, load_from_prediction_store, open_prediction_store, \
+    load_dataset_save_times, save_to_prediction_store, load_numeric_npy
+
+# sets of samples the stability can be computed on
+SAMPLE_SELECTIONS = ('all', 'positive', 'segmented')
+# number of active bits in each of the 256 possible byte values
+POPCOUNT_TABLE = np.array([bin(byte_value).count('1') for byte_value in range(256)], dtype=np.uint8)
+
 
 def load_model_prediction_from_file(inst_lab_prefix, ind_prefix, inst_pred_prefix, bag_lab_prefix, bag_pred_prefix,
                                     bbox_prefix, dataset_name, predictions_path):
@@ -12,35 +23,51 @@ def load_model_prediction_from_file(inst_lab_prefix, ind_prefix, inst_pred_prefi
     :param bag_pred_prefix: file prefix for bag predictions
     :param dataset_name: dataset identifier
     :param predictions_path: directory of the prediction files
-    :return: Instance labels, unique sample names, instance predictions, bag labels and bag predictions for each sample
+    :return: Instance labels, unique sample names, instance predictions, bag labels and bag predictions for each sample.
+    All arrays except the sample names are memory mapped (see load_numeric_npy()).
     """
-    labels = np.load(predictions_path + inst_lab_prefix + dataset_name + '.npy', allow_pickle=True)
+    labels = load_numeric_npy(predictions_path + inst_lab_prefix + dataset_name + '.npy')
     image_indices = np.load(predictions_path+ind_prefix + dataset_name + '.npy', allow_pickle=True)
-    predictions = np.load(predictions_path+inst_pred_prefix+ dataset_name + '.npy', allow_pickle=True)
+    predictions = load_numeric_npy(predictions_path+inst_pred_prefix+ dataset_name + '.npy')
 
-    bag_labels = np.load(predictions_path+bag_lab_prefix + dataset_name + '.npy',
-                         allow_pickle=True)
-    bag_predictions = np.load(predictions_path+bag_pred_prefix + dataset_name + '.npy',
-                              allow_pickle=True)
-    bbox_available = np.load(predictions_path+bbox_prefix + dataset_name + '.npy', allow_pickle=True)
+    bag_labels = load_numeric_npy(predictions_path+bag_lab_prefix + dataset_name + '.npy')
+    bag_predictions = load_numeric_npy(predictions_path+bag_pred_prefix + dataset_name + '.npy')
+    bbox_available = load_numeric_npy(predictions_path+bbox_prefix + dataset_name + '.npy')
     return labels, image_indices, predictions, bag_labels, bag_predictions, bbox_available
 
 
 def filter_bbox_image_ind(labels):
-    bbox_ind_col2 = []
     sum_all = np.sum(np.reshape(labels, (labels.shape[0], 16 * 16 * 1)), axis=1)
-    print("**************")
-    for el_ind in range(0, sum_all.shape[0]):
-        if 0 < sum_all[el_ind] < 256:
-            print(el_ind)
-            bbox_ind_col2.append(el_ind)
-    return bbox_ind_col2
+    return np.where((0 < sum_all) & (sum_all < 256))[0]
 
 
 def binarize_predictions(raw_prediction, threshold):
     return np.array(raw_prediction > threshold, dtype=int)
 
 
+def pack_binary_predictions(bin_pred, P=16):
+    """
+    Packs binary patch predictions into bits - 8 patches per byte. The 16x16 patches of an image are stored in 32 bytes
+    instead of 256 integers.
+    :param bin_pred: binary predictions with shape (images, P, P) or (images, P, P, 1)
+    :param P: patch sizes of an image
+    :return: packed predictions with shape (images, P*P/8) and dtype uint8
+    """
+    return np.packbits(np.asarray(bin_pred, dtype=bool).reshape(-1, P*P), axis=1)
+
+
+def binarize_and_pack_predictions(raw_prediction, threshold, P=16):
+    return pack_binary_predictions(raw_prediction > threshold, P)
+
+
+def unpack_binary_predictions(packed_pred, P=16):
+    return np.unpackbits(packed_pred, axis=-1)[..., :P*P].reshape(packed_pred.shape[:-1] + (P, P, 1)).astype(int)
+
+
+def count_active_bits(packed_pred):
+    return np.sum(POPCOUNT_TABLE[packed_pred], axis=-1, dtype=np.int64)
+
+
 def calculate_subsets_between_two_classifiers(bin_pred1, bin_pred2, P=16):
     sum_preds = bin_pred1 + bin_pred2
     n11_mask = np.array(sum_preds > 1, dtype=int)
@@ -63,11 +90,166 @@ def calculate_subsets_between_two_classifiers(bin_pred1, bin_pred2, P=16):
     return n00, n10, n01, n11
 
 
+def calculate_subsets_between_two_packed_classifiers(packed_pred1, packed_pred2, P=16):
+    """
+    Computes n00, n10, n01 and n11 between two models from bit-packed binary predictions
+    (see pack_binary_predictions()). Each subset is the number of set bits after a bitwise operation of the packed
+    predictions, e.g. n11 is the count of bits set in (pred1 AND pred2).
+    :param packed_pred1: packed binary predictions of a model
+    :param packed_pred2: packed binary predictions of another model on the same samples
+    :param P: patch sizes of an image
+    :return: n00, n10, n01, n11 for each image
+    """
+    n11 = count_active_bits(packed_pred1 & packed_pred2)
+    n10 = count_active_bits(packed_pred1 & ~packed_pred2)
+    n01 = count_active_bits(~packed_pred1 & packed_pred2)
+    n00 = P*P - n11 - n10 - n01
+    return n00, n10, n01, n11
+
+
+def get_model_pair_indices(models_nr):
+    """
+    Indices of all unique pairs of models (i, j) with i < j, in the order used by the condensed layout of the
+    stability scores: (0, 1), (0, 2), ..., (0, K-1), (1, 2), ..., (K-2, K-1).
+    :param models_nr: number of models compared
+    :return: two arrays with the index of the first and of the second model of each pair
+    """
+    return np.triu_indices(models_nr, k=1)
+
+
+def calculate_subsets_between_all_packed_classifiers(packed_pred_stack, P=16, condensed=False):
+    """
+    Computes n00, n10, n01 and n11 between the bit-packed binary predictions of every pair of models.
+    :param packed_pred_stack: packed binary predictions of K models with shape (K, images, P*P/8)
+    :param P: patch sizes of an image
+    :param condensed: True: only the unique pairs i < j are computed (see get_model_pair_indices())
+    :return: n00, n10, n01, n11 each with shape (K, K, images). Element [i, j, n] is the count between model i (first
+    classifier) and model j (second classifier) on image n. If condensed is True, each has a shape of
+    (K*(K-1)/2, images), where row p is the count between the models of the p-th pair.
+    """
+    models_nr, images_nr = packed_pred_stack.shape[0], packed_pred_stack.shape[1]
+    positive_patches = count_active_bits(packed_pred_stack)
+
+    if condensed:
+        first_model_ind, second_model_ind = get_model_pair_indices(models_nr)
+        n11 = np.empty((len(first_model_ind), images_nr), dtype=np.int64)
+        pair_ind = 0
+        for model_ind in range(0, models_nr - 1):
+            next_pair_ind = pair_ind + models_nr - model_ind - 1
+            n11[pair_ind:next_pair_ind] = count_active_bits(packed_pred_stack[model_ind] &
+                                                            packed_pred_stack[model_ind + 1:])
+            pair_ind = next_pair_ind
+        n10 = positive_patches[first_model_ind] - n11
+        n01 = positive_patches[second_model_ind] - n11
+    else:
+        n11 = np.empty((models_nr, models_nr, images_nr), dtype=np.int64)
+        for model_ind in range(0, models_nr):
+            n11[model_ind] = count_active_bits(packed_pred_stack[model_ind] & packed_pred_stack)
+
+        n10 = positive_patches[:, np.newaxis, :] - n11
+        n01 = positive_patches[np.newaxis, :, :] - n11
+    n00 = P*P - n11 - n10 - n01
+    return n00, n10, n01, n11
+
+
+def get_threshold_levels(raw_prediction, thresholds, P=16):
+    """
+    Finds for each patch how many of the thresholds are below its raw prediction. With thresholds sorted ascending, a
+    patch with level k is positive (raw prediction > threshold) for the first k thresholds and negative for the rest,
+    so the binarization for all thresholds is kept in a single integer per patch.
+    :param raw_prediction: raw predictions with shape (images, P, P, 1)
+    :param thresholds: thresholds for binarization sorted in ascending order
+    :param P: patch sizes of an image
+    :return: threshold levels with shape (images, P*P)
+    """
+    thresholds = np.asarray(thresholds)
+    assert (np.diff(thresholds) >= 0).all(), "The thresholds should be sorted in ascending order"
+    return np.searchsorted(thresholds, np.asarray(raw_prediction).reshape(-1, P*P), side='left')
+
+
+def count_positive_patches_varying_threshold(threshold_levels, thresholds_nr):
+    """
+    Counts the positive patches of each image for every threshold, from the threshold levels of the patches
+    (see get_threshold_levels()). The patches are counted once per level, and the cumulative sum over the levels gives
+    the count for every threshold.
+    :param threshold_levels: threshold levels with shape (images, patches)
+    :param thresholds_nr: number of thresholds
+    :return: number of positive patches with shape (thresholds, images)
+    """
+    images_nr = threshold_levels.shape[0]
+    row_offsets = np.arange(images_nr)[:, np.newaxis] * (thresholds_nr + 1)
+    level_counts = np.bincount((threshold_levels + row_offsets).ravel(),
+                               minlength=images_nr * (thresholds_nr + 1)).reshape(images_nr, thresholds_nr + 1)
+    # positive patches for threshold t are the patches with a level larger than t
+    positive_patches = np.cumsum(level_counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    return positive_patches.T
+
+
+def calculate_subsets_between_two_classifiers_varying_threshold(raw_pred1, raw_pred2, thresholds, P=16):
+    """
+    Computes n00, n10, n01 and n11 between the binary predictions of two models for every threshold of binarization.
+    :param raw_pred1: raw predictions of a model
+    :param raw_pred2: raw predictions of another model on the same samples
+    :param thresholds: thresholds for binarization sorted in ascending order
+    :param P: patch sizes of an image
+    :return: n00, n10, n01, n11 each with shape (thresholds, images)
+    """
+    thresholds_nr = len(thresholds)
+    levels1 = get_threshold_levels(raw_pred1, thresholds, P)
+    levels2 = get_threshold_levels(raw_pred2, thresholds, P)
+
+    n11 = count_positive_patches_varying_threshold(np.minimum(levels1, levels2), thresholds_nr)
+    n10 = count_positive_patches_varying_threshold(levels1, thresholds_nr) - n11
+    n01 = count_positive_patches_varying_threshold(levels2, thresholds_nr) - n11
+    n00 = P*P - n11 - n10 - n01
+    return n00, n10, n01, n11
+
+
+def calculate_subsets_between_all_classifiers_varying_threshold(raw_pred_coll, thresholds, P=16, condensed=False):
+    """
+    Computes n00, n10, n01 and n11 between the binary predictions of every pair of models for every threshold of
+    binarization. The threshold levels and the positive patches of each model are computed once.
+    :param raw_pred_coll: a list with the raw predictions of each model
+    :param thresholds: thresholds for binarization sorted in ascending order
+    :param P: patch sizes of an image
+    :param condensed: True: only the unique pairs i < j are computed (see get_model_pair_indices())
+    :return: n00, n10, n01, n11 each with shape (K, K, thresholds, images), or (K*(K-1)/2, thresholds, images) if
+    condensed
+    """
+    models_nr, thresholds_nr = len(raw_pred_coll), len(thresholds)
+    levels_coll = [get_threshold_levels(raw_pred, thresholds, P) for raw_pred in raw_pred_coll]
+    positive_patches = np.stack([count_positive_patches_varying_threshold(levels, thresholds_nr)
+                                 for levels in levels_coll])
+
+    first_model_ind, second_model_ind = get_model_pair_indices(models_nr)
+    n11 = np.stack([count_positive_patches_varying_threshold(np.minimum(levels_coll[ind1], levels_coll[ind2]),
+                                                             thresholds_nr)
+                    for ind1, ind2 in zip(first_model_ind, second_model_ind)])
+    if condensed:
+        n10 = positive_patches[first_model_ind] - n11
+        n01 = positive_patches[second_model_ind] - n11
+    else:
+        # n11 is symmetric and equal to the positive patches of the model when it is compared with itself
+        n11_all_pairs = np.empty((models_nr, models_nr) + positive_patches.shape[1:], dtype=n11.dtype)
+        n11_all_pairs[first_model_ind, second_model_ind] = n11
+        n11_all_pairs[second_model_ind, first_model_ind] = n11
+        n11_all_pairs[np.arange(models_nr), np.arange(models_nr)] = positive_patches
+        n11 = n11_all_pairs
+        n10 = positive_patches[:, np.newaxis] - n11
+        n01 = positive_patches[np.newaxis, :] - n11
+    n00 = P*P - n11 - n10 - n01
+    return n00, n10, n01, n11
+
+
 def load_filter_dice_scores(classifiers_list, segm_img_index, predict_res_path):
     dice_scores_coll = []
-    for classifier in classifiers_list:
-        dice = np.load(predict_res_path + 'dice_' + classifier+'.npy', allow_pickle=True)
-        dice_scores_coll.append(dice[segm_img_index[0]])
+    for model_ind, classifier in enumerate(classifiers_list):
+        if prediction_store_exists(predict_res_path, classifier):
+            dice = load_from_prediction_store(predict_res_path, classifier, ('dice',))[0]
+        else:
+            dice = load_numeric_npy(predict_res_path + 'dice_' + classifier+'.npy')
+        # the rows of the images can differ between the models (see build_image_alignment())
+        dice_scores_coll.append(dice[segm_img_index[model_ind]])
     return dice_scores_coll
 
 
@@ -88,13 +270,20 @@ def load_predictions(classifier_name_list, predict_res_path):
     all_bag_labels = []
     all_bbox = []
     for classifier in classifier_name_list:
-        all_labels_classifier, all_image_ind_classifier, \
-        all_raw_predictions_classifier, all_bag_labels_class, all_bag_predictions_class, all_bbox_classifier = \
-            load_model_prediction_from_file(dataset_name=classifier, predictions_path=predict_res_path,
-                                            inst_lab_prefix= 'patch_labels_',
-                                            ind_prefix='image_indices_', inst_pred_prefix= 'predictions_',
-                                            bag_lab_prefix= 'image_labels_', bag_pred_prefix='image_predictions_',
-                                            bbox_prefix='bbox_present_')
+        if prediction_store_exists(predict_res_path, classifier):
+            all_labels_classifier, all_image_ind_classifier, all_raw_predictions_classifier, all_bag_labels_class, \
+            all_bag_predictions_class, all_bbox_classifier = load_from_prediction_store(
+                predict_res_path, classifier, ('patch_labels', 'image_indices', 'predictions', 'image_labels',
+                                               'image_predictions', 'bbox_present'))
+        else:
+            # separate .npy files of runs before the prediction store
+            all_labels_classifier, all_image_ind_classifier, \
+            all_raw_predictions_classifier, all_bag_labels_class, all_bag_predictions_class, all_bbox_classifier = \
+                load_model_prediction_from_file(dataset_name=classifier, predictions_path=predict_res_path,
+                                                inst_lab_prefix= 'patch_labels_',
+                                                ind_prefix='image_indices_', inst_pred_prefix= 'predictions_',
+                                                bag_lab_prefix= 'image_labels_', bag_pred_prefix='image_predictions_',
+                                                bbox_prefix='bbox_present_')
 
         all_labels.append(all_labels_classifier)
         all_image_ind.append(all_image_ind_classifier)
@@ -105,31 +294,165 @@ def load_predictions(classifier_name_list, predict_res_path):
     return all_labels, all_image_ind, all_raw_predictions, all_bag_labels, all_bag_predictions, all_bbox
 
 
-def indices_segmentation_images(all_labels_collection):
-    bbox_ind_collection =[]
+def load_raw_predictions_memmap(classifier_name_list, predict_res_path, inst_pred_prefix='predictions_'):
+    """
+    Opens the raw instance predictions of several models as read-only memory maps. Only the images that are accessed
+    are read from disk, so the predictions of large test sets can be processed in blocks of images
+    (see compute_stability_scores_in_blocks()).
+    If a model has a prediction store, its predictions dataset is opened instead. The dataset is read in the same
+    way, but its rows have to be accessed in increasing order.
+    :param classifier_name_list: list of several models trained on slightly different subsets
+    :param predict_res_path: directory of the prediction files
+    :param inst_pred_prefix: file prefix for instance predictions
+    :return: a list with the memory mapped raw predictions of each model
+    """
+    raw_predictions_coll = []
+    for classifier in classifier_name_list:
+        if prediction_store_exists(predict_res_path, classifier):
+            raw_predictions_coll.append(open_prediction_store(predict_res_path, classifier)['predictions'])
+        else:
+            raw_predictions_coll.append(load_numeric_npy(predict_res_path + inst_pred_prefix + classifier + '.npy'))
+    return raw_predictions_coll
+
+
+def close_raw_predictions(raw_predictions_coll):
+    """
+    Closes the prediction stores opened by load_raw_predictions_memmap().
+    """
+    for raw_predictions in raw_predictions_coll:
+        if isinstance(raw_predictions, h5py.Dataset):
+            raw_predictions.file.close()
+
+
+def read_prediction_rows(raw_predictions, rows):
+    """
+    Reads rows of memory mapped predictions in any order. The datasets of a prediction store can only be read in
+    increasing order of the rows, so the rows are read sorted and then put back in the requested order.
+    :param raw_predictions: raw predictions of a model, a numpy array, memory map or prediction store dataset
+    :param rows: unique rows to read, e.g. the rows of the shared images of the model (see build_image_alignment())
+    :return: the predictions of the rows in the requested order
+    """
+    rows = np.asarray(rows)
+    read_order = np.argsort(rows, kind='stable')
+    sorted_predictions = np.asarray(raw_predictions[rows[read_order]])
+    return sorted_predictions[np.argsort(read_order)]
+
+
+def compute_sample_selection_masks(patch_labels, bag_labels):
+    """
+    Finds in one pass which samples belong to each sample set in SAMPLE_SELECTIONS: all samples, samples with a
+    positive label and samples with segmentation (some, but not all patches are positive).
+    :param patch_labels: instance labels of each sample
+    :param bag_labels: bag labels of each sample
+    :return: a dictionary with a boolean mask over the samples for each sample set
+    """
+    patch_labels_sum = np.sum(np.reshape(patch_labels, (patch_labels.shape[0], -1)), axis=1)
+    patches_nr = np.prod(patch_labels.shape[1:])
+    return {'all': np.ones(patch_labels.shape[0], dtype=bool),
+            'positive': np.asarray(bag_labels) == 1,
+            'segmented': (0 < patch_labels_sum) & (patch_labels_sum < patches_nr)}
+
+
+def load_sample_selection_masks(classifier, predict_res_path, patch_labels, bag_labels):
+    """
+    Loads the sample set masks of a model (see compute_sample_selection_masks()) from their cache next to the
+    predictions. The masks are computed and cached the first time, and again when the labels are newer than the cache.
+    With a prediction store the masks are datasets of the store, otherwise they are kept in a sample_selection_*.npz
+    file next to the .npy files.
+    :param classifier: name of the model predictions
+    :param predict_res_path: directory of the prediction files
+    :param patch_labels: instance labels of each sample, used if the masks are not cached
+    :param bag_labels: bag labels of each sample, used if the masks are not cached
+    :return: a dictionary with a boolean mask over the samples for each sample set
+    """
+    dataset_names = ['selection_' + selection for selection in SAMPLE_SELECTIONS]
+    if prediction_store_exists(predict_res_path, classifier):
+        save_times = load_dataset_save_times(predict_res_path, classifier,
+                                             dataset_names + ['patch_labels', 'image_labels'])
+        masks_save_times, labels_save_times = save_times[:len(dataset_names)], save_times[len(dataset_names):]
+        if None not in masks_save_times and \
+                min(masks_save_times) >= max(save_time or 0.0 for save_time in labels_save_times):
+            return dict(zip(SAMPLE_SELECTIONS, load_from_prediction_store(predict_res_path, classifier,
+                                                                          dataset_names)))
+        selection_masks = compute_sample_selection_masks(patch_labels, bag_labels)
+        save_to_prediction_store(predict_res_path, classifier,
+                                 **{'selection_' + selection: mask for selection, mask in selection_masks.items()})
+        return selection_masks
+
+    cache_file = predict_res_path + 'sample_selection_' + classifier + '.npz'
+    labels_files = [predict_res_path + prefix + classifier + '.npy' for prefix in ('patch_labels_', 'image_labels_')]
+    if os.path.isfile(cache_file) and all(os.path.getmtime(cache_file) >= os.path.getmtime(labels_file)
+                                          for labels_file in labels_files if os.path.isfile(labels_file)):
+        with np.load(cache_file) as cached_masks:
+            return {selection: cached_masks[selection] for selection in SAMPLE_SELECTIONS}
+    selection_masks = compute_sample_selection_masks(patch_labels, bag_labels)
+    np.savez(cache_file, **selection_masks)
+    return selection_masks
+
+
+def build_image_alignment(image_index_collection):
+    """
+    Maps each image to its row in the prediction files of every model. The image indices of each model are hashed
+    once, so the prediction files of the models can be in a different order or contain only partly the same images.
+    Only the images predicted by all models are kept, in the order of the first model.
+    :param image_index_collection: a list with the image indices (unique sample names) of each model
+    :return: a list with an array of rows for each model - the i-th element is the row of the i-th shared image in the
+     prediction files of that model
+    """
+    first_image_indices = np.asarray(image_index_collection[0])
+    if all(len(image_indices) == len(first_image_indices) and
+           np.array_equal(np.asarray(image_indices), first_image_indices)
+           for image_indices in image_index_collection[1:]):
+        return [np.arange(len(first_image_indices)) for _ in image_index_collection]
+
+    row_lookup_collection = []
+    for image_indices in image_index_collection:
+        row_lookup = {image_id: row for row, image_id in enumerate(image_indices)}
+        assert len(row_lookup) == len(image_indices), "The image indices of a model are not unique"
+        row_lookup_collection.append(row_lookup)
+
+    shared_images = [image_id for image_id in first_image_indices
+                     if all(image_id in row_lookup for row_lookup in row_lookup_collection[1:])]
+    print("Images predicted by all models: " + str(len(shared_images)))
+    return [np.array([row_lookup[image_id] for image_id in shared_images], dtype=np.int64)
+            for row_lookup in row_lookup_collection]
+
+
+def select_aligned_images(selection_collection, alignment_rows_collection):
+    """
+    Keeps the shared images selected by all models, e.g. images with segmentation or positive images.
+    :param selection_collection: a boolean array for each model, which images of its prediction files are selected
+    :param alignment_rows_collection: the rows of the shared images in each model (see build_image_alignment())
+    :return: a list with the rows of the selected images for each model
+    """
+    aligned_selection = np.asarray(selection_collection[0])[alignment_rows_collection[0]]
+    for selection, alignment_rows in zip(selection_collection[1:], alignment_rows_collection[1:]):
+        assert np.array_equal(np.asarray(selection)[alignment_rows], aligned_selection), \
+            "Error, the selected images should be equal for all models"
+    return [alignment_rows[aligned_selection] for alignment_rows in alignment_rows_collection]
+
+
+def indices_segmentation_images(all_labels_collection, alignment_rows_collection=None):
+    if alignment_rows_collection is None:
+        alignment_rows_collection = [np.arange(all_labels.shape[0]) for all_labels in all_labels_collection]
+    has_segmentation_collection = []
     for all_labels in all_labels_collection:
-        bbox_indices = filter_bbox_image_ind(all_labels)
-        bbox_ind_collection.append(bbox_indices)
+        has_segmentation = np.zeros(all_labels.shape[0], dtype=bool)
+        has_segmentation[filter_bbox_image_ind(all_labels)] = True
+        has_segmentation_collection.append(has_segmentation)
 
-    for bbox_ind in bbox_ind_collection:
-        for bbox_ind2 in bbox_ind_collection:
-            assert bbox_ind == bbox_ind2, "Error, bbox images should be equal " \
-                                                    "in both cases"
+    bbox_ind_collection = select_aligned_images(has_segmentation_collection, alignment_rows_collection)
     print("Total images found with segmenation is: " + str(len(bbox_ind_collection[0])))
     return bbox_ind_collection
 
 
-def indices_positive_images(bag_labels_collection):
-    positive_img_ind_collection =[]
-    for img_labels in bag_labels_collection:
-        # get indices of elements equal to 1
-        pos_img_indices = np.where(img_labels == 1)[0]
-        positive_img_ind_collection.append(pos_img_indices)
-
-    for pos_ind in positive_img_ind_collection:
-        for pos_ind2 in positive_img_ind_collection:
-            assert (pos_ind == pos_ind2).all(), "Error, positive images should be equal " \
-                                                    "in both cases"
+def indices_positive_images(bag_labels_collection, alignment_rows_collection=None):
+    if alignment_rows_collection is None:
+        alignment_rows_collection = [np.arange(len(img_labels)) for img_labels in bag_labels_collection]
+    # get indices of elements equal to 1
+    positive_img_ind_collection = select_aligned_images([np.asarray(img_labels) == 1
+                                                         for img_labels in bag_labels_collection],
+                                                        alignment_rows_collection)
     print("Total positive images found is: " + str(len(positive_img_ind_collection[0])))
     return positive_img_ind_collection
 
@@ -141,41 +464,120 @@ def filter_predictions_files_on_indices(all_labels_coll, all_image_ind_coll, all
     :param all_labels_coll:
     :param all_image_ind_coll:
     :param all_raw_predictions_coll:
-    :param bbox_ind_coll:
+    :param bbox_ind_coll: for each model, the rows of the images to keep in its prediction files. The rows of all
+                            models should refer to the same images in the same order (see build_image_alignment()).
     :return: Returns only the images, labels and raw predictions of images with bounding boxes
     '''
     bbox_img_labels_coll = []
     bbox_img_ind_coll = []
     bbox_img_raw_predictions = []
     bbox_img_bag_predictions = []
-    bbox_img_bag_labels = []        
+    bbox_img_bag_labels = []
     assert len(bbox_ind_coll) == len(all_labels_coll) == len(all_image_ind_coll) == len(all_raw_predictions_coll), \
         "The lists do not have the same length"
 
     for el_ind in range(0, len(all_labels_coll)):
         bbox_ind = bbox_ind_coll[el_ind]
-        labels, image_ind, raw_predictions, bag_predictions, bag_labels = (all_labels_coll[el_ind])[bbox_ind], \
-                                                                          (all_image_ind_coll[el_ind])[bbox_ind], \
-                                                                          (all_raw_predictions_coll[el_ind])[bbox_ind],\
-                                                                          (all_bag_predictions_coll[el_ind])[bbox_ind], \
-                                                                          (all_bag_labels_coll[el_ind])[bbox_ind]
+        if len(bbox_ind) == len(all_image_ind_coll[el_ind]) and (bbox_ind == np.arange(len(bbox_ind))).all():
+            # all rows in their order - the (memory mapped) arrays are kept as they are
+            labels, image_ind, raw_predictions, bag_predictions, bag_labels = all_labels_coll[el_ind], \
+                                                                              all_image_ind_coll[el_ind], \
+                                                                              all_raw_predictions_coll[el_ind], \
+                                                                              all_bag_predictions_coll[el_ind], \
+                                                                              all_bag_labels_coll[el_ind]
+        else:
+            labels, image_ind, raw_predictions, bag_predictions, bag_labels = (all_labels_coll[el_ind])[bbox_ind], \
+                                                                              (all_image_ind_coll[el_ind])[bbox_ind], \
+                                                                              (all_raw_predictions_coll[el_ind])[bbox_ind],\
+                                                                              (all_bag_predictions_coll[el_ind])[bbox_ind], \
+                                                                              (all_bag_labels_coll[el_ind])[bbox_ind]
 
         bbox_img_labels_coll.append(labels)
         bbox_img_ind_coll.append(image_ind)
         bbox_img_raw_predictions.append(raw_predictions)
         bbox_img_bag_predictions.append(bag_predictions)
         bbox_img_bag_labels.append(bag_labels)
-        print("""""""""""""""""""")
-        print(el_ind)
-        print(image_ind)
-        assert (bbox_img_ind_coll[0] == image_ind).all(), "bbox image index are different or in different order"
+        assert np.array_equal(bbox_img_ind_coll[0], image_ind), "bbox image index are different or in different order"
     return bbox_img_labels_coll, bbox_img_ind_coll, bbox_img_raw_predictions,\
            bbox_img_bag_labels, bbox_img_bag_predictions
 
 
+def get_sample_selection(only_segmentation_images, only_positive_images):
+    """
+    :return: the sample set in SAMPLE_SELECTIONS and the identifier used in the names of the result files
+    """
+    if only_segmentation_images:
+        return 'segmented', "_segmented_img"
+    elif only_positive_images:
+        return 'positive', "_pos_img"
+    return 'all', "_all_img"
+
+
+def select_sample_rows(classifiers, selection, predictions_path, instance_labels_collection, image_index_collection,
+                       bag_labels_collection):
+    """
+    Finds the rows of the images of a sample set that are predicted by all models.
+    :param selection: sample set in SAMPLE_SELECTIONS
+    :return: for each model, the rows of the images in its prediction files, in the same image order for all models
+    """
+    alignment_rows_collection = build_image_alignment(image_index_collection)
+    selection_masks_collection = [load_sample_selection_masks(classifier, predictions_path, instance_labels,
+                                                              bag_labels)
+                                  for classifier, instance_labels, bag_labels in zip(classifiers,
+                                                                                     instance_labels_collection,
+                                                                                     bag_labels_collection)]
+    filtered_idx_collection = select_aligned_images([selection_masks[selection]
+                                                     for selection_masks in selection_masks_collection],
+                                                    alignment_rows_collection)
+    print("Total images found in the sample set '" + selection + "' is: " + str(len(filtered_idx_collection[0])))
+    return filtered_idx_collection
+
+
+def load_prediction_labels(classifier_name_list, predict_res_path):
+    """
+    Loads the patch labels, image indices and image labels of several models, without their raw predictions.
+    :return: all_labels, all_image_ind, all_bag_labels as lists with an element for each model
+    """
+    all_labels = []
+    all_image_ind = []
+    all_bag_labels = []
+    for classifier in classifier_name_list:
+        if prediction_store_exists(predict_res_path, classifier):
+            labels, image_ind, bag_labels = load_from_prediction_store(predict_res_path, classifier,
+                                                                       ('patch_labels', 'image_indices',
+                                                                        'image_labels'))
+        else:
+            labels = load_numeric_npy(predict_res_path + 'patch_labels_' + classifier + '.npy')
+            image_ind = np.load(predict_res_path + 'image_indices_' + classifier + '.npy', allow_pickle=True)
+            bag_labels = load_numeric_npy(predict_res_path + 'image_labels_' + classifier + '.npy')
+        all_labels.append(labels)
+        all_image_ind.append(image_ind)
+        all_bag_labels.append(bag_labels)
+    return all_labels, all_image_ind, all_bag_labels
+
+
+def load_filtered_image_rows(classifiers, only_segmentation_images, only_positive_images, predictions_path):
+    """
+    Finds the images used to compute stability as load_and_filter_predictions(), without loading the raw predictions.
+    The predictions can then be read block by block (see compute_stability_scores_from_files()).
+    :return: the image indices of the selected images of each model, the rows of these images in the prediction files
+     of each model, and the identifier of the sample set
+    """
+    instance_labels_collection, image_index_collection, bag_labels_collection = \
+        load_prediction_labels(classifiers, predictions_path)
+    selection, identifier = get_sample_selection(only_segmentation_images, only_positive_images)
+    filtered_idx_collection = select_sample_rows(classifiers, selection, predictions_path, instance_labels_collection,
+                                                 image_index_collection, bag_labels_collection)
+    filtered_image_index_collection = [np.asarray(image_index)[rows] for image_index, rows in
+                                       zip(image_index_collection, filtered_idx_collection)]
+    return filtered_image_index_collection, filtered_idx_collection, identifier
+
+
 def load_and_filter_predictions(classifiers, only_segmentation_images, only_positive_images, predictions_path):
     '''
-    Loads prediction files and filters on specific samples, which are used to compute stability
+    Loads prediction files and filters on specific samples, which are used to compute stability.
+    The prediction files of the models are aligned on the image index, so they can be in a different order. Only images
+    predicted by all models are used.
     :param config: config file
     :param classifiers: list with all classifier names
     :param only_segmentation_images: True: analysis is done only on images with segmentation,
@@ -184,49 +586,38 @@ def load_and_filter_predictions(classifiers, only_segmentation_images, only_posi
                 True: analysis done on image with positive label
                 False: analysis is done on all images
     :param predictions_path: path to prediction files needed to evaluate stability
-    :return: Returns the suitable rows of the subset desired
+    :return: Returns the suitable rows of the subset desired. For images with segmentation, the rows of the images in
+    the prediction files of each model are returned as well.
     '''
 
     instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
     bag_predictions_collection, _ = load_predictions(classifiers, predictions_path)
+    selection, identifier = get_sample_selection(only_segmentation_images, only_positive_images)
+    filtered_idx_collection = select_sample_rows(classifiers, selection, predictions_path, instance_labels_collection,
+                                                 image_index_collection, bag_labels_collection)
 
+    instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
+    bag_predictions_collection = filter_predictions_files_on_indices(instance_labels_collection, image_index_collection,
+                                                                     raw_predictions_collection,
+                                                                     bag_predictions_collection, bag_labels_collection,
+                                                                     filtered_idx_collection)
     if only_segmentation_images:
-        filtered_idx_collection = indices_segmentation_images(instance_labels_collection)
-        identifier = "_segmented_img"
-        instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
-        bag_predictions_collection = filter_predictions_files_on_indices(instance_labels_collection, image_index_collection,
-                                                                         raw_predictions_collection,
-                                                                         bag_predictions_collection, bag_labels_collection,
-                                                                         filtered_idx_collection)
         return instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
                bag_predictions_collection, identifier, filtered_idx_collection
-
-    elif only_positive_images:
-        filtered_idx_collection = indices_positive_images(bag_labels_collection)
-        identifier = "_pos_img"
-        instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
-        bag_predictions_collection = filter_predictions_files_on_indices(instance_labels_collection, image_index_collection,
-                                                                         raw_predictions_collection,
-                                                                         bag_predictions_collection, bag_labels_collection,
-                                                                         filtered_idx_collection)
-        return instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
-               bag_predictions_collection, identifier
-    else:
-        identifier = "_all_img"
-        return instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
-               bag_predictions_collection, identifier
+    return instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
+           bag_predictions_collection, identifier
 
 
 def filter_segmentation_images_bbox_file(config, classifiers, predictions_path):
+    '''
+    Finds the images with segmentation according to the bbox_present files, among the images predicted by all models.
+    :return: for each model, the rows of the images with segmentation in its prediction files
+    '''
     # prediction_results_path = config['prediction_results_path']
 
     image_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
     bag_predictions_collection, bbox_collection = load_predictions(classifiers, predictions_path)
 
-    for model_idx in range(1, len(bbox_collection)):
-        assert (bbox_collection[model_idx] == bbox_collection[model_idx-1]).all(), "bbox files are not equal!"
-    idx_to_filter_coll = []
-    for model_idx in range(len(bbox_collection)):
-        idx_to_filter_coll.append(np.where(bbox_collection[model_idx]==True)[0])
-
-    return idx_to_filter_coll
+    alignment_rows_collection = build_image_alignment(image_index_collection)
+    return select_aligned_images([np.asarray(bbox_available) == True for bbox_available in bbox_collection],
+                                 alignment_rows_collection)
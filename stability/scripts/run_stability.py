@@ -4,8 +4,9 @@ import yaml
 
 from cnn.keras_utils import set_dataset_flag, build_path_results, make_directory
 from stability.preprocessing import load_filter_dice_scores, indices_segmentation_images, \
-    filter_predictions_files_on_indices, load_and_filter_predictions, filter_segmentation_images_bbox_file
-from stability.stability_scores import compute_stability_scores
+    filter_predictions_files_on_indices, load_and_filter_predictions, filter_segmentation_images_bbox_file, \
+    load_predictions, load_filtered_image_rows
+from stability.stability_scores import compute_stability_scores, compute_stability_scores_from_files
 from stability.visualization_utils import generate_visualizations_stability, \
     generate_visualizations_instance_level
 
@@ -24,6 +25,9 @@ config = load_config(args.config_path)
 dataset_name = config['dataset_name']
 res_path = config['results_path']
 pooling_operator = config['pooling_operator']
+# optional - number of images whose predictions are read together, so the predictions of all models are never loaded
+# in memory at once. None: the predictions are loaded in memory
+stability_block_size = config.get('stability_block_size', None)
 
 set_name1 ='test_set_CV1_0'
 set_name2 = 'test_set_CV1_1'
@@ -45,7 +49,8 @@ stability_path = build_path_results(res_path, dataset_name, pooling_operator,
                                              result_suffix='stability')
 make_directory(stability_path)
 
-if use_xray:
+### Stability of the positive images
+if stability_block_size is None:
     instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
     bag_predictions_collection, identifier = load_and_filter_predictions(classifiers,
                                                                          only_segmentation_images=False,
@@ -53,19 +58,31 @@ if use_xray:
                                                                          predictions_path=predictions_path)
 
     pos_jacc, corr_pos_jacc, corr_pos_jacc_heur, pos_overlap, corr_pos_overlap, corr_iou, \
-    pearson_correlation, spearman_rank_correlation = compute_stability_scores(raw_predictions_collection)
-
-    generate_visualizations_stability(config, visualize_per_image=False, pos_jacc=pos_jacc, corr_pos_jacc=corr_pos_jacc,
-                                      corr_pos_jacc_heur=corr_pos_jacc_heur,
-                                      pos_overlap=pos_overlap, corr_pos_overlap=corr_pos_overlap, corr_iou=corr_iou,
-                                      pearson_correlation=pearson_correlation,
-                                      spearman_rank_correlation=spearman_rank_correlation,
-                                      image_labels_collection=instance_labels_collection,
-                                      image_index_collection=image_index_collection,
-                                      raw_predictions_collection=raw_predictions_collection,
-                                      samples_identifier=identifier, stability_path=stability_path)
-
-    ### Stability on instance level
+    pearson_correlation, spearman_rank_correlation = compute_stability_scores(raw_predictions_collection,
+                                                                              condensed=True)
+else:
+    # the scores are computed block by block from the prediction files and saved in the stability folder
+    image_index_collection, image_rows_collection, identifier = load_filtered_image_rows(
+        classifiers, only_segmentation_images=False, only_positive_images=True, predictions_path=predictions_path)
+    instance_labels_collection, raw_predictions_collection = None, None
+
+    pos_jacc, corr_pos_jacc, corr_pos_jacc_heur, pos_overlap, corr_pos_overlap, corr_iou, \
+    pearson_correlation, spearman_rank_correlation = compute_stability_scores_from_files(
+        classifiers, predictions_path, stability_path, image_rows_collection, block_size=stability_block_size,
+        file_suffix=identifier)
+
+generate_visualizations_stability(config, visualize_per_image=False, pos_jacc=pos_jacc, corr_pos_jacc=corr_pos_jacc,
+                                  corr_pos_jacc_heur=corr_pos_jacc_heur,
+                                  pos_overlap=pos_overlap, corr_pos_overlap=corr_pos_overlap, corr_iou=corr_iou,
+                                  pearson_correlation=pearson_correlation,
+                                  spearman_rank_correlation=spearman_rank_correlation,
+                                  image_labels_collection=instance_labels_collection,
+                                  image_index_collection=image_index_collection,
+                                  raw_predictions_collection=raw_predictions_collection,
+                                  samples_identifier=identifier, stability_path=stability_path)
+
+### Stability on instance level
+if use_xray:
     image_labels_segm_images, image_index_segm_images, raw_predictions_segm_images, bag_labels_segm_images, \
     bag_predictions_segm_images, identifier_segm_images, ind_segm_images_coll = load_and_filter_predictions(classifiers,
                                                                                       only_segmentation_images=True,
@@ -76,7 +93,7 @@ if use_xray:
 
     pos_jacc_segm_img, corr_pos_jacc_segm_img, corr_pos_jacc_heur_segm_img, pos_overlap_segm_img, \
     corr_pos_overlap_segm_img, corr_iou_segm_img, pearson_correlation_segm_img, \
-    spearman_rank_correlation_segm_img = compute_stability_scores(raw_predictions_segm_images)
+    spearman_rank_correlation_segm_img = compute_stability_scores(raw_predictions_segm_images, condensed=True)
 
     generate_visualizations_instance_level(config, pos_jacc_segm_img, corr_pos_jacc_segm_img, corr_pos_jacc_heur_segm_img,
                                            pos_overlap_segm_img, corr_pos_overlap_segm_img, corr_iou_segm_img,
@@ -85,32 +102,11 @@ if use_xray:
                                            dice_scores, stability_path)
 
 elif use_pascal:
-    instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
-    bag_predictions_collection, identifier = load_and_filter_predictions(classifiers,
-                                                                         only_segmentation_images=False,
-                                                                         only_positive_images=True,
-                                                                         predictions_path=predictions_path)
-
+    # not aligned on the image index - filtered below on the rows of the segmented images in each model
     all_instance_labels_collection, all_image_index_collection, all_raw_predictions_collection, \
-    all_bag_labels_collection, all_bag_predictions_collection, all_identifier = load_and_filter_predictions(classifiers,
-                                                                         only_segmentation_images=False,
-                                                                         only_positive_images=False,
-                                                                         predictions_path=predictions_path)
+    all_bag_labels_collection, all_bag_predictions_collection, all_bbox_collection = load_predictions(classifiers,
+                                                                                                     predictions_path)
 
-    pos_jacc, corr_pos_jacc, corr_pos_jacc_heur, pos_overlap, corr_pos_overlap, corr_iou, \
-    pearson_correlation, spearman_rank_correlation = compute_stability_scores(raw_predictions_collection)
-
-    generate_visualizations_stability(config, visualize_per_image=False, pos_jacc=pos_jacc, corr_pos_jacc=corr_pos_jacc,
-                                      corr_pos_jacc_heur=corr_pos_jacc_heur,
-                                      pos_overlap=pos_overlap, corr_pos_overlap=corr_pos_overlap, corr_iou=corr_iou,
-                                      pearson_correlation=pearson_correlation,
-                                      spearman_rank_correlation=spearman_rank_correlation,
-                                      image_labels_collection=instance_labels_collection,
-                                      image_index_collection=image_index_collection,
-                                      raw_predictions_collection=raw_predictions_collection,
-                                      samples_identifier=identifier, stability_path=stability_path)
-
-    ### Stability on instance level
     filtered_idx_collection = filter_segmentation_images_bbox_file(config, classifiers, predictions_path)
 
     identifier = "_segmented_img"
@@ -123,7 +119,7 @@ elif use_pascal:
 
     pos_jacc_segm_img, corr_pos_jacc_segm_img, corr_pos_jacc_heur_segm_img, pos_overlap_segm_img, \
     corr_pos_overlap_segm_img, corr_iou_segm_img, pearson_correlation_segm_img, \
-    spearman_rank_correlation_segm_img = compute_stability_scores(raw_predictions_segm_img)
+    spearman_rank_correlation_segm_img = compute_stability_scores(raw_predictions_segm_img, condensed=True)
 
     generate_visualizations_instance_level(config, pos_jacc_segm_img, corr_pos_jacc_segm_img,
                                            corr_pos_jacc_heur_segm_img,
@@ -131,23 +127,3 @@ elif use_pascal:
                                            pearson_correlation_segm_img, spearman_rank_correlation_segm_img,
                                            image_labels_segm_img, image_index_segm_img,
                                            raw_predictions_segm_img, dice_scores, stability_path)
-else:
-    instance_labels_collection, image_index_collection, raw_predictions_collection, bag_labels_collection, \
-    bag_predictions_collection, identifier = load_and_filter_predictions(classifiers,
-                                                                         only_segmentation_images=False,
-                                                                         only_positive_images=True,
-                                                                         predictions_path=predictions_path)
-
-    pos_jacc, corr_pos_jacc, corr_pos_jacc_heur, pos_overlap, corr_pos_overlap, corr_iou, \
-    pearson_correlation, spearman_rank_correlation = compute_stability_scores(raw_predictions_collection)
-
-    generate_visualizations_stability(config, visualize_per_image=False, pos_jacc=pos_jacc, corr_pos_jacc=corr_pos_jacc,
-                                      corr_pos_jacc_heur=corr_pos_jacc_heur,
-                                      pos_overlap=pos_overlap, corr_pos_overlap=corr_pos_overlap, corr_iou=corr_iou,
-                                      pearson_correlation=pearson_correlation,
-                                      spearman_rank_correlation=spearman_rank_correlation,
-                                      image_labels_collection=instance_labels_collection,
-                                      image_index_collection=image_index_collection,
-                                      raw_predictions_collection=raw_predictions_collection,
-                                      samples_identifier=identifier, stability_path=stability_path)
-
@@ -1,6 +1,9 @@
 import numpy as np
-from scipy.stats import rankdata, spearmanr, kendalltau
-from stability.preprocessing import calculate_subsets_between_two_classifiers, binarize_predictions
+from scipy.stats import rankdata, kendalltau
+from stability.preprocessing import calculate_subsets_between_two_classifiers, binarize_predictions, \
+    binarize_and_pack_predictions, calculate_subsets_between_all_packed_classifiers, get_model_pair_indices, \
+    calculate_subsets_between_all_classifiers_varying_threshold, read_prediction_rows, load_raw_predictions_memmap, \
+    close_raw_predictions
 
 
 def calculate_positive_Jaccard(bin_pred1, bin_pred2, P):
@@ -52,20 +55,38 @@ def calculate_spearman_rank_coefficient(raw_pred1, raw_pred2):
      based on the ranking of the patches within a sample/image.
     It is important that the predictions are done on the same samples, and the samples are in the same order in the two
     predictions.
+    The patches of all images are ranked at once, and the coefficient is the Pearson's correlation of the ranks.
 
     :param raw_pred1: predictions of a model
     :param raw_pred2:  predictions of another model on the same samples
-    :return: A list with Spearman rank correlation coefficient between predictions of two models. Each element of the
-    list is the correlation coefficient for a single sample/image.
+    :return: An array with Spearman rank correlation coefficient between predictions of two models. Each element of the
+    array is the correlation coefficient for a single sample/image.
     """
-    spearman_corr_coll = []
     assert raw_pred1.shape[0] == raw_pred2.shape[0], "Ensure the predictions have same shape!"
-    for obs in range(0, raw_pred1.shape[0]):
-        rank_image1 = rankdata(raw_pred1.reshape(-1, 16 * 16 * 1)[obs])
-        rank_image2 = rankdata(raw_pred2.reshape(-1, 16 * 16 * 1)[obs])
-        rho, pval = spearmanr(rank_image1, rank_image2)
-        spearman_corr_coll.append(rho)
-    return spearman_corr_coll
+    return calculate_pearson_coefficient(rank_patch_predictions(raw_pred1), rank_patch_predictions(raw_pred2))
+
+
+def rank_patch_predictions(raw_pred):
+    """
+    Ranks the patch predictions within each image. Ties get their average rank, the same as scipy's rankdata().
+    :param raw_pred: predictions of a model with shape (images, P, P) or (images, P, P, 1)
+    :return: ranks with shape (images, P*P)
+    """
+    return rankdata(np.reshape(raw_pred, (raw_pred.shape[0], -1)), axis=1)
+
+
+def standardize_patch_predictions(raw_pred):
+    """
+    Centers the patch predictions of each image and scales them to unit length, so that the Pearson's correlation
+    between two images is the dot product of their standardized patches.
+    :param raw_pred: predictions with shape (images, ...)
+    :return: standardized predictions with shape (images, # patches). Images with constant predictions have NaN values.
+    """
+    flat_pred = np.reshape(raw_pred, (raw_pred.shape[0], -1)).astype(np.float64)
+    centered_pred = flat_pred - np.mean(flat_pred, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return centered_pred / np.sqrt(np.sum(centered_pred ** 2, axis=1, keepdims=True))
+
 
 # todo: delete because it is not used
 # def calculate_IoU(bin_pred1, bin_pred2):
@@ -88,25 +109,15 @@ def calculate_pearson_coefficient(raw_pred1, raw_pred2):
     Calculating the Pearson's correlation coefficient between predictions of two models.
     It is important that the predictions are done on the same samples, and the samples are in the same order in the two
     predictions.
+    The coefficient of all images is computed at once from the per-image means, standard deviations and covariance.
 
     :param raw_pred1: predictions of a model
     :param raw_pred2:  predictions of another model on the same samples
-    :return: A list with Pearson's correlation coefficient between predictions of two models. Each element of the list
-    is the correlation coefficient for a single sample/image.
+    :return: An array with Pearson's correlation coefficient between predictions of two models. Each element of the
+    array is the correlation coefficient for a single sample/image.
     """
-    correlation_coll = []
     assert raw_pred1.shape == raw_pred2.shape, "Predictions don't have same shapes, you don't compare the same samples!"
-
-    for ind in range(0, raw_pred1.shape[0]):
-        corr_coef = np.corrcoef(raw_pred1.reshape((raw_pred1.shape[0], 16*16*1))[ind],
-                    raw_pred2.reshape((raw_pred2.shape[0], 16*16*1))[ind])
-        correlation_coll.append(corr_coef[0,1])
-        # # Test if the correlation is correct
-        # corr_coef_test = np.corrcoef(raw_pred1.reshape((raw_pred1.shape[0], 16*16*1))[ind],
-        #             raw_pred2.reshape((raw_pred2.shape[0], 16*16*1))[ind], rowvar=False)
-        # assert corr_coef[0, 1] == corr_coef_test[0, 1], "think on the dimensions of the correlation computed "
-
-    return correlation_coll
+    return np.sum(standardize_patch_predictions(raw_pred1) * standardize_patch_predictions(raw_pred2), axis=1)
 
 
 def calculate_kendallstau_coefficient_batch(raw_pred1, raw_pred2):
@@ -349,7 +360,33 @@ def calculate_corrected_positive_overlap(bin_pred1, bin_pred2):
     return np.ma.masked_array(corrected_score, np.isnan(corrected_score))
 
 
-def compute_continuous_stability_scores(raw_predictions):
+def calculate_correlation_between_all_classifiers(standardized_pred_coll, condensed=False):
+    """
+    Computes the Pearson's correlation coefficient between every pair of models for each image in one batched pass.
+    :param standardized_pred_coll: a list with the standardized predictions of each model
+                                  (see standardize_patch_predictions())
+    :param condensed: True: only the unique pairs i < j are computed (see get_model_pair_indices())
+    :return: correlation coefficients with shape (# models, # models, # images), or (# pairs, # images) if condensed
+    """
+    standardized_stack = np.stack(standardized_pred_coll)
+    if condensed:
+        models_nr, images_nr = standardized_stack.shape[0], standardized_stack.shape[1]
+        first_model_ind, _ = get_model_pair_indices(models_nr)
+        correlation = np.empty((len(first_model_ind), images_nr))
+        pair_ind = 0
+        for model_ind in range(0, models_nr - 1):
+            next_pair_ind = pair_ind + models_nr - model_ind - 1
+            correlation[pair_ind:next_pair_ind] = np.sum(standardized_stack[model_ind] *
+                                                         standardized_stack[model_ind + 1:], axis=-1)
+            pair_ind = next_pair_ind
+        return correlation
+
+    # (images, models, patches) so that the matrix product is batched over the images
+    standardized_stack = standardized_stack.transpose(1, 0, 2)
+    return np.matmul(standardized_stack, standardized_stack.transpose(0, 2, 1)).transpose(1, 2, 0)
+
+
+def compute_continuous_stability_scores(raw_predictions, condensed=False):
     """
     Computes the stability scores that use continuous [0, 1] predictions.
     A stability is always a score derived from pairwise comparison of two predictions on the same image.
@@ -358,21 +395,60 @@ def compute_continuous_stability_scores(raw_predictions):
         (e.g. predictions of Model #1 with predictions of Model #2
         and predictions of Model #2 with predictions of Model #1)
     Results contain comparisons with itself (e.g. prediction of Model#1 with predictions of Model #1)
+    The predictions (and their ranks) of each model are standardized once, and the coefficients of all pairs are
+    computed together.
+    If condensed is True, only the unique pairs (Model #i with Model #j, i < j) are computed.
     :param raw_predictions: Raw predictions which are NOT binary (0/1)
-    :return: List of Peason's rank correlation coefficient and Spearman's rho correlation between all prediction pairs
-    """
-    pearson_corr_col = []
-    spearman_corr_col = []
-    for pred_inner in raw_predictions:
-        for pred_outer in raw_predictions:
-            pearson_corr = calculate_pearson_coefficient(pred_inner, pred_outer)
-            spearman_corr = calculate_spearman_rank_coefficient(pred_inner, pred_outer)
-            pearson_corr_col.append(pearson_corr)
-            spearman_corr_col.append(spearman_corr)
+    :param condensed: True: return the scores in the condensed layout (see get_model_pair_indices())
+    :return: Peason's rank correlation coefficient and Spearman's rho correlation between all prediction pairs, each
+    with a shape of (# models, # models, # images), or (# pairs, # images) if condensed
+    """
+    pearson_corr_col = calculate_correlation_between_all_classifiers(
+        [standardize_patch_predictions(raw_pred) for raw_pred in raw_predictions], condensed=condensed)
+    spearman_corr_col = calculate_correlation_between_all_classifiers(
+        [standardize_patch_predictions(rank_patch_predictions(raw_pred)) for raw_pred in raw_predictions],
+        condensed=condensed)
     return pearson_corr_col, spearman_corr_col
 
 
-def compute_binary_stability_scores(threshold, raw_pred_coll):
+def compute_binary_stability_scores_from_subsets(n00, n10, n01, n11):
+    """
+    Derives all stability scores on binary predictions from already computed n00, n10, n01, n11 counts.
+    The formulas are the same as in calculate_positive_Jaccard(), calculate_corrected_positive_Jaccard(),
+    calculate_corrected_Jaccard_heuristic(), calculate_positive_overlap(), calculate_corrected_positive_overlap() and
+    calculate_corrected_IOU(). The counts can have any shape, e.g. (images,) for a single pair of models or
+    (models, models, images) for all pairs, and the scores keep that shape.
+    Images where a score is not defined (0/0) get a NaN value.
+    :param n00: number of patches predicted as negative by both models
+    :param n10: number of patches predicted as positive by the first model and as negative by the second model
+    :param n01: number of patches predicted as negative by the first model and as positive by the second model
+    :param n11: number of patches predicted as positive by both models
+    :return: positive Jaccard, corrected positive Jaccard, heuristic correction of positive jaccard , overlap,
+     corrected positive overlap and corrected IOU(Jaccard)
+    """
+    N = n00 + n11 + n10 + n01
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pos_jaccard = n11 / (n11 + n10 + n01)
+
+        expected_positive_overlap = (n11 + n01) * (n11 + n10) / N
+        corr_pos_jaccard = ((n11 - expected_positive_overlap) / (n10 + n11 + n01 - expected_positive_overlap))
+
+        max_overlap = np.maximum((2*n11 + n01 + n10) - N, 0)
+        heur_corr_jaccard = ((n11 - max_overlap) / (n10 + n11 + n01 - max_overlap))
+
+        pos_overlap = n11 / (np.minimum(n10, n01) + n11)
+
+        corr_pos_overlap = ((n11 - expected_positive_overlap) /
+                            (np.minimum((n11 + n01), (n11 + n10)) - expected_positive_overlap))
+
+        expected_positive_overlap_iou = (((n11 + n01) / N) * ((n11 + n10) / N)) * N
+        expected_negative_overlap_iou = (((n00 + n01) / N) * ((n00 + n10) / N)) * N
+        corr_iou = ((n11 + n00 - expected_positive_overlap_iou - expected_negative_overlap_iou) /
+                    (N - expected_positive_overlap_iou - expected_negative_overlap_iou))
+    return pos_jaccard, corr_pos_jaccard, heur_corr_jaccard, pos_overlap, corr_pos_overlap, corr_iou
+
+
+def compute_binary_stability_scores(threshold, raw_pred_coll, condensed=False):
     """
     Computes the stability scores that use binary (0/1) predictions after converting the raw predictions to binary.
     A stability is always a score derived from pairwise comparison of two predictions on the same image.
@@ -381,56 +457,133 @@ def compute_binary_stability_scores(threshold, raw_pred_coll):
         (e.g. predictions of Model #1 with predictions of Model #2
         and predictions of Model #2 with predictions of Model #1)
     Results contain comparisons with itself (e.g. prediction of Model#1 with predictions of Model #1)
+    The binary predictions are kept bit-packed, and the n00, n10, n01, n11 subsets of all pairs are computed once
+    from them. All scores are derived from these subsets.
+    If condensed is True, only the unique pairs (Model #i with Model #j, i < j) are computed.
 
     :param threshold: threshold for binarization
     :param raw_pred_coll: raw predictions
-    :return: List of positive Jaccard, corrected positive Jaccard, heuristic correction of positive jaccard , overlap,
-     positive overlap  and corrected IOU(Jaccard) from each pairwise comparison
+    :param condensed: True: return the scores in the condensed layout (see get_model_pair_indices())
+    :return: positive Jaccard, corrected positive Jaccard, heuristic correction of positive jaccard , overlap,
+     positive overlap  and corrected IOU(Jaccard) from each pairwise comparison. Each score has a shape of
+     (# models, # models, # images), or (# pairs, # images) if condensed.
     """
-    binary_predictions_coll = []
-    jaccard_coll, corr_jacc_coll, heur_corr_jacc_coll, overlap_coll, \
-        corr_overlap_coll, corr_iou_coll = [], [], [], [], [], []
-
-    for raw_pred in raw_pred_coll:
-        binary_predictions = binarize_predictions(raw_pred, threshold=threshold)
-        binary_predictions_coll.append(binary_predictions)
+    packed_predictions_stack = np.stack([binarize_and_pack_predictions(raw_pred, threshold=threshold, P=16)
+                                         for raw_pred in raw_pred_coll])
+    n00, n10, n01, n11 = calculate_subsets_between_all_packed_classifiers(packed_predictions_stack, P=16,
+                                                                         condensed=condensed)
+    return compute_binary_stability_scores_from_subsets(n00, n10, n01, n11)
 
-    for bin_pred_outer in binary_predictions_coll:
-        for bin_pred_inner in binary_predictions_coll:
-            jaccard_indices = calculate_positive_Jaccard(bin_pred_outer, bin_pred_inner, 16)
-            jaccard_coll.append(jaccard_indices)
 
-            heur_corrected_jacc = calculate_corrected_Jaccard_heuristic(bin_pred_outer, bin_pred_inner)
-            heur_corr_jacc_coll.append(heur_corrected_jacc)
-
-            corrected_pos_jacc = calculate_corrected_positive_Jaccard(bin_pred_outer, bin_pred_inner)
-            corr_jacc_coll.append(corrected_pos_jacc)
-
-            overlap_coeff = calculate_positive_overlap(bin_pred_outer, bin_pred_inner, 16)
-            overlap_coll.append(overlap_coeff)
-
-            corrected_overlap = calculate_corrected_positive_overlap(bin_pred_outer, bin_pred_inner)
-            corr_overlap_coll.append(corrected_overlap)
-
-            corrected_iou = calculate_corrected_IOU(bin_pred_outer, bin_pred_inner)
-            corr_iou_coll.append(corrected_iou)
-    return jaccard_coll, corr_jacc_coll, heur_corr_jacc_coll, overlap_coll, corr_overlap_coll, corr_iou_coll
+def compute_binary_stability_scores_varying_threshold(thresholds, raw_pred_coll, condensed=False):
+    """
+    Computes the stability scores that use binary (0/1) predictions for a whole grid of binarization thresholds.
+    Each raw prediction is placed once among the sorted thresholds, and the n00, n10, n01, n11 subsets for all
+    thresholds follow from cumulative counts (see calculate_subsets_between_all_classifiers_varying_threshold()).
+    :param thresholds: thresholds for binarization sorted in ascending order
+    :param raw_pred_coll: raw predictions
+    :param condensed: True: only the unique pairs of models are compared (see get_model_pair_indices())
+    :return: positive Jaccard, corrected positive Jaccard, heuristic correction of positive jaccard , overlap,
+     positive overlap  and corrected IOU(Jaccard) from each pairwise comparison. Each score has a shape of
+     (# models, # models, # thresholds, # images), or (# pairs, # thresholds, # images) if condensed.
+    """
+    n00, n10, n01, n11 = calculate_subsets_between_all_classifiers_varying_threshold(raw_pred_coll, thresholds, P=16,
+                                                                                     condensed=condensed)
+    return compute_binary_stability_scores_from_subsets(n00, n10, n01, n11)
 
 
-def compute_stability_scores(raw_predictions_collection, bin_threshold=0.5):
+def compute_stability_scores(raw_predictions_collection, bin_threshold=0.5, condensed=False):
     '''
     Computes the stability scores between models. For models considering binary predictions (0/1 predictions),
     a threshold of 0.5 is used for the binarization of the raw predictions
     :param raw_predictions_collection: a collection where each element is a list with the raw predictions of a models
     :param bin_threshold: a threshold used for the binarization of raw predictions to binary ones.
                             Binary predictions are needed for some of the  stability scores.
+    :param condensed: True: only the unique pairs of models are compared and each score has a shape of
+                    (# pairs, # images) (see get_model_pair_indices()). False: each score has a shape of
+                    (# models, # models, # images)
     :return: Computes all stability scores - positive Jaccard, Corrected positive Jaccard, positive Jaccard with
     heuristic correction, positive overlap, corrected positive overlap, corrected IOU
     '''
 
     pos_jacc, corr_pos_jacc, corr_pos_jacc_heur, pos_overlap, corr_pos_overlap, corr_iou = \
-        compute_binary_stability_scores(bin_threshold, raw_predictions_collection)
+        compute_binary_stability_scores(bin_threshold, raw_predictions_collection, condensed=condensed)
     pearson_correlation, spearman_rank_correlation = compute_continuous_stability_scores(
-        raw_predictions_collection)
+        raw_predictions_collection, condensed=condensed)
     return pos_jacc, corr_pos_jacc, corr_pos_jacc_heur, pos_overlap, corr_pos_overlap, corr_iou, \
            pearson_correlation, spearman_rank_correlation
+
+
+# order of the scores returned by compute_stability_scores()
+STABILITY_SCORE_NAMES = ('pos_jacc', 'corr_pos_jacc', 'corr_pos_jacc_heur', 'pos_overlap', 'corr_pos_overlap',
+                         'corr_iou', 'pearson_correlation', 'spearman_rank_correlation')
+
+
+def compute_stability_scores_in_blocks(raw_predictions_collection, results_path, block_size=1024, bin_threshold=0.5,
+                                       image_rows_collection=None, file_suffix=''):
+    """
+    Computes the stability scores between models block by block of images and writes them to .npy files on disk.
+    Only the predictions of the current block are loaded, so with memory mapped predictions
+    (see load_raw_predictions_memmap()) the peak memory depends on the block size and not on the size of the test set.
+    The scores are stored in the condensed layout (see compute_stability_scores()), one file per score:
+    results_path + 'stability_' + score name + file_suffix + '.npy'
+    :param raw_predictions_collection: a collection with the raw predictions of each model, e.g. memory maps
+    :param results_path: directory where the stability scores are saved
+    :param block_size: number of images processed together
+    :param bin_threshold: a threshold used for the binarization of raw predictions to binary ones.
+    :param image_rows_collection: optional - for each model, the rows of the images to compare in its predictions.
+                                The rows of all models should refer to the same images in the same order.
+                                None: all images are compared.
+    :param file_suffix: suffix added to the file names, e.g. the identifier of the images compared
+    :return: the stability scores in the same order as compute_stability_scores(), as read-only memory maps with a
+    shape of (# pairs, # images)
+    """
+    if image_rows_collection is None:
+        image_rows_collection = [np.arange(raw_predictions.shape[0]) for raw_predictions in raw_predictions_collection]
+    assert len(image_rows_collection) == len(raw_predictions_collection), "The lists do not have the same length"
+    images_nr = len(image_rows_collection[0])
+    for image_rows in image_rows_collection:
+        assert len(image_rows) == images_nr, "The models do not have the same number of images"
+    pairs_nr = len(get_model_pair_indices(len(raw_predictions_collection))[0])
+
+    score_files = [results_path + 'stability_' + score_name + file_suffix + '.npy'
+                   for score_name in STABILITY_SCORE_NAMES]
+    score_memmaps = [np.lib.format.open_memmap(score_file, mode='w+', dtype=np.float64, shape=(pairs_nr, images_nr))
+                     for score_file in score_files]
+
+    for block_start in range(0, images_nr, block_size):
+        block_end = min(block_start + block_size, images_nr)
+        raw_predictions_block = [read_prediction_rows(raw_predictions, image_rows[block_start:block_end])
+                                 for raw_predictions, image_rows in zip(raw_predictions_collection,
+                                                                        image_rows_collection)]
+        block_scores = compute_stability_scores(raw_predictions_block, bin_threshold=bin_threshold, condensed=True)
+        for score_memmap, block_score in zip(score_memmaps, block_scores):
+            score_memmap[:, block_start:block_end] = block_score
+        print("Stability scores computed for images " + str(block_end) + "/" + str(images_nr))
+
+    for score_memmap in score_memmaps:
+        score_memmap.flush()
+    del score_memmaps
+    return tuple(np.load(score_file, mmap_mode='r') for score_file in score_files)
+
+
+def compute_stability_scores_from_files(classifiers, predictions_path, results_path, image_rows_collection,
+                                        block_size=1024, file_suffix=''):
+    """
+    Computes the stability scores between models block by block, reading from the prediction files of each model only
+    the predictions of the current block (see compute_stability_scores_in_blocks()).
+    :param classifiers: names of the model predictions
+    :param predictions_path: directory of the prediction files
+    :param results_path: directory where the stability scores are saved
+    :param image_rows_collection: for each model, the rows of the images to compare (see load_filtered_image_rows())
+    :param block_size: number of images processed together
+    :param file_suffix: suffix added to the file names of the scores
+    :return: the stability scores in the same order as compute_stability_scores(), in the condensed layout
+    """
+    raw_predictions_collection = load_raw_predictions_memmap(classifiers, predictions_path)
+    try:
+        return compute_stability_scores_in_blocks(raw_predictions_collection, results_path, block_size=block_size,
+                                                  image_rows_collection=image_rows_collection,
+                                                  file_suffix=file_suffix)
+    finally:
+        close_raw_predictions(raw_predictions_collection)
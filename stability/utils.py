@@ -1,7 +1,7 @@
 import pandas as pd
 from sklearn.metrics import roc_auc_score, average_precision_score
 
-from stability.preprocessing import binarize_predictions
+from stability.preprocessing import binarize_predictions, get_model_pair_indices
 from stability.stability_scores import compute_additional_scores_kappa
 import numpy as np
 
@@ -110,31 +110,45 @@ def calculate_aggregated_performance(columns, operation, stability_values):
     return df2
 
 
+def get_models_nr_from_condensed(condensed_scores):
+    """
+    Recovers the number of models K from condensed stability scores with K*(K-1)/2 rows.
+    :param condensed_scores: stability scores with shape (# pairs, # images)
+    :return: number of models
+    """
+    models_nr = int(round((1 + np.sqrt(1 + 8 * condensed_scores.shape[0])) / 2))
+    assert models_nr * (models_nr - 1) // 2 == condensed_scores.shape[0], "Scores are not in the condensed layout"
+    return models_nr
+
+
+def expand_condensed_scores(condensed_scores, diagonal_value=np.nan):
+    """
+    Mirrors stability scores of the unique pairs of models (i < j) to the full (# models, # models, # images) cube,
+    for code that indexes the scores by model pair.
+    :param condensed_scores: stability scores with shape (# pairs, # images) (see get_model_pair_indices())
+    :param diagonal_value: value used for the comparison of a model with itself, which is not computed
+    :return: stability scores with shape (# models, # models, # images)
+    """
+    condensed_scores = np.asarray(condensed_scores)
+    models_nr = get_models_nr_from_condensed(condensed_scores)
+    first_model_ind, second_model_ind = get_model_pair_indices(models_nr)
+    stability_cube = np.full((models_nr, models_nr, condensed_scores.shape[1]), diagonal_value,
+                             dtype=np.result_type(condensed_scores, diagonal_value))
+    stability_cube[first_model_ind, second_model_ind] = condensed_scores
+    stability_cube[second_model_ind, first_model_ind] = condensed_scores
+    return stability_cube
+
+
 def get_matrix_total_nans_stability_score(stab_index_collection, total_images_collection, normalize):
-    nan_matrix = np.count_nonzero(np.isnan(np.array(stab_index_collection).
-                                           reshape(5, 5, len(total_images_collection[0]))), axis=-1)
+    stab_index_collection = np.asarray(stab_index_collection)
+    nan_matrix = np.count_nonzero(np.isnan(stab_index_collection.reshape(stab_index_collection.shape[0], -1,
+                                                                         len(total_images_collection[0]))), axis=-1)
     if normalize:
         return nan_matrix / len(total_images_collection[0])
     else:
         return nan_matrix
 
 
-def get_nonduplicate_scores(total_images, models_nr, stability_score_coll):
-    pairwise_stability_all_images = []
-    # total_images = inst_labels[0].shape[0]
-    # FOR EACH IMAGE, THE PREDICTIONS OF EACH CLASSIFIERS ARE COMPARED WITH THE WHOLE BAG AND AUC IS COMPUTED
-    for image_ind in range(0, total_images):
-        image_stab_scores = []
-        for classifier_ind in range(0, models_nr):
-            stab_scores = stability_score_coll[classifier_ind, classifier_ind + 1:, image_ind]
-            image_stab_scores = np.concatenate((image_stab_scores, stab_scores))
-        pairwise_stability_all_images.append(image_stab_scores)
-    # TOTAL_IMAGES x 10 combinations of stability
-    stability_res = np.array(pairwise_stability_all_images)
-
-    return stability_res
-
-
 # todo: delete if not used
 def compute_ap(inst_labels, inst_pred):
     image_ap_collection_all_classifiers = []
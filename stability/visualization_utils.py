@@ -6,7 +6,7 @@ from scipy.optimize import curve_fit
 from cnn.keras_utils import image_larger_input, calculate_scale_ratio, set_dataset_flag
 from cnn.preprocessor.load_data_mura import padding_needed, pad_image
 from stability.utils import get_image_index, save_additional_kappa_scores_forthreshold, save_mean_stability, \
-    get_nonduplicate_scores, compute_ap, get_matrix_total_nans_stability_score
+    compute_ap, get_matrix_total_nans_stability_score, expand_condensed_scores
 
 # matplotlib.use('Agg')
 # matplotlib.use('TKAgg',warn=False, force=True)
@@ -16,10 +16,8 @@ import cv2
 import matplotlib.cm as cm
 import seaborn as sns
 
-from stability.preprocessing import binarize_predictions
-from stability.stability_scores import calculate_positive_Jaccard, \
-    calculate_corrected_Jaccard_heuristic, calculate_corrected_positive_Jaccard, calculate_positive_overlap, \
-    calculate_corrected_positive_overlap, calculate_corrected_IOU
+from stability.preprocessing import calculate_subsets_between_two_classifiers_varying_threshold
+from stability.stability_scores import compute_binary_stability_scores_from_subsets
 
 
 def get_image_index_from_pathstring(string_path):
@@ -602,42 +600,14 @@ def plot_change_stability_varying_threshold_per_image(overlap_coll, jacc_coll, c
                     threshold_coll, 'threshold', res_path, 'varying_thres_stability' + str(img_ind), "")
 
 
-def plot_change_stability_varying_threshold(raw_predictions1, raw_predictions2, res_path, image_indices):
-    threshold_list = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-    jacc_collection = []
-    corr_jacc_collection = []
-    corr_iou_collection = []
-    jacc_pgn_collection = []
-    overlap_collection = []
-    corr_overlap_collection = []
-
-    for threshold_bin in threshold_list:
-        binary_predictions1 = binarize_predictions(raw_predictions1, threshold=threshold_bin)
-        binary_predictions2 = binarize_predictions(raw_predictions2, threshold=threshold_bin)
-
-        jaccard_indices = calculate_positive_Jaccard(binary_predictions1, binary_predictions2, 16)
-        jaccard_indices_mask = np.ma.masked_array(jaccard_indices, np.isnan(jaccard_indices))
-        jacc_collection.append(jaccard_indices_mask)
-
-        ############################################ Corrected Jaccard - PIGEONHOLE coefficient  #########################
-        corrected_jacc_pigeonhole = calculate_corrected_Jaccard_heuristic(binary_predictions1, binary_predictions2)
-        jacc_pgn_collection.append(corrected_jacc_pigeonhole)
-
-        ############################################ Corrected Jaccard coefficient  #########################
-        corrected_pos_jacc = calculate_corrected_positive_Jaccard(binary_predictions1, binary_predictions2)
-        corr_jacc_collection.append(corrected_pos_jacc)
-
-        ############################################  Overlap coefficient #########################
-        overlap_coeff = calculate_positive_overlap(binary_predictions1, binary_predictions2, 16)
-        overlap_collection.append(overlap_coeff)
-
-        ############################################ Corrected overlap coefficient  #########################
-        corrected_overlap = calculate_corrected_positive_overlap(binary_predictions1, binary_predictions2)
-        corr_overlap_collection.append(corrected_overlap)
-
-        ############################################  corrected IOU score   #########################
-        corrected_iou = calculate_corrected_IOU(binary_predictions1, binary_predictions2)
-        corr_iou_collection.append(corrected_iou)
+def plot_change_stability_varying_threshold(raw_predictions1, raw_predictions2, res_path, image_indices,
+                                            threshold_list=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)):
+    # the subsets for all thresholds are computed together, so a dense grid of thresholds can be used as well
+    n00, n10, n01, n11 = calculate_subsets_between_two_classifiers_varying_threshold(raw_predictions1,
+                                                                                     raw_predictions2,
+                                                                                     threshold_list, P=16)
+    jacc_collection, corr_jacc_collection, jacc_pgn_collection, overlap_collection, corr_overlap_collection, \
+    corr_iou_collection = compute_binary_stability_scores_from_subsets(n00, n10, n01, n11)
 
     st_dev_collection = []
     for idx in range(0, len(image_indices)):
@@ -712,6 +682,8 @@ def generate_visualizations_stability(config, visualize_per_image,pos_jacc, corr
                  4. Lastly, computation of average stability score across all models per image.
                  This information is saved in a file, allowing further analysis. This information reveal differences in
                   values of the stability scores for the same image.
+    All stability scores are expected in the condensed layout with a shape of (# pairs of models, # images),
+    as returned by compute_stability_scores(..., condensed=True).
 
 
     :param config: configuration file
@@ -745,21 +717,22 @@ def generate_visualizations_stability(config, visualize_per_image,pos_jacc, corr
 
     dataset_identifier += samples_identifier
 
-    # Reshaping the stability scores by (# models compared, # models compared, # samples compared).
-    # Taking an index of the array in the 3rd dimension results in a 2 dimensional array
+    # The stability scores are in the condensed layout (# pairs of models, # samples compared), with only the
+    # unique pairs of models. For the heatmaps they are mirrored to (# models compared, # models compared,
+    # # samples compared). Taking an index of the array in the 3rd dimension results in a 2 dimensional array
     # with size of (#models compared, # model compared).
     # Each element of the 2D array keeps the stability score between 2 specific models.
     # Consider the following example of the array for specific image (indexing on the 3rd dimension)
     # E.g.  Mod1 Mod2 Mod3    The example assumes a comparison between the predictions of 3 different models.
-    #  Mod1 | a  | b  | c |
-    #  Mod2 | b  | d  | e |
-    #  Mod3 | c  | e  | f |
-    reshaped_jacc_coll = np.asarray(pos_jacc).reshape(5, 5, len(image_index_collection[0]))
-    reshaped_corr_jacc_coll = np.asarray(corr_pos_jacc).reshape(5, 5, len(image_index_collection[0]))
-    reshaped_spearman_coll = np.asarray(spearman_rank_correlation).reshape(5, 5, len(image_index_collection[0]))
-    reshaped_corr_iou = np.asarray(corr_iou).reshape(5, 5, len(image_index_collection[0]))
-
-    xyaxis = ['classifier1', 'classifier2', 'classifier3', 'classifier4', 'classifier5']
+    #  Mod1 | -  | a  | b |
+    #  Mod2 | a  | -  | c |
+    #  Mod3 | b  | c  | - |
+    reshaped_jacc_coll = expand_condensed_scores(pos_jacc)
+    reshaped_corr_jacc_coll = expand_condensed_scores(corr_pos_jacc)
+    reshaped_spearman_coll = expand_condensed_scores(spearman_rank_correlation)
+    reshaped_corr_iou = expand_condensed_scores(corr_iou)
+
+    xyaxis = ['classifier' + str(model_ind + 1) for model_ind in range(reshaped_jacc_coll.shape[0])]
     if visualize_per_image:
         visualize_5_classifiers(use_xray, use_pascal, image_index_collection, image_labels_collection,
                                 raw_predictions_collection, image_path, stability_path, class_name, '_test_5_class')
@@ -770,24 +743,24 @@ def generate_visualizations_stability(config, visualize_per_image,pos_jacc, corr
     ma_spearman = np.ma.masked_array(reshaped_spearman_coll, np.isnan(reshaped_spearman_coll))
 
     ############ visualizing NANs of corrected jaccard ###################
-    nan_matrix_norm = get_matrix_total_nans_stability_score(corr_pos_jacc, image_index_collection, normalize=True)
+    nan_matrix_norm = get_matrix_total_nans_stability_score(reshaped_corr_jacc_coll, image_index_collection, normalize=True)
     visualize_correlation_heatmap(nan_matrix_norm, stability_path, '_corr_pos_jacc_nan_norm' + samples_identifier, xyaxis,
                                   dropDuplicates=True)
-    nan_matrix = get_matrix_total_nans_stability_score(corr_pos_jacc, image_index_collection, normalize=False)
+    nan_matrix = get_matrix_total_nans_stability_score(reshaped_corr_jacc_coll, image_index_collection, normalize=False)
     visualize_correlation_heatmap(nan_matrix, stability_path, '_corr_pos_jacc_nan' + samples_identifier, xyaxis,
                                   dropDuplicates=True)
 
-    nan_matrix_jacc_norm = get_matrix_total_nans_stability_score(pos_jacc, image_index_collection, normalize=True)
+    nan_matrix_jacc_norm = get_matrix_total_nans_stability_score(reshaped_jacc_coll, image_index_collection, normalize=True)
     visualize_correlation_heatmap(nan_matrix_jacc_norm, stability_path, '_pos_jacc_nan_norm' + samples_identifier, xyaxis,
                                   dropDuplicates=True)
-    nan_matrix_jacc = get_matrix_total_nans_stability_score(pos_jacc, image_index_collection, normalize=False)
+    nan_matrix_jacc = get_matrix_total_nans_stability_score(reshaped_jacc_coll, image_index_collection, normalize=False)
     visualize_correlation_heatmap(nan_matrix_jacc, stability_path, '_pos_jacc_nan' + samples_identifier, xyaxis,
                                   dropDuplicates=True)
-    nan_matrix_spearman = get_matrix_total_nans_stability_score(spearman_rank_correlation,
+    nan_matrix_spearman = get_matrix_total_nans_stability_score(reshaped_spearman_coll,
                                                                 image_index_collection, normalize=False)
     visualize_correlation_heatmap(nan_matrix_spearman, stability_path, '_spearman_nan' + samples_identifier, xyaxis,
                                   dropDuplicates=True)
-    nan_matrix_spearman_norm = get_matrix_total_nans_stability_score(spearman_rank_correlation,
+    nan_matrix_spearman_norm = get_matrix_total_nans_stability_score(reshaped_spearman_coll,
                                                                      image_index_collection, normalize=True)
     visualize_correlation_heatmap(nan_matrix_spearman_norm, stability_path, '_spearman_nan_norm' + samples_identifier,
                                   xyaxis,
@@ -824,16 +797,12 @@ def generate_visualizations_stability(config, visualize_per_image,pos_jacc, corr
                                   xyaxis, dropDuplicates=True)
 
     #### AVERAGE ACROSS ALL CLASSIFIERS - PER IMAGE #######
-    mask_repetition = np.ones((ma_corr_jaccard_images.shape), dtype=bool)
-    for i in range(0, 4):
-        for j in range(i + 1, 5):
-            mask_repetition[i, j, :] = False
-    mean_all_classifiers_corr_jacc = np.mean(np.ma.masked_array(ma_corr_jaccard_images,
-                                                                mask=mask_repetition), axis=(0, 1))
-    mean_all_classifiers_jacc = np.mean(np.ma.masked_array(ma_jaccard_images, mask=mask_repetition), axis=(0, 1))
+    # the condensed scores hold every pair of classifiers once
+    mean_all_classifiers_corr_jacc = np.mean(np.ma.masked_array(corr_pos_jacc, np.isnan(corr_pos_jacc)), axis=0)
+    mean_all_classifiers_jacc = np.mean(np.ma.masked_array(pos_jacc, np.isnan(pos_jacc)), axis=0)
 
-    mean_all_classifiers_iou = np.mean(np.ma.masked_array(ma_corr_iou, mask=mask_repetition), axis=(0, 1))
-    mean_all_classifiers_spearman = np.mean(np.ma.masked_array(ma_spearman, mask=mask_repetition), axis=(0, 1))
+    mean_all_classifiers_iou = np.mean(np.ma.masked_array(corr_iou, np.isnan(corr_iou)), axis=0)
+    mean_all_classifiers_spearman = np.mean(np.ma.masked_array(spearman_rank_correlation, np.isnan(spearman_rank_correlation)), axis=0)
 
     save_mean_stability(image_index_collection[0], mean_all_classifiers_jacc, mean_all_classifiers_corr_jacc,
                         mean_all_classifiers_iou, mean_all_classifiers_spearman, stability_path, samples_identifier)
@@ -851,6 +820,8 @@ def generate_visualizations_instance_level(config,pos_jacc, corr_pos_jacc, corr_
      Another interesting aspect is the behaviour of stability score for bag with high std dev of dice - or how stable
      are images for which models suggest various performance. Some visualization include std dev of the x-axis data,
      other on the y-axis. Some of the visualizations support line of best fit as well.
+     All stability scores are expected in the condensed layout with a shape of (# pairs of models, # images),
+     as returned by compute_stability_scores(..., condensed=True).
     :param config:
     :param classifiers: list of results names
     :param only_segmentation_images: True: only images with available segmentation to consider. This should be True
@@ -859,29 +830,24 @@ def generate_visualizations_instance_level(config,pos_jacc, corr_pos_jacc, corr_
     """
 
 
-    reshaped_pos_jacc_coll = np.asarray(pos_jacc).reshape(5, 5, len(image_index_collection[0]))
-    reshaped_corr_pos_jacc_coll = np.asarray(corr_pos_jacc).reshape(5, 5, len(image_index_collection[0]))
-    reshaped_spearman_coll = np.asarray(spearman_rank_correlation).reshape(5, 5, len(image_index_collection[0]))
-    reshaped_corr_iou = np.asarray(corr_iou).reshape(5, 5, len(image_index_collection[0]))
-
-    #### Reshape, drop duplicates, calculate mean and st dev
-    nonduplicate_corr_pos_jacc = get_nonduplicate_scores(len(image_index_collection[0]), 5, reshaped_corr_pos_jacc_coll)
+    #### Drop duplicates (the condensed scores keep every pair of models once), calculate mean and st dev
+    nonduplicate_corr_pos_jacc = np.asarray(corr_pos_jacc).T
     avg_stability_corr_pos_jacc = np.mean(np.ma.masked_array(nonduplicate_corr_pos_jacc, np.isnan(nonduplicate_corr_pos_jacc)), axis=1)
     stdev_stability_corr_pos_jacc = np.std(np.ma.masked_array(nonduplicate_corr_pos_jacc,
                                                          np.isnan(nonduplicate_corr_pos_jacc)), axis=1)
 
-    nonduplicate_spear = get_nonduplicate_scores(len(image_index_collection[0]), 5, reshaped_spearman_coll)
+    nonduplicate_spear = np.asarray(spearman_rank_correlation).T
 
     avg_stability_spear = np.mean(nonduplicate_spear, axis=1)
     stdev_stability_spear = np.std(nonduplicate_spear, axis=1)
 
 
-    nonduplicate_pos_jacc = get_nonduplicate_scores(len(image_index_collection[0]), 5, reshaped_pos_jacc_coll)
+    nonduplicate_pos_jacc = np.asarray(pos_jacc).T
     avg_stability_pos_jacc = np.mean(np.ma.masked_array(nonduplicate_pos_jacc, np.isnan(nonduplicate_pos_jacc)), axis=1)
     stdev_stability_pos_jacc = np.std(np.ma.masked_array(nonduplicate_pos_jacc,
                                                          np.isnan(nonduplicate_pos_jacc)), axis=1)
 
-    nonduplicate_corr_iou = get_nonduplicate_scores(len(image_index_collection[0]), 5, reshaped_corr_iou)
+    nonduplicate_corr_iou = np.asarray(corr_iou).T
     avg_stability_corr_iou = np.mean(np.ma.masked_array(nonduplicate_corr_iou, np.isnan(nonduplicate_corr_iou)), axis=1)
     stdev_stability_corr_iou = np.std(np.ma.masked_array(nonduplicate_corr_iou,
                                                          np.isnan(nonduplicate_corr_iou)), axis=1)
@@ -918,19 +884,5 @@ def generate_visualizations_instance_level(config,pos_jacc, corr_pos_jacc, corr_
                                    x_errors=stdev_stability_spear,
                                    error_bar=True, bin_threshold_prefix=0)
 
-    mask_repetition = np.ones((reshaped_corr_pos_jacc_coll.shape), dtype=bool)
-    for i in range(0, 4):
-        for j in range(i + 1, 5):
-            mask_repetition[i, j, :] = False
-    diag_classifiers_corr_jacc = np.ma.masked_array(reshaped_corr_pos_jacc_coll, mask=mask_repetition)
-    diag_masked_corr_jacc = np.ma.masked_array(diag_classifiers_corr_jacc, mask=np.isnan(diag_classifiers_corr_jacc))
-    mean_corr_jacc = np.mean(diag_masked_corr_jacc, axis=(0, 1))
-
-    diag_classifiers_spearman = np.ma.masked_array(reshaped_spearman_coll, mask=mask_repetition)
-    diag_masked_spearman = np.ma.masked_array(diag_classifiers_spearman, mask=np.isnan(diag_classifiers_spearman))
-    mean_spearman = np.mean(diag_masked_spearman, axis=(0, 1))
-    assert mean_corr_jacc.all() == avg_stability_corr_pos_jacc.all(), "error"
-    assert mean_spearman.all() == avg_stability_spear.all(), "error"
-
     save_mean_stability(image_index_collection[0], avg_stability_pos_jacc, avg_stability_corr_pos_jacc,
                         avg_stability_corr_iou, avg_stability_spear, stability_res_path, "bbox", avg_dice, std_dev_dice)